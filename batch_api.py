@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+import gzip
+import json
+import logging
+import os
+import time
+
+from argument_mining_persuade import utils
+
+log = logging.getLogger('main_logger')
+
+# Final states of a batch job
+BATCH_TERMINAL_STATES = ("completed", "failed", "expired", "cancelled")
+
+
+def run_batch_jobs(batch_files, output_dir, client=None,
+                   poll_interval=30, max_poll_interval=600,
+                   max_resubmissions=2, completion_window="24h"):
+    """
+    Run the whole lifecycle of OpenAI batch jobs for the batch files written
+    by utils.write_batch_file: upload and submit every file, poll the jobs
+    with increasing intervals, download the results and merge them into one
+    result file. Requests that failed or are missing in the results are
+    resubmitted in a new batch file up to max_resubmissions times.
+
+    Parameters
+    ----------
+    batch_files : list of str
+        Paths of the batch files (.jsonl or .jsonl.gz).
+    output_dir : str
+        Directory the downloaded and merged result files are written to.
+    client : openai.OpenAI, optional
+        Client used for the Batch API, e.g., with the base_url of the local
+        fake server. The default is a client configured by the environment.
+    poll_interval : float, optional
+        Seconds before the first status request. The interval increases by
+        half with every request. The default is 30.
+    max_poll_interval : float, optional
+        Max seconds between two status requests. The default is 600.
+    max_resubmissions : int, optional
+        How often failed requests are resubmitted. The default is 2.
+    completion_window : str, optional
+        Completion window of the batch jobs. The default is "24h".
+
+    Returns
+    -------
+    str
+        Path of the merged result file, which can be used as
+        batch_result_file.
+    """
+    if client is None:
+        from openai import OpenAI
+        client = OpenAI()
+
+    tasks = read_batch_tasks(batch_files)
+    result_files = []
+    pending_files = list(batch_files)
+    for attempt in range(max_resubmissions + 1):
+        batch_ids = [submit_batch_file(client, file_name, completion_window)
+                     for file_name in pending_files]
+        batches = wait_for_batches(client, batch_ids, poll_interval,
+                                   max_poll_interval)
+        for batch in batches:
+            result_files.extend(download_batch_results(client, batch,
+                                                       output_dir))
+
+        output_dict, error_dict = utils.read_batch_result_files(result_files)
+        failed_ids = [custom_id for custom_id in tasks
+                      if custom_id not in output_dict]
+        if not failed_ids:
+            break
+        log.info(f"{len(failed_ids)} of {len(tasks)} requests failed or are "
+                 f"missing in the batch results.")
+        if attempt == max_resubmissions:
+            break
+        # Write failed requests to a new batch file and submit it again
+        resubmission_file = os.path.join(
+            output_dir, f"batch_resubmission_{attempt + 1}.jsonl")
+        with open(resubmission_file, "w") as file:
+            for custom_id in failed_ids:
+                file.write(json.dumps(tasks[custom_id]) + "\n")
+        log.info(f"Resubmitting failed requests in {resubmission_file}")
+        pending_files = [resubmission_file]
+
+    return merge_batch_results(result_files, tasks,
+                               os.path.join(output_dir,
+                                            "batch_results_merged.jsonl"))
+
+
+def read_batch_tasks(batch_files):
+    """
+    Return the tasks of the batch files by custom_id.
+    """
+    tasks = {}
+    for file_name in batch_files:
+        with _open_batch_file(file_name) as file:
+            for line in file:
+                if line.strip():
+                    task = json.loads(line)
+                    tasks[task["custom_id"]] = task
+    return tasks
+
+
+def submit_batch_file(client, file_name, completion_window="24h"):
+    """
+    Upload a batch file and create a batch job for it.
+
+    Returns
+    -------
+    str
+        Id of the batch job.
+    """
+    # The Batch API expects uncompressed JSONL files
+    with _open_batch_file(file_name) as file:
+        content = file.read().encode("utf-8")
+    upload_name = os.path.basename(file_name)
+    if upload_name.endswith(".gz"):
+        upload_name = upload_name[:-len(".gz")]
+    input_file = client.files.create(file=(upload_name, content),
+                                     purpose="batch")
+    batch = client.batches.create(input_file_id=input_file.id,
+                                  endpoint="/v1/chat/completions",
+                                  completion_window=completion_window,
+                                  metadata={"batch_file": upload_name})
+    log.info(f"Submitted {file_name} as batch {batch.id}")
+    return batch.id
+
+
+def wait_for_batches(client, batch_ids, poll_interval=30,
+                     max_poll_interval=600):
+    """
+    Poll the batch jobs until all of them reached a final state.
+
+    Returns
+    -------
+    list
+        Final batch objects in the order of batch_ids.
+    """
+    batches = {}
+    while len(batches) < len(batch_ids):
+        time.sleep(poll_interval)
+        for batch_id in batch_ids:
+            if batch_id in batches:
+                continue
+            batch = client.batches.retrieve(batch_id)
+            if batch.status in BATCH_TERMINAL_STATES:
+                log.info(f"Batch {batch_id} {batch.status}: "
+                         f"{batch.request_counts}")
+                batches[batch_id] = batch
+        poll_interval = min(poll_interval * 1.5, max_poll_interval)
+    return [batches[batch_id] for batch_id in batch_ids]
+
+
+def download_batch_results(client, batch, output_dir):
+    """
+    Download the output and error file of a finished batch job.
+
+    Returns
+    -------
+    list of str
+        Paths of the downloaded files.
+    """
+    file_names = []
+    for file_id, suffix in [(batch.output_file_id, "output"),
+                            (batch.error_file_id, "errors")]:
+        if not file_id:
+            continue
+        file_name = os.path.join(output_dir, f"{batch.id}_{suffix}.jsonl")
+        with open(file_name, "wb") as file:
+            file.write(client.files.content(file_id).content)
+        file_names.append(file_name)
+    return file_names
+
+
+def merge_batch_results(result_files, tasks, merged_file):
+    """
+    Merge the results of all batch jobs into one result file with one
+    line per task (the successful result if there is one).
+
+    Returns
+    -------
+    str
+        Path of the merged result file.
+    """
+    lines = {}
+    for file_name in result_files:
+        with open(file_name, "r") as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                response = result.get("response") or {}
+                succeeded = not result.get("error") \
+                    and response.get("status_code") == 200
+                if succeeded or result["custom_id"] not in lines:
+                    lines[result["custom_id"]] = line.strip()
+    with open(merged_file, "w") as file:
+        for custom_id in tasks:
+            if custom_id in lines:
+                file.write(lines[custom_id] + "\n")
+    log.info(f"Merged batch results written to {merged_file}")
+    return merged_file
+
+
+def _open_batch_file(file_name):
+    if file_name.endswith(".gz"):
+        return gzip.open(file_name, "rt")
+    return open(file_name, "r")
@@ -20,6 +20,10 @@ EMBEDDING_ESSAYS = os.path.join(
     DATA_DIR, "essays_for_embeddings.csv")
 OUTPUT_DIR = os.path.join(
     DATA_DIR, "results")
+LLM_CACHE_PATH = os.path.join(
+    DATA_DIR, "llm_cache.sqlite")
+EXAMPLE_RENDER_CACHE_PATH = os.path.join(
+    DATA_DIR, "example_render_cache.json")
 EXAMPLE_ESSAYS_1_SHOT = os.path.join(
     DATA_DIR, "example_essay_1_shot.csv")
 EXAMPLE_ESSAYS_5_SHOT = os.path.join(
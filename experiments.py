@@ -1,10 +1,15 @@
 # -*- coding: utf-8 -*-
+import concurrent.futures
 import pandas as pd
 import os
 import time
 from datetime import datetime
 
+from argument_mining_persuade import batch_api
+from argument_mining_persuade import llm_cache
 from argument_mining_persuade import metrics
+from argument_mining_persuade import prompt_generation
+from argument_mining_persuade import rate_limiter
 from argument_mining_persuade import utils
 
 
@@ -14,7 +19,12 @@ def run_simple_argument_mining_experiment(
         prompt_format="simple", example_df_file=None, fuzzysearch_factor=7,
         slice_start=None, slice_end=None, temperature=0, max_tokens=3000,
         example_format_function=None, batch_result_file="",
-        numOfEssaysPerBatchFile=None):
+        numOfEssaysPerBatchFile=None, maxBatchFileMB=200,
+        maxTokensPerBatchFile=None, compressBatchFiles=False,
+        submit_batch=False, max_concurrency=1, llm_cache_file="",
+        resume_dir="", example_render_cache_file="",
+        fit_examples_to_context=False, max_essays_per_request=8,
+        fuzzy_budget=None, parse_workers=1):
     """
     Function to run a simple argument mining with a simple chain.
 
@@ -37,14 +47,35 @@ def run_simple_argument_mining_experiment(
         If set to true, the model is not invoked directly but a batch file is
         created and writen to the output directory to be used with the
         OpenAI Batch API
+    batch_result_file : string or list of string
+        Path to the result file of the OpenAI Batch API. Several result
+        files (e.g., of multiple batch files) can be given as list or as
+        path with wildcards. If given, the outputs are read from the result
+        files instead of invoking the LLM.
     numOfEssaysPerBatchFile : int
         If a number is given the batch file is parted into multiple files
         with the given amount of essays.
+    maxBatchFileMB : int
+        Max size of a batch file in MB. If the tasks exceed the size, they
+        are written to multiple files. The default is 200 (limit of the
+        OpenAI Batch API).
+    maxTokensPerBatchFile : int
+        Max number of prompt tokens per batch file (e.g., the enqueued token
+        limit of the OpenAI account). The default is None (no limit).
+    compressBatchFiles : boolean
+        Write gzip compressed batch files. The default is False.
+    submit_batch : boolean
+        If set to true together with create_batch_only, the batch files are
+        uploaded and submitted to the OpenAI Batch API. The function waits
+        for the results, resubmits failed requests and evaluates the merged
+        results like a batch_result_file. The default is False.
     prompt_fromat : string
         "simple": The whole prompt consists only of one user (human) message
         "chat": the system role is used for the preample, user (human) massages
                 for the essays that are to be classifed and assistant (ai)
                 messages to show example essays.
+        "packed": chat prompt with several essays per request (see
+                  max_essays_per_request).
     parser : function
         Parser function from utils according to prompt template format.
     example_df_file : string or int
@@ -69,6 +100,52 @@ def run_simple_argument_mining_experiment(
     max_tokens : int, optional
         Max number of tokens the LLM is supposed to generate.
         The default is 3000.
+    max_concurrency : int, optional
+        Max number of requests that are sent to the LLM concurrently. If
+        greater than 1, the LLM is invoked asynchronously. The outputs are
+        still evaluated in the order of the essays. The requests are
+        scheduled by the rate limiter of the model (PROVIDER and
+        RATE_LIMITS of the model_module), which adapts the concurrency up to
+        max_concurrency. The default is 1.
+    llm_cache_file : string, optional
+        Path to an SQLite file used as persistent cache of the LLM outputs.
+        Requests with the same model, temperature, max_tokens and prompt
+        are read from the cache instead of invoking the LLM again. Cache
+        hits and misses are written to the statistics. The default is ""
+        (no cache).
+    resume_dir : string, optional
+        Output directory of an interrupted experiment. The experiment is
+        continued in this directory and the essays already contained in its
+        journal (journal.jsonl) are not sent to the LLM again.
+        The default is "".
+    example_render_cache_file : string, optional
+        Path to a json file with formatted example essays (see
+        prompt_generation.precomputeExampleRenders). It is loaded before the
+        prompts are assembled if it exists and updated afterwards.
+        The default is "" (examples are formatted in memory only).
+    fit_examples_to_context : boolean, optional
+        If True, examples are dropped from the prompt of an essay until the
+        prompt and max_tokens fit into the context window (CONTEXT_SIZE of
+        the model_module). Otherwise, prompts exceeding the context window
+        are only logged. The default is False.
+    max_essays_per_request : int, optional
+        Max number of essays per request of the prompt_format "packed". Fewer
+        essays are packed if the prompt would exceed the context window or
+        the estimated output max_tokens. Essays whose output can not be
+        split apart are processed individually with the chat prompt.
+        The default is 8.
+    fuzzy_budget : dict, optional
+        Time and edit distance budget of matching the non-verbatim
+        discourse units with the keys "max_span_seconds",
+        "max_essay_seconds", "max_l_dist" and "fallback" ("anchor" or
+        "skip"), see utils.match_not_verbatim_du_within_budget. Budget hits
+        are written to the statistics. The default is None (no budget).
+    parse_workers : int, optional
+        Number of worker processes parsing the LLM outputs and matching the
+        discourse units while the LLM is invoked. The workers are started
+        with the spawn method, so the experiment must be started from
+        within an 'if __name__ == "__main__":' block. The default is 1
+        (parsing in the main process).
 
     Returns
     -------
@@ -81,9 +158,13 @@ def run_simple_argument_mining_experiment(
     exp_string = \
         f"{start_time_readable}_{model_abbrev}_{module_name}_{prompt_format}"
     full_output_dir = os.path.join(output_dir, exp_string)
+    if resume_dir:
+        full_output_dir = resume_dir
+        exp_string = os.path.basename(os.path.normpath(resume_dir))
 
     # Logging setup
-    log = utils.createLogger(full_output_dir)
+    log = utils.createLogger(full_output_dir,
+                             file_mode="a" if resume_dir else "w")
 
     # Print start_time
     start_time = time.time()
@@ -92,6 +173,7 @@ def run_simple_argument_mining_experiment(
 
     # Write parameters to log
     log.debug(f"fuzzysearch_factor: {fuzzysearch_factor}")
+    log.debug(f"fuzzy_budget: {fuzzy_budget}")
     log.debug(f"df_file: {df_file}")
     log.debug(f"slice_start: {slice_start}")
     log.debug(f"slice_end: {slice_end}")
@@ -99,6 +181,13 @@ def run_simple_argument_mining_experiment(
     log.debug(f"temperature: {temperature}")
     log.debug(f"prompt_module: {prompt_module.__file__}")
     log.debug(f"parser: {parser.__name__}")
+    log.debug(f"max_concurrency: {max_concurrency}")
+    log.debug(f"parse_workers: {parse_workers}")
+    log.debug(f"llm_cache_file: {llm_cache_file}")
+    log.debug(f"resume_dir: {resume_dir}")
+    log.debug(f"example_render_cache_file: {example_render_cache_file}")
+    log.debug(f"fit_examples_to_context: {fit_examples_to_context}")
+    log.debug(f"max_essays_per_request: {max_essays_per_request}")
 
     # LLM-inference
     # Read csv
@@ -133,9 +222,27 @@ def run_simple_argument_mining_experiment(
 
     model = model_module.get_llm(temperature=temperature,
                                  max_tokens=max_tokens)
+    context_size = getattr(model_module, "CONTEXT_SIZE", None)
+
+    # Shared scheduler for concurrent requests to the model
+    limiter = None
+    if max_concurrency > 1:
+        limiter = rate_limiter.get_rate_limiter(
+            getattr(model_module, "PROVIDER", model_module.__name__),
+            utils.get_model_params(model)["model_name"],
+            max_concurrency=max_concurrency,
+            **getattr(model_module, "RATE_LIMITS", {}))
+        limiter.set_max_concurrency(max_concurrency)
+
+    if example_render_cache_file and os.path.exists(
+            example_render_cache_file):
+        num_renders = prompt_generation.loadExampleRenderCache(
+            example_render_cache_file)
+        log.info(f"{num_renders} formatted example essays read from "
+                 f"{example_render_cache_file}")
 
     if create_batch_only and not batch_result_file:
-        utils.write_batch_file(
+        batch_files = utils.write_batch_file(
             df_essay=df_essay,
             df_du=df,
             prompt_var_func_dict=prompt_var_func_dict,
@@ -143,12 +250,24 @@ def run_simple_argument_mining_experiment(
             output_dir=full_output_dir,
             exp_string=exp_string,
             numOfEssaysPerBatchFile=numOfEssaysPerBatchFile,
+            maxBatchFileMB=maxBatchFileMB,
+            maxTokensPerBatchFile=maxTokensPerBatchFile,
+            compress=compressBatchFiles,
             prompt_module=prompt_module,
             model=model,
             prompt_format=prompt_format,
             example_df_file=example_df_file,
-            example_format_function=example_format_function)
-    else:
+            example_format_function=example_format_function,
+            context_size=context_size,
+            fit_examples_to_context=fit_examples_to_context)
+        if submit_batch:
+            batch_result_file = batch_api.run_batch_jobs(batch_files,
+                                                         full_output_dir)
+
+    if not create_batch_only or batch_result_file:
+        cache = None
+        if llm_cache_file and not batch_result_file:
+            cache = llm_cache.LLMResponseCache(llm_cache_file)
         result_df, statistics_df = utils.invoke_llm(
             df_essay=df_essay,
             df_du=df,
@@ -161,7 +280,18 @@ def run_simple_argument_mining_experiment(
             model=model,
             prompt_format=prompt_format,
             example_df_file=example_df_file,
-            example_format_function=example_format_function)
+            example_format_function=example_format_function,
+            context_size=context_size,
+            fit_examples_to_context=fit_examples_to_context,
+            max_essays_per_request=max_essays_per_request,
+            fuzzy_budget=fuzzy_budget,
+            parse_workers=parse_workers,
+            max_concurrency=max_concurrency,
+            rate_limiter=limiter,
+            llm_cache=cache,
+            resume=bool(resume_dir))
+        if cache is not None:
+            cache.close()
 
         # Evaluate results (get metrics)
         metrics_df = metrics.get_span_and_word_metrics(
@@ -171,7 +301,170 @@ def run_simple_argument_mining_experiment(
             statistics_df, metrics_df, output_dir, "results_overview.xlsx",
             exp_string)
 
+    if example_render_cache_file:
+        prompt_generation.saveExampleRenderCache(example_render_cache_file)
+
+    if limiter is not None:
+        log.info(f"Rate limit errors: {limiter.rate_limit_errors}, "
+                 f"final concurrency: {int(limiter.concurrency)}")
+
     # End Timing
     end_time = time.time()
     elapsed_time = end_time - start_time
     log.info(f'Total execution time: {elapsed_time:.2f} seconds')
+
+
+def rescore_experiment(experiment_dir, df_file, parser, fuzzysearch_factor=7,
+                       metrics_kwargs=None, slice_start=None, slice_end=None,
+                       rescore_name="", write_overview=True,
+                       fuzzy_budget=None, parse_workers=1):
+    """
+    Evaluate the raw LLM outputs of a previous experiment again with a
+    different parser, fuzzysearch_factor or metric configuration without
+    invoking the LLM.
+
+    Parameters
+    ----------
+    experiment_dir : string
+        Output directory of the previous experiment (containing
+        journal.jsonl or result_df.csv).
+    df_file : string
+        Path to data frame csv with all discourse units and essay
+        information (see run_simple_argument_mining_experiment).
+    parser : function
+        Parser function from utils according to prompt template format.
+    fuzzysearch_factor : int, optional
+        See run_simple_argument_mining_experiment. The default is 7.
+    metrics_kwargs : dict, optional
+        Additional keyword arguments for
+        metrics.get_span_and_word_metrics. The default is None.
+    slice_start : int, optional
+        Start index of slice of essays. Use the slice of the previous
+        experiment, all essays of the slice are scored and essays without
+        output count as unparsable. The default is None.
+    slice_end : int, optional
+        End index of slice of essays. The default is None.
+    rescore_name : string, optional
+        Name of the subdirectory of experiment_dir the results are written
+        to. By default it is built from the time, parser and
+        fuzzysearch_factor.
+    write_overview : boolean, optional
+        Write the metrics to results_overview.xlsx in the parent directory
+        of experiment_dir. The default is True.
+    fuzzy_budget : dict, optional
+        See run_simple_argument_mining_experiment. The default is None.
+    parse_workers : int, optional
+        Number of worker processes parsing the LLM outputs. Use it for a
+        single configuration, rescore_experiment_sweep already evaluates
+        the configurations in parallel. The default is 1.
+
+    Returns
+    -------
+    tuple
+        Name of the evaluation, statistics_df and metrics_df.
+    """
+    start_time_readable = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    if not rescore_name:
+        rescore_name = f"rescore_{start_time_readable}_{parser.__name__}_" \
+            f"ff{fuzzysearch_factor}"
+    full_output_dir = os.path.join(experiment_dir, rescore_name)
+    exp_string = \
+        f"{os.path.basename(os.path.normpath(experiment_dir))}_{rescore_name}"
+
+    # Logging setup
+    log = utils.createLogger(full_output_dir)
+    start_time = time.time()
+    log.info(f"\nRescoring {experiment_dir} as {rescore_name}")
+
+    # Write parameters to log
+    log.debug(f"experiment_dir: {experiment_dir}")
+    log.debug(f"fuzzysearch_factor: {fuzzysearch_factor}")
+    log.debug(f"fuzzy_budget: {fuzzy_budget}")
+    log.debug(f"df_file: {df_file}")
+    log.debug(f"slice_start: {slice_start}")
+    log.debug(f"slice_end: {slice_end}")
+    log.debug(f"parser: {parser.__name__}")
+    log.debug(f"metrics_kwargs: {metrics_kwargs}")
+    log.debug(f"parse_workers: {parse_workers}")
+
+    llm_output_dict = utils.read_llm_outputs(experiment_dir)
+
+    # Evaluate every essay of the slice, essays without an output of the
+    # previous experiment count as unparsable
+    df = pd.read_csv(df_file, index_col=0)
+    df_essay = df.drop_duplicates("essay_id")
+    df_essay = df_essay[slice_start:slice_end]
+    df = df[df["essay_id"].isin(df_essay.essay_id)]
+
+    result_df, statistics_df = utils.parse_llm_outputs(
+        df_essay=df_essay,
+        df_du=df,
+        llm_output_dict=llm_output_dict,
+        parser_func=parser,
+        fuzzysearch_factor=fuzzysearch_factor,
+        output_dir=full_output_dir,
+        fuzzy_budget=fuzzy_budget,
+        parse_workers=parse_workers)
+
+    metrics_df = metrics.get_span_and_word_metrics(
+        gt_df=df, result_df=result_df, output_dir=full_output_dir,
+        **(metrics_kwargs or {}))
+    if write_overview:
+        utils.write_metrics_statistics_to_excel_overview(
+            statistics_df, metrics_df,
+            os.path.dirname(os.path.normpath(experiment_dir)),
+            "results_overview.xlsx", exp_string)
+
+    log.info(f'Total execution time: {time.time() - start_time:.2f} seconds')
+    return exp_string, statistics_df, metrics_df
+
+
+def rescore_experiment_sweep(experiment_dir, df_file, config_list,
+                             max_workers=None):
+    """
+    Run rescore_experiment for several configurations in parallel in a
+    process pool. The overview excel file is written by the main process
+    after all configurations are evaluated.
+
+    On Windows, this function must be called from within an
+    'if __name__ == "__main__":' block.
+
+    Parameters
+    ----------
+    experiment_dir : string
+        Output directory of the previous experiment.
+    df_file : string
+        Path to data frame csv with the ground truth.
+    config_list : list of dict
+        Keyword arguments for rescore_experiment, e.g.,
+        {"parser": utils.parser_XML, "fuzzysearch_factor": 5}.
+    max_workers : int, optional
+        Number of worker processes. The default is the number of CPUs.
+
+    Returns
+    -------
+    list of DataFrame
+        metrics_df of every configuration in the order of config_list.
+    """
+    start_time_readable = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers) as executor:
+        futures = []
+        for i, config_dict in enumerate(config_list):
+            config_dict = dict(config_dict)
+            config_dict.setdefault(
+                "rescore_name",
+                f"rescore_{start_time_readable}_{i}_"
+                f"{config_dict['parser'].__name__}_"
+                f"ff{config_dict.get('fuzzysearch_factor', 7)}")
+            futures.append(executor.submit(
+                rescore_experiment, experiment_dir=experiment_dir,
+                df_file=df_file, write_overview=False, **config_dict))
+        results = [future.result() for future in futures]
+
+    for exp_string, statistics_df, metrics_df in results:
+        utils.write_metrics_statistics_to_excel_overview(
+            statistics_df, metrics_df,
+            os.path.dirname(os.path.normpath(experiment_dir)),
+            "results_overview.xlsx", exp_string)
+    return [metrics_df for _, _, metrics_df in results]
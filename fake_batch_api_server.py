@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+import email.parser
+import http.server
+import itertools
+import json
+import threading
+import time
+
+
+class FakeBatchAPIServer:
+    """
+    Minimal local stand-in for the file, batch and model list endpoints of
+    the OpenAI API to test the batch lifecycle (batch_api.run_batch_jobs)
+    and the model lookup of local servers offline. Use it with
+    OpenAI(base_url=server.base_url, api_key="fake").
+
+    A batch reports "validating" and "in_progress" on the first status
+    requests and is completed afterwards. The output of every task is
+    generated by the responder function.
+
+    Parameters
+    ----------
+    responder : function, optional
+        Returns the output for a task of the batch file. By default the last
+        message of the task is echoed.
+    fail_once : iterable, optional
+        custom_ids whose requests fail on the first submission (written to
+        the error file) and succeed when resubmitted.
+    polls_until_complete : int, optional
+        Status requests before a batch is completed. The default is 2.
+    models : iterable, optional
+        Ids of the models listed by the models endpoint. The default is
+        ("fake-model",).
+    """
+
+    def __init__(self, responder=None, fail_once=(), polls_until_complete=2,
+                 models=("fake-model",)):
+        self.responder = responder or \
+            (lambda task: task["body"]["messages"][-1]["content"])
+        self.fail_once = set(fail_once)
+        self.polls_until_complete = polls_until_complete
+        self.models = list(models)
+        self.files = {}
+        self.batches = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._server = http.server.ThreadingHTTPServer(
+            ("127.0.0.1", 0), self._handler_class())
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _new_id(self, prefix):
+        with self._lock:
+            return f"{prefix}-{next(self._ids)}"
+
+    def _add_file(self, filename, content, purpose):
+        file_id = self._new_id("file")
+        self.files[file_id] = {
+            "id": file_id, "object": "file", "bytes": len(content),
+            "created_at": int(time.time()), "filename": filename,
+            "purpose": purpose, "status": "processed", "content": content}
+        return self.files[file_id]
+
+    def _create_batch(self, request):
+        batch_id = self._new_id("batch")
+        self.batches[batch_id] = {
+            "id": batch_id, "object": "batch",
+            "endpoint": request["endpoint"],
+            "input_file_id": request["input_file_id"],
+            "completion_window": request["completion_window"],
+            "created_at": int(time.time()), "status": "validating",
+            "metadata": request.get("metadata"), "polls": 0,
+            "output_file_id": None, "error_file_id": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0}}
+        return self.batches[batch_id]
+
+    def _retrieve_batch(self, batch_id):
+        batch = self.batches[batch_id]
+        batch["polls"] += 1
+        if batch["status"] == "validating":
+            batch["status"] = "in_progress"
+        if batch["status"] == "in_progress" \
+                and batch["polls"] >= self.polls_until_complete:
+            self._complete_batch(batch)
+        return batch
+
+    def _complete_batch(self, batch):
+        input_file = self.files[batch["input_file_id"]]
+        output_lines = []
+        error_lines = []
+        for line in input_file["content"].decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            task = json.loads(line)
+            result = {"id": self._new_id("batch_req"),
+                      "custom_id": task["custom_id"]}
+            with self._lock:
+                fail = task["custom_id"] in self.fail_once
+                self.fail_once.discard(task["custom_id"])
+            if fail:
+                result["response"] = None
+                result["error"] = {"code": "server_error",
+                                   "message": "Simulated failure"}
+                error_lines.append(json.dumps(result))
+                continue
+            result["error"] = None
+            result["response"] = {
+                "status_code": 200, "request_id": result["id"],
+                "body": {
+                    "object": "chat.completion",
+                    "model": task["body"]["model"],
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {
+                                     "role": "assistant",
+                                     "content": self.responder(task)}}]}}
+            output_lines.append(json.dumps(result))
+        batch["request_counts"] = {
+            "total": len(output_lines) + len(error_lines),
+            "completed": len(output_lines), "failed": len(error_lines)}
+        if output_lines:
+            batch["output_file_id"] = self._add_file(
+                "output.jsonl", ("\n".join(output_lines) + "\n").encode(),
+                "batch_output")["id"]
+        if error_lines:
+            batch["error_file_id"] = self._add_file(
+                "errors.jsonl", ("\n".join(error_lines) + "\n").encode(),
+                "batch_output")["id"]
+        batch["status"] = "completed"
+        batch["completed_at"] = int(time.time())
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, obj, status=200):
+                obj = {key: value for key, value in obj.items()
+                       if key not in ("content", "polls")}
+                body = json.dumps(obj).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _send_not_found(self):
+                self._send_json({"error": {"message": "Not found"}}, 404)
+
+            def _read_body(self):
+                return self.rfile.read(
+                    int(self.headers.get("Content-Length", 0)))
+
+            def do_POST(self):
+                body = self._read_body()
+                if self.path == "/v1/files":
+                    # Parse the multipart/form-data upload
+                    message = email.parser.BytesParser().parsebytes(
+                        b"Content-Type: " + self.headers[
+                            "Content-Type"].encode() + b"\r\n\r\n" + body)
+                    fields = {}
+                    for part in message.get_payload():
+                        fields[part.get_param("name", header=(
+                            "content-disposition"))] = part
+                    file_part = fields["file"]
+                    self._send_json(server._add_file(
+                        file_part.get_filename(),
+                        file_part.get_payload(decode=True),
+                        fields["purpose"].get_payload(decode=True).decode()))
+                elif self.path == "/v1/batches":
+                    self._send_json(server._create_batch(json.loads(body)))
+                else:
+                    self._send_not_found()
+
+            def do_GET(self):
+                parts = self.path.strip("/").split("/")
+                if parts == ["v1", "models"]:
+                    self._send_json({"object": "list", "data": [
+                        {"id": model_id, "object": "model", "created": 0,
+                         "owned_by": "fake"} for model_id in server.models]})
+                elif parts[:2] == ["v1", "batches"] and len(parts) == 3 \
+                        and parts[2] in server.batches:
+                    self._send_json(server._retrieve_batch(parts[2]))
+                elif parts[:2] == ["v1", "files"] and len(parts) == 4 \
+                        and parts[3] == "content" \
+                        and parts[2] in server.files:
+                    content = server.files[parts[2]]["content"]
+                    self.send_response(200)
+                    self.send_header("Content-Type",
+                                     "application/octet-stream")
+                    self.send_header("Content-Length", str(len(content)))
+                    self.end_headers()
+                    self.wfile.write(content)
+                else:
+                    self._send_not_found()
+
+        return Handler
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+
+log = logging.getLogger('main_logger')
+
+
+class LLMResponseCache:
+    """
+    Persistent cache of LLM outputs in an SQLite database.
+
+    The entries are addressed by a hash of the model name, temperature,
+    max_tokens and the fully rendered prompt messages, so any change of the
+    prompt or the model parameters results in a cache miss. Entries older
+    than max_age_days and the least recently used entries exceeding
+    max_size_mb are evicted when the cache is opened.
+
+    Parameters
+    ----------
+    path : str
+        Path to the SQLite database file. It is created if it does not exist.
+    max_age_days : float, optional
+        Entries created more than max_age_days ago are removed.
+        None keeps entries forever. The default is 90.
+    max_size_mb : float, optional
+        Max size of the cached outputs in MB. None means no limit.
+        The default is 1024.
+    """
+
+    def __init__(self, path, max_age_days=90, max_size_mb=1024):
+        self.path = path
+        self.max_age_days = max_age_days
+        self.max_size_mb = max_size_mb
+        self.hits = 0
+        self.misses = 0
+        if os.path.dirname(path) and not os.path.exists(
+                os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model_name TEXT, output TEXT, "
+            "response_metadata TEXT, size INTEGER, created REAL, "
+            "last_access REAL)")
+        self.connection.commit()
+        self.evict()
+
+    @staticmethod
+    def make_key(model_params, messages):
+        """
+        Build the cache key of a request.
+
+        Parameters
+        ----------
+        model_params : dict
+            Dict with model_name, temperature and max_tokens
+            (see utils.get_model_params).
+        messages : list
+            Rendered langchain messages of the prompt.
+
+        Returns
+        -------
+        str
+            SHA-256 hex digest of the request.
+        """
+        request = {
+            "model_name": model_params["model_name"],
+            "temperature": model_params["temperature"],
+            "max_tokens": model_params["max_tokens"],
+            "messages": [[message.type, message.content]
+                         for message in messages],
+            }
+        return hashlib.sha256(
+            json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """
+        Return the cached output for the key or None on a cache miss.
+        """
+        row = self.connection.execute(
+            "SELECT output FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.connection.execute(
+            "UPDATE responses SET last_access = ? WHERE key = ?",
+            (time.time(), key))
+        self.connection.commit()
+        return row[0]
+
+    def put(self, key, output, model_name=None, response_metadata=None):
+        """
+        Store the output of a request.
+        """
+        now = time.time()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (key, model_name, output,
+             json.dumps(response_metadata, default=str),
+             len(output.encode("utf-8")), now, now))
+        self.connection.commit()
+
+    def evict(self):
+        """
+        Remove entries that are too old and the least recently used entries
+        if the cache is too large.
+        """
+        if self.max_age_days is not None:
+            self.connection.execute(
+                "DELETE FROM responses WHERE created < ?",
+                (time.time() - self.max_age_days * 24 * 60 * 60,))
+        if self.max_size_mb is not None:
+            self.connection.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM (SELECT key, SUM(size) OVER ("
+                "ORDER BY last_access DESC) AS total_size FROM responses) "
+                "WHERE total_size > ?)",
+                (self.max_size_mb * 1024 * 1024,))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
@@ -33,6 +33,272 @@ def score_feedback_comp_micro(pred_df, gt_df):
     A function that scores for the kaggle
         Student Writing Competition
 
+    Uses the steps in the evaluation page here:
+        https://www.kaggle.com/c/feedback-prize-2021/overview/evaluation
+
+    The overlaps are computed with array operations on the word index
+    intervals of the prediction strings (see calc_overlaps). The result is
+    identical to score_feedback_comp_micro_reference.
+    """
+    # Step 1. all ground truths and predictions for a given class are compared.
+    joined = _join_predictions(pred_df, gt_df, ["predictionstring"])
+    joined["predictionstring_gt"] = joined["predictionstring_gt"].fillna(" ")
+    joined["predictionstring_pred"] = joined[
+        "predictionstring_pred"].fillna(" ")
+
+    overlap1, overlap2 = calc_overlaps(
+        joined["predictionstring_pred"], joined["predictionstring_gt"])
+    return _micro_f1_score(joined, overlap1, overlap2,
+                           ["essay_id", "predictionstring_gt"])
+
+
+def score_feedback_comp_micro_intervals(pred_df, gt_df):
+    """
+    score_feedback_comp_micro for discourse units given by their word index
+    intervals (word_start, word_end, see utils.add_word_interval) instead
+    of prediction strings. The overlaps are computed arithmetically. An
+    empty interval counts like the empty prediction string, so the result
+    is identical to score_feedback_comp_micro.
+    """
+    joined = _join_predictions(pred_df, gt_df, ["word_start", "word_end"])
+    start_pred = joined["word_start_pred"].to_numpy(dtype=float)
+    end_pred = joined["word_end_pred"].to_numpy(dtype=float)
+    start_gt = joined["word_start_gt"].to_numpy(dtype=float)
+    end_gt = joined["word_end_gt"].to_numpy(dtype=float)
+    # Missing (outer join) and empty intervals are the prediction string
+    # " " or "", i.e., one empty word
+    empty_pred = ~(end_pred - start_pred > 0)
+    empty_gt = ~(end_gt - start_gt > 0)
+    inter = np.where(
+        empty_pred | empty_gt, (empty_pred & empty_gt).astype(float),
+        np.clip(np.fmin(end_pred, end_gt) - np.fmax(start_pred, start_gt),
+                0, None))
+    len_pred = np.where(empty_pred, 1, end_pred - start_pred)
+    len_gt = np.where(empty_gt, 1, end_gt - start_gt)
+
+    # Ground truths with the same prediction string are grouped: empty
+    # intervals share one key and missing ground truths another one
+    missing_gt = np.isnan(start_gt)
+    for column, values in [("gt_key_start", start_gt),
+                           ("gt_key_end", end_gt)]:
+        joined[column] = np.where(
+            missing_gt, -2, np.where(empty_gt, -1, values)).astype(np.int64)
+    return _micro_f1_score(joined, inter / len_gt, inter / len_pred,
+                           ["essay_id", "gt_key_start", "gt_key_end"])
+
+
+def _join_predictions(pred_df, gt_df, columns):
+    """
+    Outer join of all predictions and ground truths of the same essay and
+    class with the ids pred_id and gt_id.
+    """
+    gt_df = (
+        gt_df[["essay_id", "discourse_type"] + columns]
+        .reset_index(drop=True)
+        .copy()
+    )
+    pred_df = pred_df[
+        ["essay_id", "discourse_type"] + columns].reset_index(
+        drop=True).copy()
+    pred_df["pred_id"] = pred_df.index
+    gt_df["gt_id"] = gt_df.index
+    return pred_df.merge(
+        gt_df,
+        left_on=["essay_id", "discourse_type"],
+        right_on=["essay_id", "discourse_type"],
+        how="outer",
+        suffixes=("_pred", "_gt"),
+    )
+
+
+def _micro_f1_score(joined, overlap1, overlap2, gt_key_columns):
+    """
+    Match the predictions and ground truths of the joined data frame (see
+    _join_predictions) by their overlaps and return the micro F1 score.
+    """
+    # 2. If the overlap between the ground truth and prediction is >= 0.5,
+    # and the overlap between the prediction and the ground truth >= 0.5,
+    # the prediction is a match and considered a true positive.
+    # If multiple matches exist, the match with the highest pair of overlaps
+    # is taken.
+    joined["overlap1"] = overlap1
+    joined["overlap2"] = overlap2
+    joined["potential_TP"] = (
+        joined["overlap1"] >= 0.5) & (joined["overlap2"] >= 0.5)
+    joined["max_overlap"] = joined[["overlap1", "overlap2"]].max(axis=1)
+    tp_pred_ids = (
+        joined.query("potential_TP")
+        .sort_values("max_overlap", ascending=False)
+        .groupby(gt_key_columns)
+        .first()["pred_id"]
+        .values
+    )
+
+    # 3. Any unmatched ground truths are false negatives
+    # and any unmatched predictions are false positives.
+    # Like the "not in" of the reference, isin never matches NaN ids of the
+    # outer join, which count as one FP and one FN.
+    fp_pred_ids = joined["pred_id"].unique()
+    fp_pred_ids = fp_pred_ids[~np.isin(fp_pred_ids, tp_pred_ids)]
+
+    matched_gt_ids = joined.query("potential_TP")["gt_id"].unique()
+    unmatched_gt_ids = joined["gt_id"].unique()
+    unmatched_gt_ids = unmatched_gt_ids[
+        ~np.isin(unmatched_gt_ids, matched_gt_ids)]
+
+    # Get numbers of each type
+    TP = len(tp_pred_ids)
+    FP = len(fp_pred_ids)
+    FN = len(unmatched_gt_ids)
+    # calc microf1
+    my_f1_score = TP / (TP + 0.5 * (FP + FN))
+    return my_f1_score
+
+
+def score_feedback_comp_words_micro(pred_df, gt_df):
+    """
+    Micro F1 score of score_feedback_comp_micro for the word-based
+    prediction strings of utils.build_predictionstring_df_word (one row per
+    word), computed from the word index intervals (word_start, word_end) of
+    the discourse units of one class without one row per word.
+
+    A ground truth word is a true positive if a prediction of the essay
+    contains it, every other predicted word is a false positive. Like in
+    score_feedback_comp_micro, one more FP (FN) is counted if an essay has
+    ground truth (predicted) words but no predicted (ground truth) words.
+    """
+    pred_df = pred_df[pred_df["word_end"] > pred_df["word_start"]]
+    gt_df = gt_df[gt_df["word_end"] > gt_df["word_start"]]
+    essay_codes, essay_ids = pd.factorize(
+        pd.concat([pred_df["essay_id"], gt_df["essay_id"]]))
+    pred_essays = essay_codes[:len(pred_df)]
+    gt_essays = essay_codes[len(pred_df):]
+    # Word indices of all essays on one axis
+    essay_offset = 1 + max(pred_df["word_end"].max() if len(pred_df) else 0,
+                           gt_df["word_end"].max() if len(gt_df) else 0)
+    pred_starts = pred_essays * essay_offset \
+        + pred_df["word_start"].to_numpy(dtype=np.int64)
+    pred_ends = pred_essays * essay_offset \
+        + pred_df["word_end"].to_numpy(dtype=np.int64)
+    gt_starts = gt_essays * essay_offset \
+        + gt_df["word_start"].to_numpy(dtype=np.int64)
+    gt_ends = gt_essays * essay_offset \
+        + gt_df["word_end"].to_numpy(dtype=np.int64)
+
+    predicted_words = _merge_intervals(pred_starts, pred_ends)
+    gt_words = _merge_intervals(gt_starts, gt_ends)
+    TP = _covered_words(*predicted_words, *gt_words).sum()
+    FP = (pred_ends - pred_starts).sum() - TP \
+        + np.any(~np.isin(gt_essays, pred_essays))
+    FN = (gt_ends - gt_starts).sum() \
+        - _covered_words(*predicted_words, gt_starts, gt_ends).sum() \
+        + np.any(~np.isin(pred_essays, gt_essays))
+    return TP / (TP + 0.5 * (FP + FN))
+
+
+def _merge_intervals(starts, ends):
+    """
+    Merge overlapping intervals [start, end).
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        Starts and ends of the sorted, disjoint intervals.
+    """
+    order = np.argsort(starts, kind="stable")
+    starts = starts[order]
+    running_ends = np.maximum.accumulate(ends[order]) if len(order) \
+        else ends
+    first = np.ones(len(starts), dtype=bool)
+    first[1:] = starts[1:] > running_ends[:-1]
+    last = np.ones(len(starts), dtype=bool)
+    last[:-1] = first[1:]
+    return starts[first], running_ends[last]
+
+
+def _covered_words(union_starts, union_ends, starts, ends):
+    """
+    Number of words of every interval [start, end) in the union of the
+    sorted, disjoint intervals [union_start, union_end).
+    """
+    covered_before = np.concatenate(
+        [[0], np.cumsum(union_ends - union_starts)])
+
+    def covered_below(positions):
+        # Intervals of the union starting before or at the positions
+        i = np.searchsorted(union_starts, positions, side="right")
+        previous = np.maximum(i - 1, 0)
+        partial = np.clip(np.minimum(positions, union_ends[previous])
+                          - union_starts[previous], 0, None) \
+            if len(union_starts) else np.zeros(len(positions), dtype=np.int64)
+        return np.where(i > 0, covered_before[previous] + partial, 0)
+
+    return covered_below(ends) - covered_below(starts)
+
+
+def calc_overlaps(predictionstrings_pred, predictionstrings_gt):
+    """
+    Vectorised calc_overlap for all rows of two columns of prediction
+    strings. Prediction strings that are a contiguous range of word indices
+    are compared as intervals; the others (e.g., the empty " " of the outer
+    join) with the sets of calc_overlap.
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        Overlap of every row relative to the ground truth and relative to
+        the prediction.
+    """
+    predictionstrings_pred = predictionstrings_pred.to_numpy()
+    predictionstrings_gt = predictionstrings_gt.to_numpy()
+    intervals = {predictionstring: _parse_word_interval(predictionstring)
+                 for predictionstring in set(predictionstrings_pred)
+                 | set(predictionstrings_gt)}
+    pred = np.array([intervals[predictionstring]
+                     for predictionstring in predictionstrings_pred],
+                    dtype=np.int64).reshape(-1, 3)
+    gt = np.array([intervals[predictionstring]
+                   for predictionstring in predictionstrings_gt],
+                  dtype=np.int64).reshape(-1, 3)
+    # Columns: first word, last word, number of distinct words (0 if the
+    # prediction string is no contiguous range)
+    inter = np.clip(np.minimum(pred[:, 1], gt[:, 1])
+                    - np.maximum(pred[:, 0], gt[:, 0]) + 1, 0, None)
+    len_pred = pred[:, 2].astype(float)
+    len_gt = gt[:, 2].astype(float)
+    for i in np.flatnonzero((pred[:, 2] == 0) | (gt[:, 2] == 0)):
+        set_pred = set(predictionstrings_pred[i].split(" "))
+        set_gt = set(predictionstrings_gt[i].split(" "))
+        inter[i] = len(set_gt.intersection(set_pred))
+        len_pred[i] = len(set_pred)
+        len_gt[i] = len(set_gt)
+    return inter / len_gt, inter / len_pred
+
+
+def _parse_word_interval(predictionstring):
+    """
+    Return the first and last word index and the number of words of a
+    prediction string with a contiguous range of word indices or
+    (0, -1, 0).
+    """
+    words = set(predictionstring.split(" "))
+    try:
+        first = min(int(word) for word in words)
+    except ValueError:
+        return 0, -1, 0
+    last = first + len(words) - 1
+    # Every word must be the string of an index of the range
+    if words != set(map(str, range(first, last + 1))):
+        return 0, -1, 0
+    return first, last, len(words)
+
+
+def score_feedback_comp_micro_reference(pred_df, gt_df):
+    """
+    A function that scores for the kaggle
+        Student Writing Competition
+    Row-wise reference implementation of score_feedback_comp_micro.
+
     Uses the steps in the evaluation page here:
         https://www.kaggle.com/c/feedback-prize-2021/overview/evaluation
     """
@@ -98,9 +364,39 @@ def score_feedback_comp_micro(pred_df, gt_df):
 
 
 def score_feedback_comp(pred_df, gt_df, return_class_scores=False):
+    return _score_classes(pred_df, gt_df, ["predictionstring"],
+                          score_feedback_comp_micro, return_class_scores)
+
+
+def score_feedback_comp_intervals(pred_df, gt_df, return_class_scores=False):
+    """
+    score_feedback_comp for discourse units given by their word index
+    intervals (see score_feedback_comp_micro_intervals).
+    """
+    return _score_classes(pred_df, gt_df, ["word_start", "word_end"],
+                          score_feedback_comp_micro_intervals,
+                          return_class_scores)
+
+
+def score_feedback_comp_words(pred_df, gt_df, return_class_scores=False):
+    """
+    Word-based score_feedback_comp from the word index intervals of the
+    discourse units (see score_feedback_comp_words_micro). Like the one row
+    per word of utils.build_predictionstring_df_word, discourse units
+    without words are left out.
+    """
+    return _score_classes(pred_df, gt_df[gt_df["word_end"]
+                                         > gt_df["word_start"]],
+                          ["word_start", "word_end"],
+                          score_feedback_comp_words_micro,
+                          return_class_scores)
+
+
+def _score_classes(pred_df, gt_df, columns, micro_score_function,
+                   return_class_scores):
     class_scores = {}
     pred_df = pred_df[[
-        "essay_id", "discourse_type", "predictionstring"]].reset_index(
+        "essay_id", "discourse_type"] + columns].reset_index(
         drop=True).copy()
     for discourse_type, gt_subset in gt_df.groupby("discourse_type"):
         pred_subset = (
@@ -108,7 +404,7 @@ def score_feedback_comp(pred_df, gt_df, return_class_scores=False):
             .reset_index(drop=True)
             .copy()
         )
-        class_score = score_feedback_comp_micro(pred_subset, gt_subset)
+        class_score = micro_score_function(pred_subset, gt_subset)
         class_scores[discourse_type] = class_score
     f1 = np.mean([v for v in class_scores.values()])
     if return_class_scores:
@@ -116,10 +412,63 @@ def score_feedback_comp(pred_df, gt_df, return_class_scores=False):
     return f1
 
 
-def get_span_and_word_metrics(gt_df, result_df, output_dir=""):
+def get_span_and_word_metrics(gt_df, result_df, output_dir="",
+                              essay_df=None, engine="interval"):
+    """
+    Calculate the span-based and word-based F1 scores of the discourse units
+    in result_df.
+
+    Parameters
+    ----------
+    gt_df : DataFrame
+        Ground truth discourse units with full_text_clean.
+    result_df : DataFrame
+        Parsed discourse units (see utils.RESULT_COLUMNS).
+    output_dir : str, optional
+        Directory to write metrics_df.csv to.
+    essay_df : DataFrame, optional
+        Essay texts (original_essay_text) by essay_id, if result_df has
+        none. The default is the full_text_clean of gt_df.
+    engine : str, optional
+        "interval" compares the word index intervals of the discourse units
+        arithmetically. "string" builds the prediction strings of the Kaggle
+        competition, e.g., to cross-check the results. The default is
+        "interval".
+
+    Returns
+    -------
+    DataFrame
+        metrics_df with the F1 scores.
+    """
+    if engine not in ("interval", "string"):
+        raise ValueError(f"Unknown metrics engine: {engine}")
     if len(result_df) == 0:
         return log.warning("Result data frame is empty. Results cannot be "
                            "evaluated.")
+    if "original_essay_text" not in result_df.columns:
+        # The essay texts are kept once per essay (essay_df with
+        # original_essay_text, by default the full_text_clean of gt_df)
+        if essay_df is None:
+            essay_texts = gt_df.drop_duplicates("essay_id").set_index(
+                "essay_id")["full_text_clean"]
+        else:
+            essay_texts = essay_df.set_index("essay_id")[
+                "original_essay_text"]
+        result_df = result_df.assign(
+            original_essay_text=result_df["essay_id"].map(essay_texts))
+    if engine == "interval":
+        prediction_df = utils.add_word_interval(
+            result_df, "original_essay_text", "discourse_start",
+            "discourse_end")
+        prediction_gt_df = utils.add_word_interval(
+            gt_df, "full_text_clean", "discourse_start", "discourse_end")
+        f1_span, class_scores_span = score_feedback_comp_intervals(
+            prediction_df, prediction_gt_df, return_class_scores=True)
+        f1_word, class_scores_word = score_feedback_comp_words(
+            prediction_df, prediction_gt_df, return_class_scores=True)
+        return _build_metrics_df(f1_span, class_scores_span, f1_word,
+                                 class_scores_word, output_dir)
+
     # Span-based metrics
     prediction_df_span = utils.add_predictionstring_span(
         result_df, "original_essay_text", "discourse_start", "discourse_end")
@@ -127,8 +476,6 @@ def get_span_and_word_metrics(gt_df, result_df, output_dir=""):
         gt_df, "full_text_clean", "discourse_start", "discourse_end")
     f1_span, class_scores_span = score_feedback_comp(
         prediction_df_span, prediction_gt_df_span, return_class_scores=True)
-    all_scores_span = class_scores_span.copy()
-    all_scores_span["All"] = f1_span
     # Word-based metrics
     prediction_df_word = utils.build_predictionstring_df_word(
         result_df, "original_essay_text", "discourse_start", "discourse_end",
@@ -138,6 +485,14 @@ def get_span_and_word_metrics(gt_df, result_df, output_dir=""):
         "essay_id", "discourse_type")
     f1_word, class_scores_word = score_feedback_comp(
         prediction_df_word, prediction_gt_df_word, return_class_scores=True)
+    return _build_metrics_df(f1_span, class_scores_span, f1_word,
+                             class_scores_word, output_dir)
+
+
+def _build_metrics_df(f1_span, class_scores_span, f1_word, class_scores_word,
+                      output_dir):
+    all_scores_span = class_scores_span.copy()
+    all_scores_span["All"] = f1_span
     all_scores_word = class_scores_word.copy()
     all_scores_word["All"] = f1_word
 
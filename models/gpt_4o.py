@@ -1,6 +1,12 @@
 import os
 from langchain_openai import ChatOpenAI
 
+# Provider and rate limits (OpenAI usage tier 1) used by the rate limiter
+PROVIDER = "openai"
+RATE_LIMITS = {"rpm": 500, "tpm": 30000}
+# Context window in tokens (prompt and output)
+CONTEXT_SIZE = 128000
+
 
 def get_llm(temperature=0, max_tokens=3000):
     model = ChatOpenAI(
@@ -1,13 +1,36 @@
 from langchain_openai import ChatOpenAI
 
+# Local server without rate limits, only the concurrency is adapted
+PROVIDER = "lm_studio"
+RATE_LIMITS = {}
+# Context window depends on the model loaded in LM Studio
+CONTEXT_SIZE = None
+BASE_URL = "http://localhost:1234/v1"
+# Id of the model loaded in LM Studio. None uses the first model served by
+# LM Studio. The id is part of the LLM cache key, so the outputs of
+# different models are cached separately.
+MODEL_NAME = None
+
+
+def get_served_model_id(base_url=BASE_URL):
+    """
+    Return the id of the first model served by LM Studio.
+    """
+    from openai import OpenAI
+    models = OpenAI(base_url=base_url, api_key="lm-studio").models.list()
+    if not models.data:
+        raise ValueError(f"No model is loaded in LM Studio ({base_url}).")
+    return models.data[0].id
+
 
 def get_llm(temperature=0, max_tokens=3000):
     # Point to the local server
     # return OpenAI(base_url="http://localhost:1234/v1", api_key="lm-studio")
 
     model = ChatOpenAI(
+        model=MODEL_NAME or get_served_model_id(BASE_URL),
         openai_api_key="lm-studio",
-        base_url="http://localhost:1234/v1",
+        base_url=BASE_URL,
         temperature=temperature,
         max_tokens=max_tokens)
     return model
@@ -1,6 +1,12 @@
 import os
 from langchain_mistralai.chat_models import ChatMistralAI
 
+# Provider and rate limits (Mistral free tier) used by the rate limiter
+PROVIDER = "mistral"
+RATE_LIMITS = {"rpm": 60, "tpm": 500000}
+# Context window in tokens (prompt and output)
+CONTEXT_SIZE = 32768
+
 
 def get_llm(temperature=0, max_tokens=3000):
     model = ChatMistralAI(mistral_api_key=os.environ['MISTRAL_API_KEY'],
@@ -1,5 +1,11 @@
 from langchain_community.chat_models import ChatOllama
 
+# Local server without rate limits, only the concurrency is adapted
+PROVIDER = "ollama"
+RATE_LIMITS = {}
+# Context window in tokens (prompt and output)
+CONTEXT_SIZE = 8192
+
 
 def get_llm(temperature=0, max_tokens=3000):
     model = ChatOllama(model="llama3:8b",
@@ -1,5 +1,11 @@
 from langchain_community.chat_models import ChatOllama
 
+# Local server without rate limits, only the concurrency is adapted
+PROVIDER = "ollama"
+RATE_LIMITS = {}
+# Context window in tokens (prompt and output)
+CONTEXT_SIZE = 4096
+
 
 def get_llm(temperature=0, max_tokens=3000):
     model = ChatOllama(model="phi3:3.8b-mini-instruct-4k-q4_K_M",
@@ -1,8 +1,27 @@
 # -*- coding: utf-8 -*-
+import concurrent.futures
+import hashlib
+import json
+import logging
+import weakref
 import pandas as pd
-from langchain_core.prompts import (PromptTemplate, ChatPromptTemplate)
+from argument_mining_persuade import tokens
 from argument_mining_persuade.rag import similar_essay_retriever as retriever
 
+log = logging.getLogger('main_logger')
+
+# langchain is imported in the functions that build the prompt templates to
+# keep importing this module (and utils) fast
+
+# First line of every essay of a packed prompt and of its output section
+PACKED_ESSAY_HEADER = "### Essay {essay_id}"
+PACKED_ESSAY_INSTRUCTION = (
+    "\n\nThe next message contains several essays. Every essay starts with "
+    "the line \"### Essay <id>\". Process every essay separately and answer "
+    "with one section per essay in the same order. Every section starts "
+    "with the line \"### Essay <id>\" of its essay followed by the output "
+    "for this essay.")
+
 
 def assembleChatPrompt(preamble, essay_text, example_df_file="",
                        pre_essay="Essay:", pre_demo="Output:", suffix="",
@@ -11,11 +30,8 @@ def assembleChatPrompt(preamble, essay_text, example_df_file="",
     # System prompt with basic instructions
     messages.append(("system", preamble))
     # Append 'fake' conversation showing examples
-    if example_df_file:
-        if type(example_df_file) is str:
-            df = pd.read_csv(example_df_file, index_col=0)
-        elif type(example_df_file) is int:
-            df = retriever.retrieve_similar_essays(essay_text, example_df_file)
+    df = loadExampleDf(example_df_file, essay_text)
+    if df is not None:
         for essay_id in df.essay_id.unique():
             # example essay text
             text = df[df["essay_id"] == essay_id].iloc[0].full_text_clean
@@ -24,11 +40,12 @@ def assembleChatPrompt(preamble, essay_text, example_df_file="",
             messages.append(
                 ("human", f"{temp_pre_essay}\n\"\"\"\n{text}\n\"\"\""))
             # 'fake' AI answer with formated essay only
-            du = df[df["essay_id"] == essay_id]
-            messages.append(("ai", example_format_function(du, "", "")))
+            messages.append(("ai", formatExampleEssayCached(
+                df, essay_id, example_format_function, "", "")))
     # Actual essay to classify
     messages.append(("human", pre_essay + "\n\"\"\"\n{essay}\n\"\"\""))
 
+    from langchain_core.prompts import ChatPromptTemplate
     prompt = ChatPromptTemplate.from_messages(messages)
     return prompt
 
@@ -36,21 +53,18 @@ def assembleChatPrompt(preamble, essay_text, example_df_file="",
 def assembleSimplePrompt(preamble, essay_text, example_df_file="",
                          pre_essay="Essay:", pre_demo="Output:", suffix="",
                          example_format_function=None):
+    from langchain_core.prompts import PromptTemplate
     prompt = PromptTemplate.from_template(preamble)
     prompt += "\n\n"
     # Format and add example
-    if example_df_file:
-        if type(example_df_file) is str:
-            example_df = pd.read_csv(example_df_file, index_col=0)
-        elif type(example_df_file) is int:
-            example_df = retriever.retrieve_similar_essays(essay_text,
-                                                           example_df_file)
+    example_df = loadExampleDf(example_df_file, essay_text)
+    if example_df is not None:
         for essay_id in example_df.essay_id.unique():
             # Fill in any placeholder if there are any
             temp_pre_essay = formatPreEssayString(example_df, essay_id,
                                                   pre_essay)
-            prompt += example_format_function(
-                example_df[example_df["essay_id"] == essay_id],
+            prompt += formatExampleEssayCached(
+                example_df, essay_id, example_format_function,
                 pre_essay=temp_pre_essay, pre_demo=pre_demo)
             prompt += "\n\n"
     prompt += pre_essay
@@ -69,9 +83,8 @@ def assembleCoTPrompt(preamble, essay_text, example_df_file="",
     messages = []
     # System prompt with basic instructions
     messages.append(("system", preamble))
-    if example_df_file:
-        if type(example_df_file) is str:
-            df = pd.read_csv(example_df_file, index_col=0)
+    df = loadExampleDf(example_df_file, essay_text)
+    if df is not None:
         for essay_id in df.essay_id.unique():
             # example essay text
             text = df[df["essay_id"] == essay_id].iloc[0].full_text_clean
@@ -85,14 +98,459 @@ def assembleCoTPrompt(preamble, essay_text, example_df_file="",
     # Actual essay to classify
     messages.append(("human", pre_essay + "\n\"\"\"\n{essay}\n\"\"\""))
 
+    from langchain_core.prompts import ChatPromptTemplate
     prompt = ChatPromptTemplate.from_messages(messages)
     return prompt
 
 
+def assemblePackedChatPrompt(preamble, essay_text, example_df_file="",
+                             pre_essay="Essay:", pre_demo="Output:",
+                             suffix="", example_format_function=None):
+    """
+    Chat prompt for several essays per request. The examples are shown as
+    one packed request and answer. The {essay} placeholder takes the essays
+    formatted with formatPackedEssays.
+    """
+    messages = []
+    # System prompt with basic instructions and the packing format
+    messages.append(("system", preamble + PACKED_ESSAY_INSTRUCTION))
+    df = loadExampleDf(example_df_file, essay_text)
+    if df is not None and len(df) > 0:
+        messages.append(("human", formatPackedEssays(
+            df.drop_duplicates("essay_id"), pre_essay)))
+        # 'fake' AI answer with one section per formated essay
+        messages.append(("ai", "\n\n".join(
+            PACKED_ESSAY_HEADER.format(essay_id=essay_id) + "\n"
+            + formatExampleEssayCached(df, essay_id, example_format_function,
+                                       "", "")
+            for essay_id in df.essay_id.unique())))
+    # Actual essays to classify
+    messages.append(("human", "{essay}"))
+
+    from langchain_core.prompts import ChatPromptTemplate
+    prompt = ChatPromptTemplate.from_messages(messages)
+    return prompt
+
+
+def formatPackedEssays(df_essay, pre_essay):
+    """
+    Returns the essays of df_essay (one row per essay), each starting with
+    PACKED_ESSAY_HEADER and its pre_essay string.
+    """
+    blocks = []
+    for essay_id, text, assignment, prompt_name, task in zip(
+            df_essay.essay_id, df_essay.full_text_clean, df_essay.assignment,
+            df_essay.prompt_name, df_essay.task):
+        # Fill in any placeholder if there are any
+        temp_pre_essay = pre_essay.format(assignment=assignment,
+                                          prompt_name=prompt_name, task=task)
+        blocks.append(f"{PACKED_ESSAY_HEADER.format(essay_id=essay_id)}\n"
+                      f"{temp_pre_essay}\n\"\"\"\n{text}\n\"\"\"")
+    return "\n\n".join(blocks)
+
+
+def loadExampleDf(example_df_file, essay_text=""):
+    """
+    Return the data frame with the example essays.
+
+    Parameters
+    ----------
+    example_df_file : str, int or DataFrame
+        Path to the csv of the example essays, number of similar essays to
+        retrieve for essay_text or the data frame itself.
+    essay_text : str, optional
+        Essay to retrieve similar essays for.
+
+    Returns
+    -------
+    DataFrame or None
+        None if no examples are used.
+    """
+    if isinstance(example_df_file, pd.DataFrame):
+        return example_df_file
+    if not example_df_file:
+        return None
+    if type(example_df_file) is str:
+        return pd.read_csv(example_df_file, index_col=0)
+    elif type(example_df_file) is int:
+        return retriever.retrieve_similar_essays(essay_text, example_df_file)
+
+
+def compilePrompt(prompt_format, prompt_dict, example_df_file="",
+                  example_format_function=None, context_size=None,
+                  max_tokens=0, model_name=None, fit_examples=False):
+    """
+    Compile the prompt template of an experiment once instead of assembling
+    it for every essay. Only the {essay} placeholder (and the other prompt
+    variables) are bound per essay when the chain is invoked.
+
+    With a static example file, the examples are read and formatted once
+    and the same template is returned for every essay. With retrieved
+    examples (example_df_file is int), the templates are memoised by the
+    set of retrieved example essays.
+
+    If context_size is given, a warning is logged for every essay whose
+    prompt plus max_tokens exceeds the context window of the model. With
+    fit_examples, the examples are packed into the remaining token budget
+    of every essay instead (see packExamples) and the number of dropped
+    examples is logged.
+
+    Parameters
+    ----------
+    context_size : int, optional
+        Context window of the model in tokens. The default is None (no
+        check).
+    max_tokens : int, optional
+        Tokens reserved for the output. The default is 0.
+    model_name : str, optional
+        Model name used to select the tokenizer.
+    fit_examples : bool, optional
+        Drop examples that do not fit into the context window.
+        The default is False.
+
+    Returns
+    -------
+    function
+        Returns the prompt template for an essay text (and optionally the
+        essay id used in the log messages).
+    """
+    assemble_functions = {"simple": assembleSimplePrompt,
+                          "chat": assembleChatPrompt,
+                          "CoT": assembleCoTPrompt,
+                          "packed": assemblePackedChatPrompt}
+    assemble_function = assemble_functions[prompt_format]
+    # Compiled templates and their token counts by example essay ids
+    prompts = {}
+    example_dfs = {}
+    example_tokens = {}
+
+    def assemble(example_df):
+        return assemble_function(
+            example_df_file=example_df,
+            example_format_function=example_format_function,
+            essay_text="",
+            **prompt_dict)
+
+    def getCompiledPrompt(example_df):
+        key = () if example_df is None \
+            else tuple(example_df.essay_id.unique())
+        if key not in prompts:
+            prompt = assemble(example_df if key else None)
+            prompt_tokens = countPromptTokens(prompt, model_name) \
+                if context_size else 0
+            prompts[key] = (prompt, prompt_tokens)
+        return prompts[key]
+
+    def getExampleTokens(example_df, essay_id):
+        # Additional tokens of the prompt with the example
+        if essay_id not in example_tokens:
+            example_tokens[essay_id] = getCompiledPrompt(
+                example_df[example_df["essay_id"] == essay_id])[1] \
+                - getCompiledPrompt(None)[1]
+        return example_tokens[essay_id]
+
+    if type(example_df_file) is int and example_df_file:
+        def getExampleDf(essay_text):
+            essay_ids = tuple(retriever.retrieve_similar_essay_ids(
+                essay_text, example_df_file))
+            if essay_ids not in example_dfs:
+                example_dfs[essay_ids] = retriever.get_essays(essay_ids)
+            return example_dfs[essay_ids]
+    else:
+        static_example_df = loadExampleDf(example_df_file)
+
+        def getExampleDf(essay_text):
+            return static_example_df
+
+    if not context_size:
+        return lambda essay_text, essay_id="": getCompiledPrompt(
+            getExampleDf(essay_text))[0]
+
+    def getPrompt(essay_text, essay_id=""):
+        example_df = getExampleDf(essay_text)
+        # Tokens left for the prompt template without the essay
+        token_budget = context_size - max_tokens \
+            - tokens.count_tokens(essay_text, model_name)
+        if fit_examples and example_df is not None:
+            example_df, num_dropped = packExamples(
+                example_df,
+                token_budget - getCompiledPrompt(None)[1],
+                lambda example_essay_id: getExampleTokens(
+                    example_df, example_essay_id))
+            if num_dropped:
+                log.info(f"{num_dropped} examples dropped to fit the prompt "
+                         f"of essay {essay_id} into the context size of "
+                         f"{context_size} tokens")
+        prompt, prompt_tokens = getCompiledPrompt(example_df)
+        if prompt_tokens > token_budget:
+            log.warning(f"The prompt of essay {essay_id} exceeds the context "
+                        f"size of {context_size} tokens by "
+                        f"{prompt_tokens - token_budget} tokens (including "
+                        f"{max_tokens} tokens reserved for the output)")
+        return prompt
+    return getPrompt
+
+
+def packExamples(example_df, token_budget, get_example_tokens):
+    """
+    Greedily select the example essays that fit into the token budget in
+    the order of example_df. Examples that do not fit are skipped, so
+    shorter examples later in the order may still be selected.
+
+    Parameters
+    ----------
+    example_df : DataFrame
+        Discourse units of the example essays.
+    token_budget : int
+        Tokens available for the examples.
+    get_example_tokens : function
+        Returns the number of tokens an example essay adds to the prompt.
+
+    Returns
+    -------
+    DataFrame
+        Discourse units of the selected example essays.
+    int
+        Number of dropped example essays.
+    """
+    selected_ids = []
+    num_dropped = 0
+    for essay_id in example_df.essay_id.unique():
+        num_tokens = get_example_tokens(essay_id)
+        if num_tokens <= token_budget:
+            selected_ids.append(essay_id)
+            token_budget -= num_tokens
+        else:
+            num_dropped += 1
+    return example_df[example_df["essay_id"].isin(selected_ids)], \
+        num_dropped
+
+
+def countPromptTokens(prompt, model_name=None):
+    """
+    Count the tokens of a prompt template without the prompt variables.
+    """
+    if hasattr(prompt, "messages"):
+        return tokens.count_message_tokens(
+            [{"content": message.prompt.template}
+             for message in prompt.messages], model_name)
+    return tokens.count_tokens(prompt.template, model_name)
+
+
+# Formatted example essays by the key of exampleRenderKey. The formatters do
+# not use pre_essay.
+example_render_cache = {}
+# Version of the example formatters in the keys of example_render_cache.
+# Increase it when the output of a formatter changes, so that persisted
+# renders are not used anymore.
+EXAMPLE_FORMAT_VERSION = 1
+# Columns of the discourse units read by the example formatters
+EXAMPLE_RENDER_COLUMNS = ["full_text_clean", "discourse_start",
+                          "discourse_start_clean", "discourse_end_clean",
+                          "discourse_text_clean", "discourse_type"]
+# Fingerprints of the example essays by the id of their data frame (see
+# exampleFingerprints)
+example_fingerprints = {}
+
+
+def exampleRenderKey(df, essay_id, example_format_function, pre_demo):
+    """
+    Return the key of the example essay essay_id of df in
+    example_render_cache. Besides the essay_id, the formatter and pre_demo,
+    it contains the fingerprint of the essay (see exampleFingerprints), so
+    a changed dataset or a differently prepared text (e.g., the
+    brace-sanitised text of the retriever) is formatted again.
+    """
+    return (essay_id, example_format_function.__name__,
+            EXAMPLE_FORMAT_VERSION, pre_demo,
+            exampleFingerprints(df)[essay_id])
+
+
+def exampleFingerprints(df):
+    """
+    Return the fingerprints of the example essays of df by essay_id: a hash
+    of the EXAMPLE_RENDER_COLUMNS of their discourse unit rows (including
+    the essay text). They are computed once per data frame with
+    pandas.util.hash_pandas_object, which is stable across processes, so
+    the keys can be persisted. Data frames must not be changed in place
+    after their examples were formatted.
+    """
+    cached = example_fingerprints.get(id(df))
+    if cached is not None and cached[0]() is df:
+        return cached[1]
+    columns = [column for column in EXAMPLE_RENDER_COLUMNS
+               if column in df.columns]
+    row_hashes = pd.util.hash_pandas_object(df[columns], index=False)
+    essay_row_hashes = {}
+    for essay_id, row_hash in zip(df["essay_id"].tolist(),
+                                  row_hashes.tolist()):
+        essay_row_hashes.setdefault(essay_id, []).append(row_hash)
+    fingerprints = {
+        essay_id: hashlib.sha256(json.dumps([columns, hashes]).encode(
+            "utf-8")).hexdigest()
+        for essay_id, hashes in essay_row_hashes.items()}
+    example_fingerprints[id(df)] = (weakref.ref(df), fingerprints)
+    weakref.finalize(df, example_fingerprints.pop, id(df), None)
+    return fingerprints
+
+
+def formatExampleEssayCached(df, essay_id, example_format_function,
+                             pre_essay, pre_demo):
+    """
+    Return the example essay essay_id of df formatted with
+    example_format_function. The result is memoised in
+    example_render_cache, so essays that appear in many prompts (e.g.,
+    popular neighbours of the RAG retriever) are formatted only once.
+    """
+    key = exampleRenderKey(df, essay_id, example_format_function, pre_demo)
+    if key not in example_render_cache:
+        example_render_cache[key] = example_format_function(
+            df[df["essay_id"] == essay_id], pre_essay=pre_essay,
+            pre_demo=pre_demo)
+    return example_render_cache[key]
+
+
+def saveExampleRenderCache(path):
+    """
+    Write the formatted example essays of example_render_cache to a json
+    file.
+    """
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump([[*key, text] for key, text
+                   in example_render_cache.items()], file)
+
+
+def loadExampleRenderCache(path):
+    """
+    Warm example_render_cache with the formatted example essays of a json
+    file written by saveExampleRenderCache. Entries of other formatter
+    versions or without content hash (older files) are ignored.
+
+    Returns
+    -------
+    int
+        Number of loaded entries.
+    """
+    with open(path, "r", encoding="utf-8") as file:
+        entries = json.load(file)
+    num_loaded = 0
+    for entry in entries:
+        if len(entry) != 6 or entry[2] != EXAMPLE_FORMAT_VERSION:
+            continue
+        example_render_cache[tuple(entry[:5])] = entry[5]
+        num_loaded += 1
+    return num_loaded
+
+
+def precomputeExampleRenders(df, example_format_function, pre_demo="",
+                             max_workers=None):
+    """
+    Format all essays of df (e.g., the corpus of the RAG retriever) in a
+    process pool and add them to example_render_cache.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Discourse units of the essays as they are used in the prompts.
+    example_format_function : function
+        One of the formatExampleEssay* functions.
+    pre_demo : str, optional
+        pre_demo of the prompt_dict. The chat prompt always uses "".
+    max_workers : int, optional
+        Number of processes. The default is the number of CPUs.
+
+    Returns
+    -------
+    int
+        Number of formatted essays.
+    """
+    keys = {}
+    for essay_id, essay_df in df.groupby("essay_id", sort=False):
+        key = exampleRenderKey(df, essay_id, example_format_function,
+                               pre_demo)
+        if key not in example_render_cache:
+            keys[key] = essay_df
+    if not keys:
+        return 0
+    essay_dfs = list(keys.values())
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+        texts = executor.map(example_format_function, essay_dfs,
+                             [""] * len(essay_dfs),
+                             [pre_demo] * len(essay_dfs),
+                             chunksize=max(1, len(essay_dfs) // 64))
+        for key, text in zip(keys, texts):
+            example_render_cache[key] = text
+    return len(essay_dfs)
+
+
 def formatExampleEssayPythonDict(df, pre_essay, pre_demo):
     """
     Returns the discourse units of the df formated as a Python dictionary.
     """
+    sorted_df = df.sort_values("discourse_start")
+    du_texts = sorted_df.discourse_text_clean.str.replace('"', "'")
+    out = [pre_demo + "\n"] if pre_demo else []
+    out.append("{{\n")
+    out.extend(f'"{du_text}": "{du_type}",\n' for du_text, du_type
+               in zip(du_texts.tolist(), sorted_df.discourse_type.tolist()))
+    out.append("}}")
+    return "".join(out)
+
+
+def formatExampleEssayXML(df, pre_essay, pre_demo):
+    """
+    Returns the discourse units of the df formated with the XML-like syntax.
+    """
+    out = [pre_demo + "\n"] if pre_demo else []
+    out.append("```xml\n")
+    out.extend(_interleaveDiscourseUnits(
+        df, lambda du_text, du_type: f"<{du_type}>{du_text}</{du_type}>"))
+    out.append("```")
+    return "".join(out)
+
+
+def formatExampleEssayTANL(df, pre_essay, pre_demo):
+    """
+    Returns the discourse units of the df formated with the TANL syntax.
+    """
+    out = [pre_demo + "\n"] if pre_demo else []
+    out.extend(_interleaveDiscourseUnits(
+        df, lambda du_text, du_type: f"[{du_text}|{du_type}]"))
+    return "".join(out)
+
+
+def _interleaveDiscourseUnits(df, format_du):
+    """
+    Returns the segments of the essay text of df with every discourse unit
+    formatted by format_du(du_text, du_type) and the non-argument text in
+    between unchanged.
+    """
+    sorted_df = df.sort_values("discourse_start")
+    # The essay text is the same for all discourse units of the essay
+    full_text = sorted_df.full_text_clean.iloc[-1]
+    segments = []
+    cursor = 0
+    for discourse_start, discourse_end, du_type in zip(
+            sorted_df.discourse_start_clean.tolist(),
+            sorted_df.discourse_end_clean.tolist(),
+            sorted_df.discourse_type.tolist()):
+        # If no non-argument sections are between two discourse units
+        if cursor != discourse_start:
+            segments.append(full_text[cursor:discourse_start])
+        segments.append(format_du(full_text[discourse_start:discourse_end],
+                                  du_type))
+        cursor = discourse_end
+    # Add non-argument spans from the end of the essay
+    if cursor != len(full_text):
+        segments.append(full_text[cursor:])
+    return segments
+
+
+def formatExampleEssayPythonDictReference(df, pre_essay, pre_demo):
+    """
+    Returns the discourse units of the df formated as a Python dictionary.
+    Reference implementation of formatExampleEssayPythonDict.
+    """
     # out = pre_essay
     # out += "\n\n"
     # # Append full essay first (because non-argument text would not appear)
@@ -112,9 +570,10 @@ def formatExampleEssayPythonDict(df, pre_essay, pre_demo):
     return out
 
 
-def formatExampleEssayXML(df, pre_essay, pre_demo):
+def formatExampleEssayXMLReference(df, pre_essay, pre_demo):
     """
     Returns the discourse units of the df formated with the XML-like syntax.
+    Reference implementation of formatExampleEssayXML.
     """
     if pre_demo:
         out = pre_demo
@@ -145,9 +604,10 @@ def formatExampleEssayXML(df, pre_essay, pre_demo):
     return out
 
 
-def formatExampleEssayTANL(df, pre_essay, pre_demo):
+def formatExampleEssayTANLReference(df, pre_essay, pre_demo):
     """
     Returns the discourse units of the df formated with the TANL syntax.
+    Reference implementation of formatExampleEssayTANL.
     """
     cursor = 0
     if pre_demo:
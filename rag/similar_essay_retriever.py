@@ -1,5 +1,4 @@
-from langchain.vectorstores import Chroma
-from langchain_openai import OpenAIEmbeddings
+import functools
 import pandas as pd
 from argument_mining_persuade import config
 import os
@@ -7,22 +6,40 @@ import os
 
 CHROMA_PATH = os.path.join(config.DATA_DIR, "essay_chroma_data")
 COLLECTION_NAME = "essay_embeddings"
-EMBEDDINGS = OpenAIEmbeddings(model="text-embedding-3-small")
+EMBEDDING_MODEL = "text-embedding-3-small"
 
-df_dus = pd.read_csv(config.PERSUADE_2_CLEANED_PATH, index_col=0,
-                     low_memory=False)
+
+# The data frame, the embeddings and the Chroma client are created on first
+# use, so importing this module does not cost anything for runs without RAG
+@functools.lru_cache(maxsize=None)
+def get_df_dus():
+    return pd.read_csv(config.PERSUADE_2_CLEANED_PATH, index_col=0,
+                       low_memory=False)
+
+
+@functools.lru_cache(maxsize=None)
+def get_db():
+    from langchain.vectorstores import Chroma
+    from langchain_openai import OpenAIEmbeddings
+    return Chroma(persist_directory=CHROMA_PATH,
+                  collection_name=COLLECTION_NAME,
+                  embedding_function=OpenAIEmbeddings(model=EMBEDDING_MODEL))
 
 
 def retrieve_similar_essays(text, numOfEssays):
-    db = Chroma(persist_directory=CHROMA_PATH,
-                collection_name=COLLECTION_NAME,
-                embedding_function=EMBEDDINGS)
-    similar_essays = db.similarity_search(query=text, k=numOfEssays)
+    return get_essays(retrieve_similar_essay_ids(text, numOfEssays))
+
+
+def retrieve_similar_essay_ids(text, numOfEssays):
+    similar_essays = get_db().similarity_search(query=text, k=numOfEssays)
     # Get essay_ids of similar essays
-    essay_id_list = [sim_essay.metadata["essay_id"]
-                     for sim_essay in similar_essays]
+    return [sim_essay.metadata["essay_id"] for sim_essay in similar_essays]
+
+
+def get_essays(essay_id_list):
     # Get data frame lines of those essays
-    df = df_dus[df_dus["essay_id"].isin(essay_id_list)]
+    df_dus = get_df_dus()
+    df = df_dus[df_dus["essay_id"].isin(essay_id_list)].copy()
     # Replace "{" and "}" because they are interpreted as template placeholders
     df["full_text_clean"] = df["full_text_clean"].apply(
         lambda t: t.replace("{", "(").replace("}", ")"))
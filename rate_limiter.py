@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import collections
+import logging
+import random
+import re
+import time
+
+log = logging.getLogger('main_logger')
+
+# Rate limiters by provider and model name (see get_rate_limiter)
+_rate_limiters = {}
+# Messages of rate limit errors without status code, e.g. "Error code: 429"
+# or "Rate limit reached". 429 only counts as a status code following words
+# like "code", "status" or "HTTPError", not as part of other numbers.
+RATE_LIMIT_MESSAGE_PATTERN = re.compile(
+    r"\b(?:code|status|http\w*|\w*error)\W{0,3}429\b"
+    r"|rate[ _-]?limit|too many requests", re.IGNORECASE)
+# Exception types of the providers for rate limit errors
+RATE_LIMIT_ERROR_TYPES = {"RateLimitError", "ResourceExhausted"}
+
+
+class AdaptiveRateLimiter:
+    """
+    Scheduler for asynchronous LLM requests of one model of a provider.
+
+    Requests are only sent if they fit into the requests-per-minute (rpm) and
+    tokens-per-minute (tpm) budgets of the last 60 seconds. The token count
+    of a request has to be estimated before it is sent (prompt tokens plus
+    max_tokens, which is how OpenAI accounts requests against the limit).
+
+    The number of concurrent requests is adapted with an additive increase /
+    multiplicative decrease scheme: every successful request increases the
+    concurrency a little, a rate limit error (HTTP 429) halves it and pauses
+    all requests, and a latency far above the fastest observed latency
+    (the server starts queuing) shrinks it slightly.
+
+    Parameters
+    ----------
+    rpm : int, optional
+        Requests per minute of the model. None means no limit.
+    tpm : int, optional
+        Tokens per minute of the model. None means no limit.
+    max_concurrency : int, optional
+        Upper bound for concurrent requests. The default is 16.
+    max_rate_limit_retries : int, optional
+        How often a request is retried after a rate limit error.
+        The default is 8.
+    latency_factor : float, optional
+        Requests slower than latency_factor times the baseline latency
+        reduce the concurrency. The default is 2.5.
+    max_backoff : float, optional
+        Max seconds to pause after a rate limit error. The default is 60.
+    """
+
+    def __init__(self, rpm=None, tpm=None, max_concurrency=16,
+                 max_rate_limit_retries=8, latency_factor=2.5,
+                 max_backoff=60.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrency = max_concurrency
+        self.max_rate_limit_retries = max_rate_limit_retries
+        self.latency_factor = latency_factor
+        self.max_backoff = max_backoff
+        # Start in the middle and let the requests find the ceiling
+        self.concurrency = max(1.0, max_concurrency / 2)
+        self.in_flight = 0
+        self.pause_until = 0.0
+        self.latency_ewma = None
+        self.latency_baseline = None
+        self.rate_limit_errors = 0
+        # (timestamp, tokens) of the requests sent within the last minute
+        self._window = collections.deque()
+        self._condition = None
+        self._loop = None
+
+    def set_max_concurrency(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self.concurrency = min(self.concurrency, max_concurrency)
+
+    async def run(self, request_func, estimated_tokens):
+        """
+        Await request_func() as soon as the budgets allow it and retry it on
+        rate limit errors.
+
+        Parameters
+        ----------
+        request_func : function
+            Function without arguments returning the awaitable request.
+        estimated_tokens : int
+            Tokens the request is accounted with.
+        """
+        retries = 0
+        while True:
+            await self._acquire(estimated_tokens)
+            start = time.monotonic()
+            try:
+                result = await request_func()
+            except Exception as e:
+                await self._release()
+                if not is_rate_limit_error(e) \
+                        or retries >= self.max_rate_limit_retries:
+                    raise
+                retries += 1
+                self._on_rate_limit(retries)
+                continue
+            await self._release()
+            self._on_success(time.monotonic() - start)
+            return result
+
+    async def _acquire(self, estimated_tokens):
+        # Every experiment runs its own event loop
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._condition = asyncio.Condition()
+            self.in_flight = 0
+        if self.tpm:
+            # A single request can never exceed the whole budget
+            estimated_tokens = min(estimated_tokens, self.tpm)
+        async with self._condition:
+            while True:
+                wait_time = self._wait_time(estimated_tokens)
+                if wait_time <= 0 and self.in_flight < int(self.concurrency):
+                    break
+                try:
+                    # Woken up earlier by finished requests
+                    await asyncio.wait_for(
+                        self._condition.wait(),
+                        timeout=max(wait_time, 0.05))
+                except asyncio.TimeoutError:
+                    pass
+            self.in_flight += 1
+            self._window.append((time.monotonic(), estimated_tokens))
+
+    async def _release(self):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def _wait_time(self, estimated_tokens):
+        """
+        Seconds until a request with estimated_tokens fits into the budgets.
+        """
+        now = time.monotonic()
+        while self._window and now - self._window[0][0] >= 60:
+            self._window.popleft()
+        wait_time = self.pause_until - now
+        if self.rpm and len(self._window) >= self.rpm:
+            wait_time = max(wait_time,
+                            60 - (now - self._window[-self.rpm][0]))
+        if self.tpm:
+            used_tokens = sum(tokens for _, tokens in self._window)
+            # Free the oldest requests until the new one fits
+            for timestamp, tokens in self._window:
+                if used_tokens + estimated_tokens <= self.tpm:
+                    break
+                used_tokens -= tokens
+                wait_time = max(wait_time, 60 - (now - timestamp))
+        return wait_time
+
+    def _on_success(self, latency):
+        if self.latency_ewma is None:
+            self.latency_ewma = latency
+        else:
+            self.latency_ewma = 0.8 * self.latency_ewma + 0.2 * latency
+        if self.latency_baseline is None \
+                or self.latency_ewma < self.latency_baseline:
+            self.latency_baseline = self.latency_ewma
+        if self.latency_ewma > self.latency_factor * self.latency_baseline:
+            self.concurrency = max(1.0, self.concurrency * 0.9)
+        else:
+            self.concurrency = min(float(self.max_concurrency),
+                                   self.concurrency + 1 / self.concurrency)
+
+    def _on_rate_limit(self, retries):
+        self.rate_limit_errors += 1
+        self.concurrency = max(1.0, self.concurrency / 2)
+        # Exponential backoff with jitter for all requests of the provider
+        backoff = min(self.max_backoff, 2 ** retries) \
+            * (0.5 + random.random() / 2)
+        self.pause_until = max(self.pause_until, time.monotonic() + backoff)
+        log.debug(f"Rate limit hit (retry {retries}). Concurrency reduced to "
+                  f"{int(self.concurrency)}, pausing {backoff:.1f} seconds.")
+
+
+def is_rate_limit_error(e):
+    """
+    Check if an exception raised by a chat model is a rate limit error
+    (HTTP 429). The exception types differ between the providers. The HTTP
+    status code decides if the exception has one, then the exception type,
+    and only then the message (see RATE_LIMIT_MESSAGE_PATTERN).
+    """
+    status_code = getattr(e, "status_code", None)
+    response = getattr(e, "response", None)
+    if status_code is None and response is not None:
+        status_code = getattr(response, "status_code", None)
+    if isinstance(status_code, int):
+        return status_code == 429
+    if any(cls.__name__ in RATE_LIMIT_ERROR_TYPES
+           for cls in type(e).__mro__):
+        return True
+    return RATE_LIMIT_MESSAGE_PATTERN.search(str(e)) is not None
+
+
+def get_rate_limiter(provider, model_name=None, rpm=None, tpm=None,
+                     max_concurrency=16):
+    """
+    Return the rate limiter shared by all experiments with the model of the
+    provider. The limits of providers like OpenAI apply per model, so every
+    model has its own limiter. It is created with the given budgets on
+    first use.
+    """
+    key = (provider, model_name)
+    if key not in _rate_limiters:
+        _rate_limiters[key] = AdaptiveRateLimiter(
+            rpm=rpm, tpm=tpm, max_concurrency=max_concurrency)
+    return _rate_limiters[key]
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+import timeit
+
+import pandas as pd
+
+from argument_mining_persuade import config
+from argument_mining_persuade import prompt_generation
+
+
+# %% Configure the benchmark
+
+# Number of RAG example sets and examples per set
+num_rag_sets = 20
+num_rag_examples = 15
+repeat = 5
+
+# %% Example sets: the 15-shot file and random sets of the RAG corpus
+example_sets = {"15-shot": pd.read_csv(config.EXAMPLE_ESSAYS_15_SHOT,
+                                       index_col=0)}
+df_corpus = pd.read_csv(config.PERSUADE_2_CLEANED_PATH, index_col=0,
+                        low_memory=False)
+essay_ids = pd.Series(df_corpus.essay_id.unique())
+example_sets["RAG"] = pd.concat([
+    df_corpus[df_corpus.essay_id.isin(
+        essay_ids.sample(num_rag_examples, random_state=seed))]
+    for seed in range(num_rag_sets)])
+
+
+def render(example_df, example_format_function):
+    for essay_id, essay_df in example_df.groupby("essay_id", sort=False):
+        example_format_function(essay_df, "", "Output:")
+
+
+# %% Run benchmark
+for set_name, example_df in example_sets.items():
+    for format_name in ["PythonDict", "XML", "TANL"]:
+        fast = getattr(prompt_generation, f"formatExampleEssay{format_name}")
+        reference = getattr(prompt_generation,
+                            f"formatExampleEssay{format_name}Reference")
+        fast_time = min(timeit.repeat(lambda: render(example_df, fast),
+                                      number=1, repeat=repeat))
+        reference_time = min(timeit.repeat(
+            lambda: render(example_df, reference), number=1, repeat=repeat))
+        print(f"{set_name:8} {format_name:10} reference: "
+              f"{reference_time * 1000:8.1f} ms, vectorised: "
+              f"{fast_time * 1000:8.1f} ms, speedup: "
+              f"{reference_time / fast_time:5.1f}x")
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import os
+import random
+import time
+
+import pandas as pd
+
+from argument_mining_persuade import config
+from argument_mining_persuade import utils
+
+
+# %% Configure the benchmark
+
+df_file = config.TEST_DATASET_PATH
+num_essays = 50
+fuzzysearch_factor = 7
+# Fractions of characters of a discourse unit that are edited randomly
+edit_rate_list = [0.02, 0.05, 0.1, 0.2]
+# Lengths of long spans cut from the essays, edited with long_edit_rate
+long_span_length_list = [374, 623, 840]
+long_edit_rate = 0.05
+# Optional output directory of a previous experiment (with journal.jsonl)
+# whose non-verbatim spans are matched as well
+experiment_dir = ""
+parser = utils.parser_XML
+seed = 0
+
+
+def perturb(text, edit_rate, rng):
+    chars = list(text)
+    for _ in range(int(len(chars) * edit_rate)):
+        position = rng.randrange(len(chars))
+        operation = rng.choice(["substitute", "insert", "delete"])
+        if operation == "substitute":
+            chars[position] = rng.choice("abcdefghijklmnopqrstuvwxyz ")
+        elif operation == "insert":
+            chars.insert(position, rng.choice("abcdefghijklmnopqrstuvwxyz "))
+        elif len(chars) > 1:
+            del chars[position]
+    return "".join(chars)
+
+
+def compare(name, cases):
+    results = {}
+    for function in [utils.match_not_verbatim_du_full_scan,
+                     utils.align_not_verbatim_du]:
+        start_time = time.perf_counter()
+        results[function] = [
+            [(match.start, match.end) for match in function(
+                span, essay_text, fuzzysearch_factor)]
+            for span, essay_text in cases]
+        results[function, "time"] = time.perf_counter() - start_time
+    full_scan = results[utils.match_not_verbatim_du_full_scan]
+    aligned = results[utils.align_not_verbatim_du]
+    # parse_llm_result only accepts a span with exactly one match
+    accepted_full_scan = sum(len(matches) == 1 for matches in full_scan)
+    same_result = sum(a == b for a, b in zip(full_scan, aligned))
+    same_accepted = sum(len(a) == 1 and a == b
+                        for a, b in zip(full_scan, aligned))
+    print(f"{name:22} spans: {len(cases):5}, full scan: "
+          f"{results[utils.match_not_verbatim_du_full_scan, 'time']:7.2f} s, "
+          f"anchored: {results[utils.align_not_verbatim_du, 'time']:7.2f} s, "
+          f"identical matches: {same_result / max(1, len(cases)):6.1%}, "
+          f"accepted: {accepted_full_scan} / {same_accepted} (full scan / "
+          f"also anchored)")
+
+
+# %% Run benchmark
+if __name__ == "__main__":
+    rng = random.Random(seed)
+    df = pd.read_csv(df_file, index_col=0)
+    essay_ids = df.essay_id.drop_duplicates().sample(
+        min(num_essays, df.essay_id.nunique()), random_state=seed)
+    df = df[df.essay_id.isin(essay_ids)]
+    for edit_rate in edit_rate_list:
+        compare(f"edit rate {edit_rate:.0%}",
+                [(perturb(du_text, edit_rate, rng), essay_text)
+                 for du_text, essay_text in zip(df.discourse_text_clean,
+                                                df.full_text_clean)])
+    essay_texts = df.full_text_clean.drop_duplicates().tolist()
+    for span_length in long_span_length_list:
+        cases = []
+        for essay_text in essay_texts:
+            if len(essay_text) <= span_length:
+                continue
+            start = rng.randrange(len(essay_text) - span_length)
+            cases.append((perturb(essay_text[start:start + span_length],
+                                  long_edit_rate, rng), essay_text))
+        compare(f"{span_length} chars, {long_edit_rate:.0%}", cases)
+    if experiment_dir:
+        essay_texts = dict(zip(df.essay_id, df.full_text_clean))
+        llm_output_dict = utils.read_llm_outputs(experiment_dir)
+        cases = []
+        for essay_id, llm_output in llm_output_dict.items():
+            if essay_id not in essay_texts:
+                continue
+            try:
+                spans = parser(llm_output)
+            except Exception:
+                continue
+            cases.extend((span, essay_texts[essay_id]) for span in spans
+                         if span not in essay_texts[essay_id])
+        compare(os.path.basename(os.path.normpath(experiment_dir)), cases)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import ast
+import timeit
+
+import pandas as pd
+
+from argument_mining_persuade import config
+from argument_mining_persuade import prompt_generation
+from argument_mining_persuade import utils
+
+
+# %% Configure the benchmark
+
+df_file = config.TEST_DATASET_PATH
+num_essays = 200
+# Optional output directory of a previous experiment with the Python
+# dictionary format (with journal.jsonl) whose outputs are parsed as well
+experiment_dir = ""
+repeat = 5
+seed = 0
+
+
+def strip_code_fences(llm_output):
+    return llm_output.replace(r"```python", "").replace("```", "").strip()
+
+
+def literal_eval_parser(llm_output):
+    return ast.literal_eval(strip_code_fences(llm_output))
+
+
+def compare(name, outputs):
+    print(f"{name}: {len(outputs)} outputs")
+    for parser_name, parser in [
+            ("eval", utils.parser_python_dict_reference),
+            ("ast.literal_eval", literal_eval_parser),
+            ("parser_python_dict", utils.parser_python_dict)]:
+        parsed_outputs = 0
+        pairs = 0
+        for output in outputs:
+            try:
+                pairs += len(parser(output))
+                parsed_outputs += 1
+            except Exception:
+                pass
+        parse_time = min(timeit.repeat(
+            lambda: [_try_parse(parser, output) for output in outputs],
+            number=1, repeat=repeat))
+        print(f"    {parser_name:20} {parse_time * 1000:9.1f} ms, parsed "
+              f"outputs: {parsed_outputs:5}, discourse units: {pairs:6}")
+
+
+def _try_parse(parser, output):
+    try:
+        return parser(output)
+    except Exception:
+        return None
+
+
+# %% Run benchmark
+if __name__ == "__main__":
+    df = pd.read_csv(df_file, index_col=0)
+    essay_ids = df.essay_id.drop_duplicates().sample(
+        min(num_essays, df.essay_id.nunique()), random_state=seed)
+    # Outputs like the demonstrations of the Python dictionary templates
+    outputs = ["```python\n" + prompt_generation.formatExampleEssayPythonDict(
+        essay_df, "", "").replace("{{", "{").replace("}}", "}") + "\n```"
+        for _, essay_df in df[df.essay_id.isin(essay_ids)].groupby(
+            "essay_id")]
+    compare("Complete outputs", outputs)
+    compare("Outputs truncated at 70 %",
+            [output[:int(len(output) * 0.7)] for output in outputs])
+    if experiment_dir:
+        compare(experiment_dir,
+                list(utils.read_llm_outputs(experiment_dir).values()))
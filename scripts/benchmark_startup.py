@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import statistics
+import subprocess
+import sys
+import time
+
+
+# %% Configure the benchmark
+
+# Modules whose import time is measured in a fresh interpreter
+module_list = [
+    "argument_mining_persuade.utils",
+    "argument_mining_persuade.experiments",
+    ]
+# Target for the median import time in seconds
+target_seconds = 1.0
+repeat = 5
+# Number of slowest imports listed from python -X importtime
+num_slowest_imports = 10
+
+
+def measure_import(module_name):
+    start_time = time.perf_counter()
+    subprocess.run([sys.executable, "-c", f"import {module_name}"],
+                   check=True)
+    return time.perf_counter() - start_time
+
+
+def slowest_imports(module_name):
+    # -X importtime writes "import time: self | cumulative | module" to stderr
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module_name}"],
+        check=True, capture_output=True, text=True).stderr
+    imports = []
+    for line in stderr.splitlines()[1:]:
+        self_time, cumulative_time, name = line.split("|")
+        imports.append((int(cumulative_time), name.rstrip()))
+    return sorted(imports, reverse=True)[:num_slowest_imports]
+
+
+# %% Run benchmark
+if __name__ == "__main__":
+    exceeded = False
+    for module_name in module_list:
+        # The first run fills the bytecode cache
+        measure_import(module_name)
+        median_time = statistics.median(
+            measure_import(module_name) for _ in range(repeat))
+        exceeded = exceeded or median_time > target_seconds
+        print(f"{module_name}: {median_time:.2f} s (target "
+              f"{target_seconds:.2f} s)")
+        for cumulative_time, name in slowest_imports(module_name):
+            print(f"    {cumulative_time / 1e6:6.2f} s {name}")
+    sys.exit(1 if exceeded else 0)
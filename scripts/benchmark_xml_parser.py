@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+import timeit
+
+from argument_mining_persuade import utils
+from argument_mining_persuade.templates import \
+    xml_V1_with_format_assignment_CoT as cot_template
+
+
+# %% Configure the benchmark
+
+# The demonstration of the CoT template is a complete CoT output: the
+# reasoning quotes the spans, followed by the annotated essay. Longer
+# outputs repeat the reasoning.
+reasoning_repetitions = [1, 4, 16]
+# Optional output directory of a previous experiment (with journal.jsonl)
+# whose outputs are parsed as well
+experiment_dir = ""
+repeat = 20
+
+
+def compare(name, outputs):
+    for output in outputs:
+        if utils.parser_XML(output) != utils.parser_XML_reference(output):
+            raise AssertionError(f"Parsers differ for the output:\n{output}")
+    reference_time = min(timeit.repeat(
+        lambda: [utils.parser_XML_reference(output) for output in outputs],
+        number=1, repeat=repeat))
+    fast_time = min(timeit.repeat(
+        lambda: [utils.parser_XML(output) for output in outputs],
+        number=1, repeat=repeat))
+    print(f"{name:28} outputs: {len(outputs):5}, characters: "
+          f"{sum(len(output) for output in outputs):9}, regex: "
+          f"{reference_time * 1000:8.2f} ms, single pass: "
+          f"{fast_time * 1000:8.2f} ms, speedup: "
+          f"{reference_time / fast_time:5.1f}x")
+
+
+# %% Run benchmark
+if __name__ == "__main__":
+    reasoning, annotated_essay = cot_template.prompt_dict["pre_demo"].split(
+        "In summary this is the essay annotated in the XML-like syntax:")
+    for repetitions in reasoning_repetitions:
+        compare(f"CoT, reasoning x{repetitions}",
+                [reasoning * repetitions + annotated_essay] * 100)
+    if experiment_dir:
+        compare(experiment_dir[-28:],
+                list(utils.read_llm_outputs(experiment_dir).values()))
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+import pandas as pd
+
+from argument_mining_persuade import config
+from argument_mining_persuade import prompt_generation
+from argument_mining_persuade.rag import similar_essay_retriever as retriever
+
+
+# %% Configure the formats to precompute
+
+# pre_demo of the prompt templates ("" is used by the chat prompt)
+pre_demo_list = ["", "Output:"]
+format_function_list = [
+    prompt_generation.formatExampleEssayXML,
+    # prompt_generation.formatExampleEssayTANL,
+    # prompt_generation.formatExampleEssayPythonDict,
+    ]
+
+# %% Format all essays of the embedding corpus in a process pool
+# The guard is required for the process pool on Windows
+if __name__ == "__main__":
+    essay_ids = pd.read_csv(config.EMBEDDING_ESSAYS,
+                            index_col=0).essay_id.unique()
+    # Same data frame as used for the prompts of the RAG experiments
+    df = retriever.get_essays(essay_ids)
+    for example_format_function in format_function_list:
+        for pre_demo in pre_demo_list:
+            num_renders = prompt_generation.precomputeExampleRenders(
+                df, example_format_function, pre_demo)
+            print(f"{example_format_function.__name__} ({pre_demo!r}): "
+                  f"{num_renders} essays formatted")
+    prompt_generation.saveExampleRenderCache(config.EXAMPLE_RENDER_CACHE_PATH)
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+import os
+
+from argument_mining_persuade import utils
+from argument_mining_persuade import experiments
+from argument_mining_persuade import config
+
+
+# %% Configure the experiment to evaluate again
+
+# Output directory of a previous experiment containing journal.jsonl
+experiment_dir = os.path.join(config.OUTPUT_DIR, "")
+df_file = config.TEST_DATASET_PATH
+# Slice of essays of the previous experiment (None for the entire df). All
+# essays of the slice are scored, also those without LLM output.
+slice_start = None
+slice_end = None
+
+# Every configuration is evaluated in its own subdirectory of experiment_dir
+config_list = []
+for parser in [
+        utils.parser_XML,
+        # utils.parser_TANL,
+        # utils.parser_python_dict,
+        ]:
+    for fuzzysearch_factor in [
+            7,
+            # 5,
+            # 10,
+            ]:
+        config_list.append({"parser": parser,
+                            "fuzzysearch_factor": fuzzysearch_factor,
+                            "slice_start": slice_start,
+                            "slice_end": slice_end})
+
+# %% Run evaluation in a process pool
+# The guard is required for the process pool on Windows
+if __name__ == "__main__":
+    experiments.rescore_experiment_sweep(experiment_dir, df_file, config_list)
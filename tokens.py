@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import functools
+import logging
+
+log = logging.getLogger('main_logger')
+
+# Rough number of characters per token if no tokenizer is available
+CHARS_PER_TOKEN = 4
+
+
+@functools.lru_cache(maxsize=None)
+def _get_encoding(model_name):
+    """
+    Return the tiktoken encoding for the model or None if tiktoken is not
+    installed or the encoding cannot be loaded (it is downloaded on first
+    use). Models unknown to tiktoken (e.g., local models) are counted with
+    the cl100k_base encoding, which is close enough for budgeting.
+    """
+    try:
+        import tiktoken
+    except ImportError:
+        log.debug("tiktoken is not installed. Token counts are estimated "
+                  "from the number of characters.")
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except (KeyError, TypeError, AttributeError):
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        log.debug(f"tiktoken encoding could not be loaded ({e}). Token "
+                  f"counts are estimated from the number of characters.")
+        return None
+
+
+def count_tokens(text, model_name=None):
+    """
+    Count the tokens of a text for the given model.
+    """
+    encoding = _get_encoding(model_name)
+    if encoding is None:
+        return len(text) // CHARS_PER_TOKEN + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages, model_name=None):
+    """
+    Count the tokens of a list of chat messages, including the few tokens
+    every message adds for its role and separators.
+
+    Parameters
+    ----------
+    messages : list
+        List of langchain messages or dicts with a "content" key.
+    model_name : str, optional
+        Name of the model used to choose the tokenizer.
+
+    Returns
+    -------
+    int
+        Number of prompt tokens.
+    """
+    num_tokens = 3
+    for message in messages:
+        if isinstance(message, dict):
+            content = message["content"]
+        else:
+            content = message.content
+        num_tokens += 4 + count_tokens(content, model_name)
+    return num_tokens
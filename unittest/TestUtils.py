@@ -1,11 +1,32 @@
 # -*- coding: utf-8 -*-
 import unittest
+import asyncio
+import os
+import json
+import random
+import subprocess
+import sys
+import gzip
+import logging
+import tempfile
+import time
+import types
 import pandas as pd
 import fuzzysearch
 from difflib import SequenceMatcher
 from argument_mining_persuade import utils
+from argument_mining_persuade import experiments
 from argument_mining_persuade import metrics
 from argument_mining_persuade import prompt_generation
+from argument_mining_persuade import rate_limiter
+from argument_mining_persuade import llm_cache
+from argument_mining_persuade import batch_api
+from argument_mining_persuade import config
+from argument_mining_persuade.fake_batch_api_server import FakeBatchAPIServer
+from argument_mining_persuade.rag import similar_essay_retriever
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.prompts import PromptTemplate
+from langchain_core.runnables import RunnableLambda
 
 
 class Test_parse_discourse_type(unittest.TestCase):
@@ -45,6 +66,45 @@ class Test_parse_discourse_type(unittest.TestCase):
         self.assertEqual(utils.parse_discourse_type("counter claim"),
                          "Counterclaim")
 
+    def test_same_as_reference(self):
+        labels = ["Lead", "lead", "Concluding statement",
+                  "ConcludingStatement", "counter claim", " Claim ", "Claim\n",
+                  "claims", "Evidnce", "Non-argument", "", None]
+        for valid_type in utils.get_valid_types_list():
+            labels.extend([valid_type, valid_type.upper(),
+                           valid_type.replace(" ", "")])
+        for label in labels:
+            self.assertEqual(utils.parse_discourse_type(label),
+                             utils.parse_discourse_type_reference(label))
+
+    def test_normaliser_counters(self):
+        normaliser = utils.DiscourseTypeNormaliser()
+        for label in ["CLAIM", "Claim", "Evidnce", "Evidnce", "unknown"]:
+            normaliser.normalise(label)
+        self.assertEqual(normaliser.counters(),
+                         {"table_hits": 2, "fuzzy_cache_hits": 1,
+                          "fuzzy_cache_misses": 2, "unknown_labels": 1})
+
+    def test_normaliser_counts_in_statistics(self):
+        # Every discourse unit is normalised once, whatever the parser
+        essay_text = "I think so. Phones help students. Ask them. I agree."
+        for parser_func, llm_output in [
+                (lambda output: {"I think so.": "CLAIM",
+                                 "Phones help students.": "nonsense",
+                                 "Ask them.": "nonsense",
+                                 "I agree.": "Claim"}, ""),
+                (utils.parser_XML, "<CLAIM>I think so.</CLAIM> <nonsense>"
+                 "Phones help students.</nonsense> <nonsense>Ask them."
+                 "</nonsense> <Claim>I agree.</Claim>")]:
+            stats_dict, result_rows = utils.parse_llm_result(
+                stats_dict=utils.new_stats_dict(), essay_text=essay_text,
+                essay_id="0", parser_func=parser_func, llm_output=llm_output,
+                result_rows=[], fuzzysearch_factor=10)
+            self.assertEqual([row[4] for row in result_rows],
+                             ["Claim", None, None, "Claim"])
+            self.assertEqual(stats_dict["discourse_type_table_hits"], 2)
+            self.assertEqual(stats_dict["unknown_discourse_types"], 2)
+
 
 class Test_start_and_end_word_idx(unittest.TestCase):
     def test1(self):
@@ -72,6 +132,124 @@ class Test_word_based_predictionstring(unittest.TestCase):
         self.assertEqual(result_df.predictionstring.iloc[1], "3")
         self.assertEqual(result_df.predictionstring.iloc[2], "4")
 
+    def test_same_as_reference(self):
+        df = pd.read_csv("example_essay_1_shot_A5DB60716E91.csv", index_col=0)
+        # Empty and overlapping discourse units
+        df["discourse_end"] -= [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 43]
+        df = pd.concat([df, df.iloc[[1, 2]].assign(discourse_start=0)])
+        args = (df, "full_text_clean", "discourse_start", "discourse_end",
+                "essay_id", "discourse_type")
+        pd.testing.assert_frame_equal(
+            utils.build_predictionstring_df_word(*args),
+            utils.build_predictionstring_df_word_reference(*args))
+
+
+class Test_locate_verbatim_spans(unittest.TestCase):
+    def test_order_of_output(self):
+        essay_text = "We should. Because it is fun. We should."
+        #             0123456789012345678901234567890
+        self.assertEqual(utils.locate_verbatim_spans(
+            ["Because it is fun.", "We should.", "missing"], essay_text),
+            [11, 30, None])
+
+    def test_no_overlap(self):
+        essay_text = "We should. We should."
+        self.assertEqual(utils.locate_verbatim_spans(
+            ["We should.", "We should. We", "should."], essay_text),
+            [0, 0, 14])
+
+
+class Test_align_not_verbatim_du(unittest.TestCase):
+    essay_text = ("Some people think that students should not be allowed to "
+                  "use phones in school. I disagree with that, because "
+                  "phones can help students to learn and to stay safe. "
+                  "In conclusion, phones should be allowed in school.")
+
+    def test_same_as_full_scan(self):
+        for span in ["phones can help studnets to lern and to stay safe",
+                     "I disagre with tht, because",
+                     "phones should be alowed in school."]:
+            self.assertEqual(
+                utils.align_not_verbatim_du(span, self.essay_text, 10),
+                utils.match_not_verbatim_du_full_scan(
+                    span, self.essay_text, 10))
+
+    def test_long_span_same_as_full_scan(self):
+        span = ("Some peple think that studnts should not be alowed to use "
+                "phones in school. I disagree with tht, becuse phones can "
+                "help students to learn and to stay safe.")
+        matches = utils.align_not_verbatim_du(span, self.essay_text, 10)
+        self.assertEqual(matches, utils.match_not_verbatim_du_full_scan(
+            span, self.essay_text, 10))
+        self.assertEqual([(match.start, match.end, match.dist)
+                          for match in matches], [(0, 160, 5)])
+
+    def test_coverage_pruning(self):
+        # The second occurrence keeps one of the three pieces. The windows
+        # cover the whole essay, so it is dropped for the verbatim one.
+        span = "students use phones!"
+        essay_text = span + " and studXnts usX phones!"
+        self.assertEqual(len(utils.match_not_verbatim_du_full_scan(
+            span, essay_text, 10)), 2)
+        self.assertEqual(utils.align_not_verbatim_du(span, essay_text, 10),
+                         [fuzzysearch.Match(start=0, end=20, dist=0,
+                                            matched=span)])
+        coverage = utils.ALIGN_MAX_WINDOW_COVERAGE
+        try:
+            utils.ALIGN_MAX_WINDOW_COVERAGE = 1.0
+            self.assertEqual(
+                utils.align_not_verbatim_du(span, essay_text, 10),
+                utils.match_not_verbatim_du_full_scan(span, essay_text, 10))
+        finally:
+            utils.ALIGN_MAX_WINDOW_COVERAGE = coverage
+
+    def test_no_anchor(self):
+        self.assertEqual(utils.align_not_verbatim_du(
+            "xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx", self.essay_text, 10),
+            [])
+
+    def test_budget_fallback(self):
+        span = "phones can help studnets to lern and to stay safe"
+        start = self.essay_text.index("phones can help")
+        for fallback, expected in [("anchor", [(start, start + len(span))]),
+                                   ("skip", [])]:
+            stats_dict, result_rows = utils.parse_llm_result(
+                stats_dict=utils.new_stats_dict(),
+                essay_text=self.essay_text, essay_id="0",
+                parser_func=lambda output: {span: "Claim"},
+                llm_output="", result_rows=[], fuzzysearch_factor=10,
+                fuzzy_budget={"max_l_dist": 2, "fallback": fallback})
+            self.assertEqual(stats_dict["fuzzy_budget_hits"], 1)
+            self.assertEqual([row[1:3] for row in result_rows], expected)
+
+    def test_short_pieces_same_as_full_scan(self):
+        # Pieces of two characters are aligned to the whole essay
+        for span in ["phones can help studnets", "I disagre with tht",
+                     "to stay safe. In conclsion"]:
+            self.assertEqual(
+                utils.align_not_verbatim_du(span, self.essay_text, 3),
+                utils.match_not_verbatim_du_full_scan(
+                    span, self.essay_text, 3))
+
+    def test_deadline_stops_alignment(self):
+        span = "phones can help studnets to lern and to stay safe"
+        for factor in [3, 10]:
+            self.assertIsNone(utils.align_not_verbatim_du(
+                span, self.essay_text, factor, time.perf_counter() - 1))
+            matches, budget_hit = utils.match_not_verbatim_du_within_budget(
+                span, self.essay_text, factor, {"max_span_seconds": 0,
+                                                "fallback": "skip"})
+            self.assertTrue(budget_hit)
+            self.assertEqual(matches, [])
+
+    def test_within_budget(self):
+        span = "phones can help studnets to lern and to stay safe"
+        matches, budget_hit = utils.match_not_verbatim_du_within_budget(
+            span, self.essay_text, 10, {"max_span_seconds": 10})
+        self.assertFalse(budget_hit)
+        self.assertEqual(matches, utils.match_not_verbatim_du_full_scan(
+            span, self.essay_text, 10))
+
 
 class Test_metrics(unittest.TestCase):
     def test_span_1(self):
@@ -138,6 +316,40 @@ class Test_metrics(unittest.TestCase):
             df_pred, df_gt, return_class_scores=False),
             0)
 
+    def test_micro_same_as_reference(self):
+        df_gt = pd.DataFrame(
+            {"essay_id": ["0", "0", "0", "1", "2"],
+             "discourse_type": ["Claim"] * 5,
+             "predictionstring": ["0 1 2 3", "4 5 6", "10 11", "3 1 2",
+                                  "7 8 9"]
+             })
+        df_pred = pd.DataFrame(
+            {"essay_id": ["0", "0", "0", "1", "1", "3"],
+             "discourse_type": ["Claim"] * 6,
+             "predictionstring": ["1 2 3", "2 3 4 5", "5 6 7 8", "1 2",
+                                  " ", "0 1"]
+             })
+        self.assertEqual(
+            metrics.score_feedback_comp_micro(df_pred, df_gt),
+            metrics.score_feedback_comp_micro_reference(df_pred, df_gt))
+
+    def test_interval_engine_same_as_string(self):
+        df_gt = pd.read_csv("example_essay_1_shot_A5DB60716E91.csv",
+                            index_col=0)
+        df_gt = df_gt.rename(columns={"discourse_text_clean":
+                                      "discourse_text"})
+        # Shifted, shortened, empty and mislabeled discourse units
+        result_df = df_gt[utils.RESULT_COLUMNS].copy()
+        result_df["discourse_start"] += [0, 5, 20, 0, 1, 0, 0, 40, 0, 0, 3, 0]
+        result_df["discourse_end"] -= [0, 0, 30, 0, 0, 9, 0, 0, 70, 0, 0, 0]
+        result_df.loc[result_df.index[3], "discourse_end"] = \
+            result_df.loc[result_df.index[3], "discourse_start"]
+        result_df.loc[result_df.index[4], "discourse_type"] = "Lead"
+        metrics_dfs = [metrics.get_span_and_word_metrics(
+            df_gt, result_df, engine=engine)
+            for engine in ["string", "interval"]]
+        pd.testing.assert_frame_equal(*metrics_dfs)
+
 
 class Test_overlap(unittest.TestCase):
     def test1(self):
@@ -176,6 +388,41 @@ class Test_parser_formatter_(unittest.TestCase):
             self.assertTrue(ratio > 0.95)
             self.assertEqual(dict_as_tuples[i][1], row.discourse_type)
 
+    def test_python_dict_same_as_eval(self):
+        df = pd.read_csv("example_essay_1_shot_A5DB60716E91.csv", index_col=0)
+        llm_output = "```python\n" + prompt_generation.\
+            formatExampleEssayPythonDict(df, "", "").replace(
+                "{{", "{").replace("}}", "}") + "\n```"
+        self.assertEqual(
+            list(utils.parser_python_dict(llm_output).items()),
+            list(utils.parser_python_dict_reference(llm_output).items()))
+
+    def test_python_dict_recovery(self):
+        self.assertEqual(utils.parser_python_dict(
+            "{'a': 'Claim', \"b\\\"c\": \"Lead\", \"d\": \"Evid"),
+            {"a": "Claim", 'b"c': "Lead"})
+        self.assertEqual(utils.parser_python_dict("```python\n{}\n```"), {})
+        with self.assertRaises(SyntaxError):
+            utils.parser_python_dict("I can not annotate this essay.")
+
+    def test_python_dict_malformed(self):
+        # Line break in a span and apostrophe in a single-quoted span
+        self.assertEqual(utils.parser_python_dict(
+            "{\"a\nb\": \"Claim\", 'I don't agree': 'Position'}"),
+            {"a\nb": "Claim", "I don't agree": "Position"})
+        # Unescaped quotes inside of a span
+        self.assertEqual(utils.parser_python_dict(
+            '{"he said "no" to me": "Lead", "b": "Claim"}'),
+            {'he said "no" to me': "Lead", "b": "Claim"})
+        # Text after the closing brace is ignored
+        self.assertEqual(utils.parser_python_dict(
+            '```python\n{"a": "Claim"}\n```\n"Note": "none"'),
+            {"a": "Claim"})
+        # Malformed pairs are skipped up to the next pair
+        self.assertEqual(utils.parser_python_dict(
+            '{{\n"a": "Claim",\n"broken,\n"b": Lead,\n"c": "Evidence",\n'
+            '"d": "Evid'), {"a": "Claim", "c": "Evidence"})
+
     def test_XML(self):
         df = pd.read_csv("example_essay_1_shot_A5DB60716E91.csv", index_col=0)
         df.reset_index(drop=True, inplace=True)
@@ -190,6 +437,21 @@ class Test_parser_formatter_(unittest.TestCase):
             self.assertTrue(ratio > 0.95)
             self.assertEqual(dict_as_tuples[i][1], row.discourse_type)
 
+    def test_XML_same_as_reference(self):
+        for llm_output in [
+                "<Claim>a <Lead>b</Lead> c</Claim>",
+                "<Claim>unclosed <Position>p</Position> <> </>x</>",
+                "Reasoning with a < b and c > d. <Evidence>e</Evidence>",
+                "<Claim>a</Claim><Claim>a</Claim></Claim>b</Claim>"]:
+            self.assertEqual(list(utils.parser_XML(llm_output).items()),
+                             list(utils.parser_XML_reference(
+                                 llm_output).items()))
+
+    def test_XML_spans(self):
+        llm_output = "Reasoning <Lead>a b</Lead> <Claim>c"
+        self.assertEqual(utils.parse_xml_spans(llm_output),
+                         [(16, 19, "Lead")])
+
     def test_TANL(self):
         df = pd.read_csv("example_essay_1_shot_A5DB60716E91.csv", index_col=0)
         df.reset_index(drop=True, inplace=True)
@@ -205,5 +467,642 @@ class Test_parser_formatter_(unittest.TestCase):
             self.assertEqual(dict_as_tuples[i][1], row.discourse_type)
 
 
+class Test_example_formatters(unittest.TestCase):
+    def test_equal_to_reference(self):
+        df = pd.read_csv("example_essay_1_shot_A5DB60716E91.csv", index_col=0)
+        for fast, reference in [
+                (prompt_generation.formatExampleEssayPythonDict,
+                 prompt_generation.formatExampleEssayPythonDictReference),
+                (prompt_generation.formatExampleEssayXML,
+                 prompt_generation.formatExampleEssayXMLReference),
+                (prompt_generation.formatExampleEssayTANL,
+                 prompt_generation.formatExampleEssayTANLReference)]:
+            for pre_demo in ["", "Output:"]:
+                self.assertEqual(fast(df, "Essay:", pre_demo),
+                                 reference(df, "Essay:", pre_demo))
+
+
+class Test_compile_prompt(unittest.TestCase):
+    def test_static_examples(self):
+        example_file = "example_essay_1_shot_A5DB60716E91.csv"
+        prompt_dict = {"preamble": "Find the arguments.",
+                       "pre_essay": "Essay:", "pre_demo": "Output:"}
+        for prompt_format, assemble_function in [
+                ("simple", prompt_generation.assembleSimplePrompt),
+                ("chat", prompt_generation.assembleChatPrompt)]:
+            get_prompt = prompt_generation.compilePrompt(
+                prompt_format, prompt_dict, example_file,
+                prompt_generation.formatExampleEssayXML)
+            prompt = get_prompt("first essay")
+            # The template is compiled once and reused for every essay
+            self.assertIs(get_prompt("second essay"), prompt)
+            expected = assemble_function(
+                essay_text="first essay", example_df_file=example_file,
+                example_format_function=(
+                    prompt_generation.formatExampleEssayXML),
+                **prompt_dict)
+            self.assertEqual(prompt.format_prompt(essay="text"),
+                             expected.format_prompt(essay="text"))
+
+
+class Test_pack_examples(unittest.TestCase):
+    def test_greedy(self):
+        example_df = pd.DataFrame({"essay_id": ["a", "a", "b", "c"]})
+        example_tokens = {"a": 50, "b": 80, "c": 30}
+        packed_df, num_dropped = prompt_generation.packExamples(
+            example_df, 90, example_tokens.get)
+        # b does not fit after a, but the shorter c does
+        self.assertEqual(list(packed_df.essay_id.unique()), ["a", "c"])
+        self.assertEqual(num_dropped, 1)
+
+    def test_fit_examples(self):
+        example_file = "example_essay_1_shot_A5DB60716E91.csv"
+        prompt_dict = {"preamble": "Find the arguments."}
+        for context_size, num_messages in [(100000, 4), (1000, 2)]:
+            get_prompt = prompt_generation.compilePrompt(
+                "chat", prompt_dict, example_file,
+                prompt_generation.formatExampleEssayXML,
+                context_size=context_size, max_tokens=500,
+                fit_examples=True)
+            self.assertEqual(len(get_prompt("short essay").messages),
+                             num_messages)
+
+
+class Test_example_render_cache(unittest.TestCase):
+    def setUp(self):
+        prompt_generation.example_render_cache.clear()
+
+    def tearDown(self):
+        prompt_generation.example_render_cache.clear()
+
+    def test_precompute_save_load(self):
+        df = pd.read_csv("example_essay_1_shot_A5DB60716E91.csv", index_col=0)
+        essay_id = df.essay_id.iloc[0]
+        expected = prompt_generation.formatExampleEssayXML(df, "", "Output:")
+        self.assertEqual(prompt_generation.precomputeExampleRenders(
+            df, prompt_generation.formatExampleEssayXML, "Output:",
+            max_workers=1), 1)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "renders.json")
+            prompt_generation.saveExampleRenderCache(path)
+            prompt_generation.example_render_cache.clear()
+            self.assertEqual(
+                prompt_generation.loadExampleRenderCache(path), 1)
+        # Served from the cache
+        self.assertEqual(prompt_generation.formatExampleEssayCached(
+            df, essay_id, prompt_generation.formatExampleEssayXML,
+            "", "Output:"), expected)
+        self.assertEqual(len(prompt_generation.example_render_cache), 1)
+
+    def test_changed_essay_is_formatted_again(self):
+        df = pd.read_csv("example_essay_1_shot_A5DB60716E91.csv", index_col=0)
+        essay_id = df.essay_id.iloc[0]
+        prompt_generation.formatExampleEssayCached(
+            df, essay_id, prompt_generation.formatExampleEssayXML, "", "")
+        changed_df = df.assign(full_text_clean=df.full_text_clean.str.upper())
+        self.assertEqual(prompt_generation.formatExampleEssayCached(
+            changed_df, essay_id, prompt_generation.formatExampleEssayXML,
+            "", ""),
+            prompt_generation.formatExampleEssayXML(changed_df, "", ""))
+        self.assertEqual(len(prompt_generation.example_render_cache), 2)
+
+    def test_fingerprint_once_per_df(self):
+        df = pd.read_csv("example_essay_1_shot_A5DB60716E91.csv", index_col=0)
+        essay_id = df.essay_id.iloc[0]
+        fingerprints = prompt_generation.exampleFingerprints(df)
+        self.assertIs(prompt_generation.exampleFingerprints(df),
+                      fingerprints)
+        # Same fingerprint for the same examples read again
+        self.assertEqual(prompt_generation.exampleFingerprints(
+            pd.read_csv("example_essay_1_shot_A5DB60716E91.csv",
+                        index_col=0)), fingerprints)
+        # Other essays of the data frame do not change the fingerprint
+        other_df = pd.concat([df, df.assign(essay_id="E1")])
+        self.assertEqual(prompt_generation.exampleFingerprints(
+            other_df)[essay_id], fingerprints[essay_id])
+
+
+class Test_lazy_imports(unittest.TestCase):
+    def test_import_without_langchain(self):
+        # Fresh interpreter, the modules of this test are already imported
+        code = ("import sys\n"
+                "from argument_mining_persuade import experiments\n"
+                "print(sorted({name.split('.')[0] for name in sys.modules}\n"
+                "             & {'langchain', 'langchain_core', 'chromadb',\n"
+                "                'langchain_openai', 'openai', 'openpyxl'}))")
+        output = subprocess.run([sys.executable, "-c", code],
+                                capture_output=True, text=True, check=True)
+        self.assertEqual(output.stdout.strip(), "[]")
+
+    def test_retriever_reads_essays_on_first_use(self):
+        path = config.PERSUADE_2_CLEANED_PATH
+        similar_essay_retriever.get_df_dus.cache_clear()
+        try:
+            config.PERSUADE_2_CLEANED_PATH = \
+                "example_essay_1_shot_A5DB60716E91.csv"
+            df = pd.read_csv(config.PERSUADE_2_CLEANED_PATH, index_col=0)
+            essay_id = df.essay_id.iloc[0]
+            for _ in range(2):
+                essay_df = similar_essay_retriever.get_essays([essay_id])
+            self.assertEqual(len(essay_df), len(df))
+            self.assertEqual(
+                similar_essay_retriever.get_df_dus.cache_info().misses, 1)
+        finally:
+            config.PERSUADE_2_CLEANED_PATH = path
+            similar_essay_retriever.get_df_dus.cache_clear()
+
+
+class Test_packed_essays(unittest.TestCase):
+    def test_split_output(self):
+        output = "### Essay A1\n<Claim>x</Claim>\n\n**### Essay B2:**\n" \
+            "<Lead>y</Lead>\n### Essay C3\n\n### Essay D4\nz"
+        self.assertEqual(utils.split_packed_output(
+            output, ["A1", "B2", "C3", "D4", "E5"]),
+            {"A1": "<Claim>x</Claim>", "B2": "<Lead>y</Lead>", "D4": "z"})
+
+    def test_pack_essays(self):
+        essay_tokens = {0: 100, 1: 100, 2: 500, 3: 100, 4: 100}
+        # Limited by the number of essays
+        self.assertEqual(utils.pack_essays(
+            range(5), essay_tokens, 50, None, None, 2),
+            [[0, 1], [2, 3], [4]])
+        # Limited by the estimated output and the context window
+        self.assertEqual(utils.pack_essays(
+            range(5), essay_tokens, 50, 1000, 700, 8),
+            [[0, 1], [2], [3, 4]])
+
+
+class Test_rate_limiter(unittest.TestCase):
+    class RateLimitError(Exception):
+        status_code = 429
+
+    def test_retry_after_rate_limit(self):
+        limiter = rate_limiter.AdaptiveRateLimiter(
+            rpm=100, tpm=10000, max_concurrency=4, max_backoff=0.01)
+        calls = []
+
+        async def request():
+            calls.append(1)
+            if len(calls) == 1:
+                raise self.RateLimitError("Rate limit reached")
+            return "output"
+
+        self.assertEqual(asyncio.run(limiter.run(request, 100)), "output")
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(limiter.rate_limit_errors, 1)
+        # Concurrency is halved (2 -> 1) and increased after the success
+        self.assertEqual(limiter.concurrency, 2)
+
+    def test_other_errors_are_raised(self):
+        limiter = rate_limiter.AdaptiveRateLimiter()
+
+        async def request():
+            raise ValueError("something else")
+
+        with self.assertRaises(ValueError):
+            asyncio.run(limiter.run(request, 100))
+
+    def test_is_rate_limit_error(self):
+        class ServerError(Exception):
+            status_code = 500
+
+        for error, expected in [
+                (self.RateLimitError("Too busy"), True),
+                (ServerError("Error code: 429"), False),
+                (ValueError("Error code: 429 - {'error': ...}"), True),
+                (ValueError("Rate limit reached for gpt-4o"), True),
+                (ValueError("Essay 1429 took 4290 ms"), False),
+                (ValueError("The output used 429 tokens"), False)]:
+            self.assertEqual(rate_limiter.is_rate_limit_error(error),
+                             expected, str(error))
+
+    def test_window_delays_acquisition(self):
+        # The window is full until its oldest requests are 60 seconds old
+        for limiter, tokens in [
+                (rate_limiter.AdaptiveRateLimiter(rpm=2), 10),
+                (rate_limiter.AdaptiveRateLimiter(tpm=100), 20)]:
+            sent = time.monotonic() - 59.7
+            limiter._window.extend([(sent, 45), (sent, 45)])
+
+            async def request():
+                return time.monotonic()
+
+            start_time = time.monotonic()
+            self.assertGreater(asyncio.run(limiter.run(request, tokens)),
+                               start_time + 0.2)
+        # A request that fits into the token budget is not delayed
+        limiter = rate_limiter.AdaptiveRateLimiter(tpm=100)
+        limiter._window.append((time.monotonic(), 90))
+        start_time = time.monotonic()
+        self.assertLess(asyncio.run(limiter.run(request, 10)),
+                        start_time + 0.2)
+
+    def test_aimd(self):
+        limiter = rate_limiter.AdaptiveRateLimiter(max_concurrency=8)
+        self.assertEqual(limiter.concurrency, 4)
+        # Additive increase while the latency is stable
+        for _ in range(4):
+            limiter._on_success(1.0)
+        self.assertAlmostEqual(limiter.concurrency, 4.92, places=2)
+        # Slight decrease when the server starts queuing
+        concurrency = limiter.concurrency
+        for _ in range(10):
+            limiter._on_success(10.0)
+        self.assertLess(limiter.concurrency, concurrency)
+        # Multiplicative decrease and pause after a rate limit error
+        concurrency = limiter.concurrency
+        limiter._on_rate_limit(1)
+        self.assertEqual(limiter.concurrency, max(1.0, concurrency / 2))
+        self.assertGreater(limiter.pause_until, time.monotonic())
+        # Never more than max_concurrency
+        limiter = rate_limiter.AdaptiveRateLimiter(max_concurrency=2)
+        for _ in range(10):
+            limiter._on_success(1.0)
+        self.assertEqual(limiter.concurrency, 2)
+
+    def test_limiter_per_model(self):
+        gpt_4o = rate_limiter.get_rate_limiter(
+            "test_provider", "gpt-4o", rpm=500, tpm=30000)
+        gpt_3_5 = rate_limiter.get_rate_limiter(
+            "test_provider", "gpt-3.5-turbo", rpm=3500, tpm=60000)
+        self.assertIsNot(gpt_4o, gpt_3_5)
+        self.assertEqual((gpt_4o.rpm, gpt_4o.tpm), (500, 30000))
+        self.assertEqual((gpt_3_5.rpm, gpt_3_5.tpm), (3500, 60000))
+        self.assertIs(rate_limiter.get_rate_limiter(
+            "test_provider", "gpt-4o", rpm=500, tpm=30000), gpt_4o)
+
+
+class Test_llm_cache(unittest.TestCase):
+    model_params = {"model_name": "gpt-4o", "temperature": 0,
+                    "max_tokens": 3000}
+    messages = [SystemMessage(content="preamble"),
+                HumanMessage(content="essay")]
+
+    def test_key(self):
+        key = llm_cache.LLMResponseCache.make_key(self.model_params,
+                                                  self.messages)
+        self.assertEqual(key, llm_cache.LLMResponseCache.make_key(
+            self.model_params.copy(), list(self.messages)))
+        self.assertNotEqual(key, llm_cache.LLMResponseCache.make_key(
+            {**self.model_params, "temperature": 1}, self.messages))
+        self.assertNotEqual(key, llm_cache.LLMResponseCache.make_key(
+            self.model_params, self.messages[1:]))
+
+    def test_key_of_lm_studio_models(self):
+        from argument_mining_persuade.models import lm_studio
+        keys = []
+        for model_id in ["llama-3-8b-instruct", "phi-3-mini-4k-instruct"]:
+            server = FakeBatchAPIServer(models=[model_id]).start()
+            base_url = lm_studio.BASE_URL
+            lm_studio.BASE_URL = server.base_url
+            try:
+                model = lm_studio.get_llm()
+            finally:
+                lm_studio.BASE_URL = base_url
+                server.stop()
+            self.assertEqual(utils.get_model_params(model)["model_name"],
+                             model_id)
+            keys.append(llm_cache.LLMResponseCache.make_key(
+                utils.get_model_params(model), self.messages))
+        self.assertNotEqual(keys[0], keys[1])
+
+    def test_get_put_evict(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "cache.sqlite")
+            cache = llm_cache.LLMResponseCache(path)
+            self.assertIsNone(cache.get("a"))
+            cache.put("a", "output a")
+            cache.put("b", "output b")
+            self.assertEqual(cache.get("a"), "output a")
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            cache.close()
+            # "b" is the least recently used entry and exceeds the size
+            cache = llm_cache.LLMResponseCache(path, max_size_mb=8 / 2**20)
+            self.assertEqual(cache.get("a"), "output a")
+            self.assertIsNone(cache.get("b"))
+            cache.close()
+            cache = llm_cache.LLMResponseCache(path, max_age_days=0)
+            self.assertIsNone(cache.get("a"))
+            cache.close()
+
+
+class FakeChain:
+    """
+    Stand-in for the chain (prompt | model) of ainvoke_llm. It answers with
+    the essay text after a random delay and records the number of requests
+    in flight.
+    """
+
+    def __init__(self, seed=0):
+        self.first = PromptTemplate.from_template("{essay}")
+        self.random = random.Random(seed)
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def ainvoke(self, prompt_var_dict):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.random.uniform(0, 0.02))
+        finally:
+            self.in_flight -= 1
+        return AIMessage(content=prompt_var_dict["essay"])
+
+
+class Test_ainvoke_llm(unittest.TestCase):
+    def test_order_and_concurrency(self):
+        df_essay = pd.DataFrame({
+            "essay_id": [f"E{i}" for i in range(40)],
+            "full_text_clean": [f"essay {i}" for i in range(40)]})
+        for max_concurrency in [1, 4, 16]:
+            chain = FakeChain(seed=max_concurrency)
+            finished = []
+            outputs = asyncio.run(utils.ainvoke_llm(
+                df_essay, {"essay": lambda row: row.full_text_clean},
+                lambda row: chain, model=None,
+                prompt_log=logging.getLogger("test_prompts"),
+                max_concurrency=max_concurrency,
+                on_output=lambda i, output: finished.append(i)))
+            self.assertEqual(outputs, list(df_essay.full_text_clean))
+            self.assertEqual(sorted(finished), list(range(40)))
+            if max_concurrency > 1:
+                # The requests finish out of order
+                self.assertNotEqual(finished, sorted(finished))
+            self.assertEqual(chain.max_in_flight, max_concurrency)
+
+
+class Test_journal(unittest.TestCase):
+    def test_write_read_restore(self):
+        stats_dict = utils.new_stats_dict()
+        stats_dict["total_classified_du"] = 2
+        stats_dict["total_verbatim_du"] = 1
+        result_rows = [("1", 0, 12, "word1 word2.", "Claim")]
+        with tempfile.TemporaryDirectory() as temp_dir:
+            journal_file = os.path.join(temp_dir, utils.JOURNAL_FILE_NAME)
+            with open(journal_file, "w", encoding="utf-8") as file:
+                utils.write_journal_record(file, "1", "output", stats_dict,
+                                           result_rows)
+                # Line cut off by an interrupted run
+                file.write('{"essay_id": "2", "llm_ou')
+            journal = utils.read_journal(journal_file)
+        self.assertEqual(list(journal.keys()), ["1"])
+        restored_stats, restored_rows = utils.restore_journal_record(
+            journal["1"])
+        self.assertEqual(restored_stats, stats_dict)
+        self.assertEqual(restored_rows, result_rows)
+
+    def test_resume_invokes_missing_essays(self):
+        df = pd.read_csv("example_essay_1_shot_A5DB60716E91.csv", index_col=0)
+        output = prompt_generation.formatExampleEssayXML(df, "", "")
+        # Every essay ends with its id, so the model can tell them apart
+        df_du = pd.concat([df.assign(
+            essay_id=f"E{i}", full_text_clean=df.full_text_clean + f" E{i}")
+            for i in range(4)], ignore_index=True)
+        df_essay = df_du.drop_duplicates("essay_id")
+        invoked = []
+
+        def model(prompt_value):
+            invoked.append(prompt_value.to_string().strip('"\n').split()[-1])
+            return AIMessage(content=output)
+
+        prompt_module = types.SimpleNamespace(prompt_dict={
+            "preamble": "Find the arguments.", "pre_essay": "",
+            "pre_demo": ""})
+        prompt_var_func_dict = {"essay": lambda row: row.full_text_clean}
+        with tempfile.TemporaryDirectory() as temp_dir:
+            def invoke_llm(df_essay, resume):
+                return utils.invoke_llm(
+                    df_essay, df_du, prompt_var_func_dict, utils.parser_XML,
+                    7, prompt_module, RunnableLambda(model), "simple", "",
+                    prompt_generation.formatExampleEssayXML,
+                    output_dir=temp_dir, resume=resume)
+
+            invoke_llm(df_essay.iloc[:2], resume=False)
+            # Line cut off by an interrupted run
+            with open(os.path.join(temp_dir, utils.JOURNAL_FILE_NAME), "a",
+                      encoding="utf-8") as file:
+                file.write('{"essay_id": "E2", "llm_ou')
+            result_df, statistics_df = invoke_llm(df_essay, resume=True)
+            logging.getLogger("prompts").handlers.clear()
+        self.assertEqual(invoked, ["E0", "E1", "E2", "E3"])
+        self.assertEqual(list(result_df.essay_id.unique()),
+                         ["E0", "E1", "E2", "E3"])
+        # The statistics of the journaled essays are restored
+        self.assertEqual(statistics_df["Total classified DUs"].iloc[0],
+                         4 * len(df))
+
+
+class Test_rescore_experiment(unittest.TestCase):
+    def test_essays_without_output(self):
+        df = pd.read_csv("example_essay_1_shot_A5DB60716E91.csv", index_col=0)
+        output = prompt_generation.formatExampleEssayXML(df, "", "")
+        df_du = pd.concat([df.assign(essay_id=f"E{i}") for i in range(2)],
+                          ignore_index=True)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            df_file = os.path.join(temp_dir, "df.csv")
+            df_du.to_csv(df_file)
+            experiment_dir = os.path.join(temp_dir, "experiment")
+            os.makedirs(experiment_dir)
+            with open(os.path.join(experiment_dir, utils.JOURNAL_FILE_NAME),
+                      "w", encoding="utf-8") as file:
+                utils.write_journal_record(file, "E0", output,
+                                           utils.new_stats_dict(), [])
+            _, statistics_df, metrics_df = experiments.rescore_experiment(
+                experiment_dir, df_file, utils.parser_XML,
+                rescore_name="rescore", write_overview=False)
+        # The essay without output is part of the ground truth
+        self.assertEqual(statistics_df["Total DUs in ground truth"].iloc[0],
+                         len(df_du))
+        self.assertEqual(
+            statistics_df["Number of essays without LLM output"].iloc[0], 1)
+        self.assertEqual(
+            statistics_df["Number of unparsable essays"].iloc[0], 1)
+        # Half of the discourse units are missed
+        self.assertLess(metrics_df.loc["F1_span", "All"], 0.7)
+
+    def test_read_llm_outputs_fallbacks(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with self.assertRaises(FileNotFoundError):
+                utils.read_llm_outputs(temp_dir)
+            # Older experiments only have the essays with discourse units
+            utils.build_result_df([("E0", 0, 4, "text", "Claim")]).assign(
+                llm_output="output 0").to_csv(
+                    os.path.join(temp_dir, "result_df.csv"))
+            self.assertEqual(utils.read_llm_outputs(temp_dir),
+                             {"E0": "output 0"})
+            # The essay result table also has the essays without units
+            utils.build_essay_result_df(
+                ["E0", "E1"], ["text 0", "text 1"], ["output 0", ""]).to_csv(
+                    os.path.join(temp_dir, "essay_result_df.csv"))
+            self.assertEqual(utils.read_llm_outputs(temp_dir),
+                             {"E0": "output 0", "E1": ""})
+            # The journal takes precedence
+            with open(os.path.join(temp_dir, utils.JOURNAL_FILE_NAME), "w",
+                      encoding="utf-8") as file:
+                utils.write_journal_record(file, "E1", "journaled output",
+                                           utils.new_stats_dict(), [])
+            self.assertEqual(utils.read_llm_outputs(temp_dir),
+                             {"E1": "journaled output"})
+
+
+class Test_result_tables(unittest.TestCase):
+    def test_essay_text_kept_once_per_essay(self):
+        df = pd.read_csv("example_essay_1_shot_A5DB60716E91.csv", index_col=0)
+        df_du = pd.concat([df.assign(essay_id=f"E{i}") for i in range(3)],
+                          ignore_index=True)
+        df_essay = df_du.drop_duplicates("essay_id")
+        output = prompt_generation.formatExampleEssayXML(df, "", "")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            result_df, _ = utils.parse_llm_outputs(
+                df_essay, df_du, {"E0": output, "E2": output},
+                utils.parser_XML, 7, output_dir=temp_dir)
+            essay_result_df = pd.read_csv(
+                os.path.join(temp_dir, "essay_result_df.csv"), index_col=0)
+        # One row per discourse unit without the texts of the essay
+        self.assertEqual(list(result_df.columns), utils.RESULT_COLUMNS)
+        self.assertEqual(list(result_df.essay_id.value_counts().sort_index()
+                              .items()), [("E0", len(df)), ("E2", len(df))])
+        self.assertEqual(list(result_df.discourse_type[:len(df)]),
+                         list(df.sort_values("discourse_start")
+                              .discourse_type))
+        # One row per essay with output
+        self.assertEqual(list(essay_result_df.columns),
+                         utils.ESSAY_RESULT_COLUMNS)
+        self.assertEqual(list(essay_result_df.essay_id), ["E0", "E2"])
+        self.assertEqual(list(essay_result_df.llm_output), [output] * 2)
+
+
+class Test_parse_workers(unittest.TestCase):
+    def test_same_as_sequential(self):
+        df = pd.read_csv("example_essay_1_shot_A5DB60716E91.csv", index_col=0)
+        df_du = pd.concat([df.assign(essay_id=str(i)) for i in range(4)],
+                          ignore_index=True)
+        df_essay = df_du.drop_duplicates("essay_id")
+        output = prompt_generation.formatExampleEssayXML(df, "", "")
+        llm_output_dict = {"0": output,
+                           "1": output.replace("students", "studnets"),
+                           "3": ""}
+        results = [utils.parse_llm_outputs(
+            df_essay, df_du, llm_output_dict, utils.parser_XML, 7,
+            parse_workers=parse_workers) for parse_workers in [1, 2]]
+        pd.testing.assert_frame_equal(results[0][0], results[1][0])
+        pd.testing.assert_frame_equal(results[0][1], results[1][1])
+        self.assertEqual(
+            results[1][1]["Number of unparsable essays"].iloc[0], 1)
+
+    def test_worker_log_records(self):
+        class ListHandler(logging.Handler):
+            def __init__(self):
+                super().__init__()
+                self.messages = []
+
+            def emit(self, record):
+                self.messages.append(record.getMessage())
+
+        df = pd.read_csv("example_essay_1_shot_A5DB60716E91.csv", index_col=0)
+        output = prompt_generation.formatExampleEssayXML(df, "", "")
+        handler = ListHandler()
+        utils.log.addHandler(handler)
+        try:
+            utils.parse_llm_outputs(
+                df.drop_duplicates("essay_id"), df,
+                {df.essay_id.iloc[0]: output}, utils.parser_XML, 7,
+                parse_workers=2)
+        finally:
+            utils.log.removeHandler(handler)
+        # Logged in the worker and forwarded to the handlers of this process
+        self.assertTrue(any(
+            message.startswith("\nVerbatim discourse units in essay")
+            for message in handler.messages))
+
+
+class Test_batch_result_files(unittest.TestCase):
+    @staticmethod
+    def result_line(custom_id, content=None, error=None):
+        if error:
+            return json.dumps({"custom_id": custom_id, "response": None,
+                               "error": {"message": error}})
+        return json.dumps({
+            "custom_id": custom_id, "error": None,
+            "response": {"status_code": 200, "body": {
+                "choices": [{"message": {"content": content}}]}}})
+
+    def test_read_shards(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with open(os.path.join(temp_dir, "batch_0_output.jsonl"),
+                      "w") as file:
+                file.write(self.result_line("A", "output A") + "\n")
+                file.write(self.result_line("B", error="server error") + "\n")
+                file.write(self.result_line("C", error="server error") + "\n")
+            with open(os.path.join(temp_dir, "batch_1_output.jsonl"),
+                      "w") as file:
+                file.write(self.result_line("B", "output B") + "\n")
+            output_dict, error_dict = utils.read_batch_result_files(
+                os.path.join(temp_dir, "batch_*_output.jsonl"))
+        self.assertEqual(output_dict, {"A": "output A", "B": "output B"})
+        self.assertEqual(list(error_dict.keys()), ["C"])
+        self.assertEqual(utils.report_missing_batch_outputs(
+            ["A", "B", "C", "D"], output_dict, error_dict), ["C", "D"])
+
+
+class Test_batch_file_writer(unittest.TestCase):
+    def test_shards(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            writer = utils.BatchFileWriter(os.path.join(temp_dir, "batch"),
+                                           max_requests=3, max_tokens=100)
+            for i in range(5):
+                writer.write({"custom_id": str(i)}, num_tokens=40)
+            file_names = writer.close()
+            self.assertEqual([os.path.basename(f) for f in file_names],
+                             ["batch_0.jsonl", "batch_1.jsonl",
+                              "batch_2.jsonl"])
+            with open(file_names[0]) as file:
+                self.assertEqual(len(file.readlines()), 2)
+            self.assertFalse(os.path.exists(
+                os.path.join(temp_dir, "batch.jsonl")))
+
+    def test_single_compressed_file(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            writer = utils.BatchFileWriter(os.path.join(temp_dir, "batch"),
+                                           max_bytes=1000, compress=True)
+            writer.write({"custom_id": "0"})
+            file_names = writer.close()
+            self.assertEqual([os.path.basename(f) for f in file_names],
+                             ["batch.jsonl.gz"])
+            with gzip.open(file_names[0], "rt") as file:
+                self.assertEqual(json.loads(file.readline()),
+                                 {"custom_id": "0"})
+
+
+class Test_batch_api(unittest.TestCase):
+    def test_lifecycle_with_resubmission(self):
+        from openai import OpenAI
+        server = FakeBatchAPIServer(
+            responder=lambda task: f"output {task['custom_id']}",
+            fail_once=["B"]).start()
+        try:
+            client = OpenAI(base_url=server.base_url, api_key="fake")
+            with tempfile.TemporaryDirectory() as temp_dir:
+                writer = utils.BatchFileWriter(
+                    os.path.join(temp_dir, "batch"), max_requests=2,
+                    compress=True)
+                for custom_id in ["A", "B", "C"]:
+                    writer.write({
+                        "custom_id": custom_id, "method": "POST",
+                        "url": "/v1/chat/completions",
+                        "body": {"model": "gpt-4o", "messages": [
+                            {"role": "user", "content": custom_id}]}})
+                merged_file = batch_api.run_batch_jobs(
+                    writer.close(), temp_dir, client=client,
+                    poll_interval=0.01)
+                output_dict, error_dict = utils.read_batch_result_files(
+                    merged_file)
+        finally:
+            server.stop()
+        self.assertEqual(output_dict, {"A": "output A", "B": "output B",
+                                       "C": "output C"})
+        self.assertEqual(error_dict, {})
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,105 +1,787 @@
 # -*- coding: utf-8 -*-
 from tqdm import tqdm
+import ast
+import asyncio
+import bisect
+import concurrent.futures
 import logging
+import logging.handlers
+import multiprocessing
 import fuzzysearch
 import pandas as pd
 import difflib
+import numpy as np
+import functools
 import os
-import openpyxl
 import traceback
-from openpyxl.styles import PatternFill, Alignment
 import re
 import json
+import time
+import glob
+import gzip
 from argument_mining_persuade import prompt_generation
+from argument_mining_persuade import llm_cache as llm_cache_module
+from argument_mining_persuade import tokens
 
 log = logging.getLogger('main_logger')
 
+# Journal of the LLM outputs and parsed discourse units of an experiment
+JOURNAL_FILE_NAME = "journal.jsonl"
+JOURNAL_COLUMNS = ["discourse_start", "discourse_end", "discourse_text",
+                   "discourse_type"]
+# Columns of the parsed discourse units (result_df). The essay text and the
+# LLM output are kept once per essay in the essay result table.
+RESULT_COLUMNS = ["essay_id"] + JOURNAL_COLUMNS
+ESSAY_RESULT_COLUMNS = ["essay_id", "original_essay_text", "llm_output"]
+# Limits of a single input file of the OpenAI Batch API
+BATCH_API_MAX_REQUESTS = 50000
+BATCH_API_MAX_FILE_MB = 200
+# Anchors of align_not_verbatim_du must be at least this long, otherwise
+# the span is aligned to the whole essay
+ALIGN_MIN_ANCHOR_LENGTH = 4
+# Max fraction of the essay searched around all anchors
+ALIGN_MAX_WINDOW_COVERAGE = 0.5
+# "key": "value" pair of a Python dictionary in the LLM output. The key ends
+# at the first quote of its kind that is followed by a colon and a quote, so
+# it may contain line breaks, apostrophes and unescaped quotes. Pair
+# boundaries (a quote followed by a comma and a quote, or a comma at the end
+# of a line followed by a line starting with a quote) end the key as well.
+PYTHON_DICT_PAIR_PATTERN = re.compile(
+    r"""\s*(?P<quote>["'])(?P<key>[^"',]*(?:(?!(?P=quote)\s*[,:]\s*["']"""
+    r"""|,[ \t]*\n\s*["'])["',][^"',]*)*)"""
+    r"""(?P=quote)\s*:\s*(?P<value_quote>["'])(?P<value>[^"'\n]*)"""
+    r"""(?P=value_quote)\s*(?:,|(?P<end>\}))?""")
+# Start of the next pair after a malformed one or the closing brace of the
+# dictionary
+PYTHON_DICT_RESYNC_PATTERN = re.compile(
+    r"""["']\s*,\s*(?=["'])|\n\s*(?=["'])|(?P<end>\}+[ \t]*(?:\n|```|$))""")
+# Words like str.split() separates them
+WORD_PATTERN = re.compile(r"\S+")
+# Estimated output tokens per essay token of the packed prompt format (the
+# XML and TANL outputs repeat the whole essay)
+PACKED_OUTPUT_TOKEN_FACTOR = 1.3
+
 
 def invoke_llm(df_essay, df_du, prompt_var_func_dict, parser_func,
                fuzzysearch_factor, prompt_module, model, prompt_format,
                example_df_file, example_format_function,
-               output_dir="", batch_result_file=""):
+               output_dir="", batch_result_file="", max_concurrency=1,
+               rate_limiter=None, llm_cache=None, resume=False,
+               context_size=None, fit_examples_to_context=False,
+               max_essays_per_request=8, fuzzy_budget=None, parse_workers=1):
     """
     - Setup logging
     - Build prompts
     - Invoke the LLM or read a batch result
     - Start functions to calculate the metrics
-    """
-    stats_dict = {}
-    stats_dict["total_classified_du"] = 0
-    stats_dict["total_verbatim_du"] = 0
-    stats_dict["total_matched_not_verbatim_du"] = 0
-    stats_dict["syntax_err_list"] = []
-    result_df = pd.DataFrame(
-        columns=["essay_id", "discourse_start", "discourse_end",
-                 "discourse_text", "discourse_type", "original_essay_text",
-                 "llm_output"])
-    prompt_log = createLogger(output_dir, "prompts")
 
-    for i, df_essay_row in tqdm(df_essay.iterrows(), total=df_essay.shape[0]):
+    If max_concurrency is greater than 1, the LLM is invoked asynchronously
+    with up to max_concurrency requests in flight. The outputs are still
+    parsed in the order of the essays in df_essay. If a rate_limiter is
+    given, it schedules the asynchronous requests within the rate limits of
+    the provider and adapts the concurrency. If an llm_cache is given,
+    outputs of identical requests are read from the cache instead of
+    invoking the LLM.
+
+    The LLM output and the parsed discourse units of every essay are
+    appended to a journal in the output_dir as soon as they are available.
+    If resume is True, essays already contained in the journal are not
+    processed again.
+
+    If context_size is given, prompts exceeding the context window of the
+    model are logged. With fit_examples_to_context, examples are dropped
+    from those prompts until they fit.
+
+    With the prompt_format "packed", up to max_essays_per_request essays
+    are sent in one request (see invoke_packed_llm). Essays whose output
+    could not be split apart are processed individually with the chat
+    prompt format.
+
+    Non-verbatim discourse units are matched within the fuzzy_budget (see
+    match_not_verbatim_du_within_budget) if one is given.
+
+    If parse_workers is greater than 1, the outputs are parsed in a process
+    pool (see new_parse_pool) while the LLM is invoked.
+    """
+    prompt_log = createLogger(output_dir, "prompts",
+                              file_mode="a" if resume else "w")
+
+    essay_rows = [df_essay_row for _, df_essay_row in df_essay.iterrows()]
+    # (stats_dict, result_rows, llm_output) of every essay in the order of
+    # df_essay
+    essay_results = [None] * len(essay_rows)
+
+    # Restore essays from the journal of an interrupted run
+    journal_file = os.path.join(output_dir, JOURNAL_FILE_NAME) \
+        if output_dir else ""
+    journal = read_journal(journal_file) if resume else {}
+    pending = []
+    for i, df_essay_row in enumerate(essay_rows):
+        if df_essay_row.essay_id in journal:
+            essay_results[i] = restore_journal_record(
+                journal[df_essay_row.essay_id]) \
+                + (journal[df_essay_row.essay_id]["llm_output"],)
+        else:
+            pending.append(i)
+    if resume:
+        log.info(f"Resuming run: {len(essay_rows) - len(pending)} of "
+                 f"{len(essay_rows)} essays were read from the journal.")
+
+    # Index the batch results once and report missing outputs up front
+    if batch_result_file:
+        batch_output_dict, batch_error_dict = read_batch_result_files(
+            batch_result_file)
+        report_missing_batch_outputs(
+            [essay_rows[i].essay_id for i in pending], batch_output_dict,
+            batch_error_dict)
+
+    journal_handle = None
+    if journal_file:
+        # Rewrite the journal to drop a line cut off by the interruption
+        journal_handle = open(journal_file, "w", encoding="utf-8")
+        for record in journal.values():
+            journal_handle.write(json.dumps(record) + "\n")
+        journal_handle.flush()
+
+    # The prompt template is compiled once for all essays
+    chain_builder = compile_chain_builder(
+        prompt_module=prompt_module,
+        model=model,
+        prompt_format="chat" if prompt_format == "packed" else prompt_format,
+        example_df_file=example_df_file,
+        example_format_function=example_format_function,
+        context_size=context_size,
+        fit_examples_to_context=fit_examples_to_context)
+
+    parse_pool = None
+    # Futures of the essays parsed in the parse_pool by position
+    parse_futures = {}
+    if parse_workers > 1:
+        parse_pool = new_parse_pool(
+            dict(zip(df_essay.essay_id, df_essay.full_text_clean)),
+            parser_func, fuzzysearch_factor, fuzzy_budget, parse_workers)
+
+    def store_parsing_result(i, output, essay_stats_dict, essay_result_rows):
+        essay_results[i] = (essay_stats_dict, essay_result_rows, output)
+        if journal_handle is not None:
+            write_journal_record(journal_handle, essay_rows[i].essay_id,
+                                 output, essay_stats_dict, essay_result_rows)
+
+    def collect_parsing_results(wait=False):
+        for i in list(parse_futures):
+            future, output = parse_futures[i]
+            if wait or future.done():
+                del parse_futures[i]
+                store_parsing_result(i, output, *future.result())
+
+    def process_output(i, output):
+        df_essay_row = essay_rows[i]
         log.debug("")
-        log.debug(f"## Processing_essay {df_essay_row.essay_id} ##")
+        log.debug(f"## Parsing output of essay {df_essay_row.essay_id} ##")
+        # print Output also to prompt log
+        prompt_log.debug(f"The LLM output of essay {df_essay_row.essay_id} "
+                         f"was: \n\n{remove_special_characters(output)}\n\n")
+
+        if parse_pool is not None:
+            parse_futures[i] = (parse_pool.submit(
+                parse_essay_in_worker, df_essay_row.essay_id, output), output)
+            collect_parsing_results()
+            return
+        essay_stats_dict, essay_result_rows = parse_llm_result(
+            stats_dict=new_stats_dict(),
+            essay_text=df_essay_row.full_text_clean,
+            essay_id=df_essay_row.essay_id,
+            parser_func=parser_func,
+            llm_output=output,
+            result_rows=[],
+            fuzzysearch_factor=fuzzysearch_factor,
+            fuzzy_budget=fuzzy_budget)
+        store_parsing_result(i, output, essay_stats_dict, essay_result_rows)
 
-        prompt_dict = prompt_module.prompt_dict
-        if prompt_format == "simple":
-            prompt = prompt_generation.assembleSimplePrompt(
-                example_df_file=example_df_file,
-                example_format_function=example_format_function,
-                essay_text=df_essay_row.full_text_clean,
-                **prompt_dict)
-        elif prompt_format == "chat":
-            prompt = prompt_generation.assembleChatPrompt(
-                example_df_file=example_df_file,
-                example_format_function=example_format_function,
-                essay_text=df_essay_row.full_text_clean,
-                **prompt_dict)
-        elif prompt_format == "CoT":
-            prompt = prompt_generation.assembleCoTPrompt(
+    try:
+        if prompt_format == "packed" and not batch_result_file:
+            pending = invoke_packed_llm(
+                essay_rows=essay_rows,
+                positions=pending,
+                prompt_var_func_dict=prompt_var_func_dict,
+                prompt_module=prompt_module,
+                model=model,
                 example_df_file=example_df_file,
                 example_format_function=example_format_function,
-                essay_text=df_essay_row.full_text_clean,
-                **prompt_dict)
+                prompt_log=prompt_log,
+                max_concurrency=max_concurrency,
+                rate_limiter=rate_limiter,
+                llm_cache=llm_cache,
+                context_size=context_size,
+                max_essays_per_request=max_essays_per_request,
+                on_output=process_output)
+
+        if max_concurrency > 1 and not batch_result_file:
+            # Outputs are parsed as soon as the requests finish
+            asyncio.run(ainvoke_llm(
+                df_essay=df_essay.iloc[pending],
+                prompt_var_func_dict=prompt_var_func_dict,
+                chain_builder=chain_builder,
+                model=model,
+                prompt_log=prompt_log,
+                max_concurrency=max_concurrency,
+                rate_limiter=rate_limiter,
+                llm_cache=llm_cache,
+                on_output=lambda j, output: process_output(pending[j],
+                                                           output)))
+        else:
+            for i in tqdm(pending):
+                df_essay_row = essay_rows[i]
+                log.debug("")
+                log.debug(f"## Processing_essay {df_essay_row.essay_id} ##")
+
+                chain = chain_builder(df_essay_row)
+
+                # Set current essay text
+                prompt_var_dict = fill_prompt_var_dict(df_essay_row,
+                                                       prompt_var_func_dict)
+                log_prompt(prompt_log, df_essay_row.essay_id, chain,
+                           prompt_var_dict)
+
+                # Directly invoke chain
+                if not batch_result_file:
+                    output = None
+                    if llm_cache is not None:
+                        cache_key = llm_cache_key(chain, prompt_var_dict)
+                        output = llm_cache.get(cache_key)
+                    if output is None:
+                        # Invoke chain and get output string
+                        message = chain.invoke(prompt_var_dict)
+                        output = message.content
+                        # Write token usage to log
+                        prompt_log.debug(message.response_metadata)
+                        if llm_cache is not None:
+                            llm_cache.put(
+                                cache_key, output,
+                                get_model_params(model)["model_name"],
+                                message.response_metadata)
+                    else:
+                        prompt_log.debug("Output was read from the LLM "
+                                         "cache")
+                else:
+                    output = batch_output_dict.get(df_essay_row.essay_id, "")
+
+                process_output(i, output)
+
+        collect_parsing_results(wait=True)
+    finally:
+        if parse_pool is not None:
+            parse_pool.shutdown(cancel_futures=True)
+        if journal_handle is not None:
+            journal_handle.close()
+
+    # Merge the results of the essays in the order of df_essay
+    stats_dict = new_stats_dict()
+    result_rows = []
+    for essay_stats_dict, essay_result_rows, _ in essay_results:
+        merge_stats_dict(stats_dict, essay_stats_dict)
+        result_rows.extend(essay_result_rows)
+    result_df = build_result_df(result_rows)
+    essay_result_df = build_essay_result_df(
+        df_essay.essay_id, df_essay.full_text_clean,
+        [llm_output for _, _, llm_output in essay_results])
+
+    statistics_df = build_statistics_df(stats_dict, df_essay, df_du,
+                                        llm_cache)
+    write_parsing_results(result_df, statistics_df, output_dir,
+                          essay_result_df)
 
-        chain = prompt | model
+    return result_df, statistics_df
 
-        # Get additonal logger for prompts
-        prompt_log.debug(f"## Processing_essay {df_essay_row.essay_id} ##")
 
-        # Set current essay text
+async def ainvoke_llm(df_essay, prompt_var_func_dict, chain_builder, model,
+                      prompt_log, max_concurrency, rate_limiter=None,
+                      llm_cache=None, on_output=None):
+    """
+    Invoke the LLM asynchronously for all essays of df_essay with up to
+    max_concurrency requests in flight. If a rate_limiter is given, the
+    requests are scheduled by it instead, using the prompt tokens plus
+    max_tokens of each request as estimated token count. Requests found in
+    the llm_cache are not sent. If on_output is given, it is called with the
+    position of the essay in df_essay and the output as soon as a request
+    finishes. The chains are built by chain_builder (see
+    compile_chain_builder).
+
+    Returns
+    -------
+    list of str
+        LLM outputs in the order of the essays in df_essay.
+    """
+    chains = []
+    prompt_var_dicts = []
+    for i, df_essay_row in df_essay.iterrows():
+        chain = chain_builder(df_essay_row)
         prompt_var_dict = fill_prompt_var_dict(df_essay_row,
                                                prompt_var_func_dict)
-        # Write filled in prompt to log
-        filled_prompt = remove_special_characters(
-            chain.first.format(**prompt_var_dict))
-        prompt_log.debug(
-            f"--Full prompt:\n{filled_prompt}")
-        prompt_log.debug("--End of prompt\n")
-
-        # Directly invoke chain
-        if not batch_result_file:
-            # Invoke chain and get output string
-            message = chain.invoke(prompt_var_dict)
-            output = message.content
-            # Write token usage to log
-            prompt_log.debug(message.response_metadata)
+        log_prompt(prompt_log, df_essay_row.essay_id, chain, prompt_var_dict)
+        chains.append(chain)
+        prompt_var_dicts.append(prompt_var_dict)
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+    progress = tqdm(total=len(chains), desc="LLM requests")
+    model_params = get_model_params(model)
+
+    def _finish(i, output):
+        if on_output is not None:
+            on_output(i, output)
+        progress.update(1)
+        return output
+
+    async def _ainvoke(i, essay_id, chain, prompt_var_dict):
+        if llm_cache is not None:
+            cache_key = llm_cache_key(chain, prompt_var_dict)
+            output = llm_cache.get(cache_key)
+            if output is not None:
+                prompt_log.debug(f"## Output for essay {essay_id} was read "
+                                 f"from the LLM cache ##")
+                return _finish(i, output)
+        if rate_limiter is None:
+            async with semaphore:
+                message = await chain.ainvoke(prompt_var_dict)
         else:
-            output = llm_output_from_batch_file(
-                batch_result_file, df_essay_row.essay_id)
+            estimated_tokens = tokens.count_message_tokens(
+                chain.first.format_prompt(**prompt_var_dict).to_messages(),
+                model_params["model_name"]) \
+                + (model_params["max_tokens"] or 0)
+            message = await rate_limiter.run(
+                lambda: chain.ainvoke(prompt_var_dict), estimated_tokens)
+        prompt_log.debug(f"## Response for essay {essay_id} ##\n"
+                         f"{message.response_metadata}")
+        if llm_cache is not None:
+            llm_cache.put(cache_key, message.content,
+                          model_params["model_name"],
+                          message.response_metadata)
+        return _finish(i, message.content)
 
-        # print Output also to prompt log
-        prompt_log.debug(f"The LLM output was: "
-                         f"\n\n{remove_special_characters(output)}\n\n")
+    try:
+        # gather() returns the results in the order of the awaitables,
+        # independent of the order in which the requests finish
+        return await asyncio.gather(*[
+            _ainvoke(i, essay_id, chain, prompt_var_dict)
+            for i, (essay_id, chain, prompt_var_dict)
+            in enumerate(zip(df_essay.essay_id, chains, prompt_var_dicts))])
+    finally:
+        progress.close()
+
+
+def invoke_packed_llm(essay_rows, positions, prompt_var_func_dict,
+                      prompt_module, model, example_df_file,
+                      example_format_function, prompt_log, max_concurrency,
+                      rate_limiter=None, llm_cache=None, context_size=None,
+                      max_essays_per_request=8, on_output=None):
+    """
+    Invoke the LLM with several essays per request using the packed chat
+    prompt (see prompt_generation.assemblePackedChatPrompt). The essays at
+    the given positions of essay_rows are packed in order into requests
+    whose prompt fits into the context_size and whose estimated output fits
+    into max_tokens (see pack_essays). The output of every request is split
+    into the sections of its essays and on_output is called with the
+    position and the output of every essay.
 
-        stats_dict, result_df = parse_llm_result(
-            stats_dict=stats_dict,
-            essay_text=df_essay_row.full_text_clean,
-            essay_id=df_essay_row.essay_id,
-            parser_func=parser_func,
-            llm_output=output,
-            result_df=result_df,
-            fuzzysearch_factor=fuzzysearch_factor)
+    Returns
+    -------
+    list of int
+        Positions of the essays whose output could not be split apart. They
+        have to be processed individually.
+    """
+    if type(example_df_file) is int and example_df_file:
+        raise Exception("The packed prompt format does not support "
+                        "retrieved examples!")
+    model_params = get_model_params(model)
+    chain_builder = compile_chain_builder(
+        prompt_module=prompt_module,
+        model=model,
+        prompt_format="packed",
+        example_df_file=example_df_file,
+        example_format_function=example_format_function,
+        context_size=context_size)
+    pre_essay = prompt_module.prompt_dict.get("pre_essay", "Essay:")
+
+    # Tokens of every essay in the packed prompt
+    essay_blocks = {
+        i: prompt_generation.formatPackedEssays(
+            essay_rows[i].to_frame().T, pre_essay)
+        for i in positions}
+    base_tokens = prompt_generation.countPromptTokens(
+        chain_builder(essay_rows[positions[0]]).first,
+        model_params["model_name"]) if positions else 0
+    packs = pack_essays(
+        positions,
+        {i: tokens.count_tokens(essay_blocks[i], model_params["model_name"])
+         for i in positions},
+        base_tokens, context_size, model_params["max_tokens"],
+        max_essays_per_request)
+
+    # One row per request with the packed essays as essay text
+    df_pack = pd.DataFrame([
+        {**essay_rows[pack[0]].to_dict(),
+         "essay_id": ", ".join(essay_rows[i].essay_id for i in pack),
+         "full_text_clean": "\n\n".join(essay_blocks[i] for i in pack)}
+        for pack in packs])
+    log.info(f"{len(positions)} essays packed into {len(packs)} requests.")
+
+    not_split = []
+
+    def process_pack_output(j, output):
+        pack = packs[j]
+        essay_outputs = split_packed_output(
+            output, [essay_rows[i].essay_id for i in pack])
+        for i in pack:
+            if essay_rows[i].essay_id in essay_outputs:
+                on_output(i, essay_outputs[essay_rows[i].essay_id])
+            else:
+                not_split.append(i)
+
+    if packs:
+        asyncio.run(ainvoke_llm(
+            df_essay=df_pack,
+            prompt_var_func_dict=prompt_var_func_dict,
+            chain_builder=chain_builder,
+            model=model,
+            prompt_log=prompt_log,
+            max_concurrency=max_concurrency,
+            rate_limiter=rate_limiter,
+            llm_cache=llm_cache,
+            on_output=process_pack_output))
+    if not_split:
+        log.info(f"The outputs of {len(not_split)} essays could not be split "
+                 f"apart. These essays are processed individually.")
+    return sorted(not_split)
+
+
+def pack_essays(positions, essay_tokens, base_tokens, context_size,
+                max_tokens, max_essays_per_request):
+    """
+    Greedily pack consecutive essays into requests. A request is closed
+    before the prompt (base_tokens plus the tokens of its essays) and
+    max_tokens would exceed context_size, before the estimated output
+    (PACKED_OUTPUT_TOKEN_FACTOR tokens per essay token) would exceed
+    max_tokens or when it contains max_essays_per_request essays. Every
+    request contains at least one essay.
 
-    statistics_df = pd.DataFrame({
+    Returns
+    -------
+    list of list
+        Positions of the essays of every request.
+    """
+    packs = []
+    pack = []
+    input_tokens = base_tokens
+    output_tokens = 0
+    for i in positions:
+        fits = len(pack) < max_essays_per_request
+        if context_size:
+            fits = fits and input_tokens + essay_tokens[i] \
+                + (max_tokens or 0) <= context_size
+        if max_tokens:
+            fits = fits and output_tokens + essay_tokens[i] \
+                * PACKED_OUTPUT_TOKEN_FACTOR <= max_tokens
+        if pack and not fits:
+            packs.append(pack)
+            pack = []
+            input_tokens = base_tokens
+            output_tokens = 0
+        pack.append(i)
+        input_tokens += essay_tokens[i]
+        output_tokens += essay_tokens[i] * PACKED_OUTPUT_TOKEN_FACTOR
+    if pack:
+        packs.append(pack)
+    return packs
+
+
+def split_packed_output(output, essay_ids):
+    """
+    Split the output of a packed request into the sections of the essays.
+    A section starts with the line "### Essay <id>" (small deviations like
+    bold text or a colon are accepted).
+
+    Returns
+    -------
+    dict
+        Output section by essay id. Essays without a non-empty section or
+        with several sections are missing.
+    """
+    header_pattern = re.compile(
+        r"^[ \t>*#]*#+[ \t*]*Essay[ \t]+([^\s:*]+)[ \t:*]*$", re.MULTILINE)
+    headers = list(header_pattern.finditer(output))
+    sections = {}
+    duplicates = set()
+    for k, header in enumerate(headers):
+        end = headers[k + 1].start() if k + 1 < len(headers) else len(output)
+        essay_id = header.group(1)
+        if essay_id in sections:
+            duplicates.add(essay_id)
+        sections[essay_id] = output[header.end():end].strip()
+    return {essay_id: sections[essay_id] for essay_id in essay_ids
+            if sections.get(essay_id) and essay_id not in duplicates}
+
+
+def compile_chain_builder(prompt_module, model, prompt_format,
+                          example_df_file, example_format_function,
+                          context_size=None, fit_examples_to_context=False):
+    """
+    Compile the prompt template of the experiment once (see
+    prompt_generation.compilePrompt) and return a function that returns the
+    chain (prompt | model) for a row of df_essay. Chains are reused for all
+    essays sharing the same prompt template. If context_size is given,
+    prompts exceeding the context window are logged or, with
+    fit_examples_to_context, examples are dropped until the prompt fits.
+    """
+    model_params = get_model_params(model)
+    get_prompt = prompt_generation.compilePrompt(
+        prompt_format=prompt_format,
+        prompt_dict=prompt_module.prompt_dict,
+        example_df_file=example_df_file,
+        example_format_function=example_format_function,
+        context_size=context_size,
+        max_tokens=model_params["max_tokens"] or 0,
+        model_name=model_params["model_name"],
+        fit_examples=fit_examples_to_context)
+    chains = {}
+
+    def chain_builder(df_essay_row):
+        prompt = get_prompt(df_essay_row.full_text_clean,
+                            df_essay_row.essay_id)
+        # The compiled templates are kept alive by get_prompt, so their ids
+        # are unique
+        if id(prompt) not in chains:
+            chains[id(prompt)] = prompt | model
+        return chains[id(prompt)]
+    return chain_builder
+
+
+def get_model_params(model):
+    """
+    Return model name, temperature and max_tokens of a langchain chat model.
+    The attribute names differ between the chat model classes.
+    """
+    model_name = getattr(model, "model_name", None) \
+        or getattr(model, "model", None)
+    max_tokens = getattr(model, "max_tokens", None)
+    if max_tokens is None:
+        max_tokens = getattr(model, "num_predict", None)
+    return {"model_name": model_name,
+            "temperature": getattr(model, "temperature", None),
+            "max_tokens": max_tokens}
+
+
+def llm_cache_key(chain, prompt_var_dict):
+    """
+    Key of the request for the LLM cache built from the model parameters and
+    the fully rendered prompt messages.
+    """
+    return llm_cache_module.LLMResponseCache.make_key(
+        get_model_params(chain.last),
+        chain.first.format_prompt(**prompt_var_dict).to_messages())
+
+
+def log_prompt(prompt_log, essay_id, chain, prompt_var_dict):
+    """
+    Write the filled in prompt of an essay to the prompt log.
+    """
+    prompt_log.debug(f"## Processing_essay {essay_id} ##")
+    filled_prompt = remove_special_characters(
+        chain.first.format(**prompt_var_dict))
+    prompt_log.debug(
+        f"--Full prompt:\n{filled_prompt}")
+    prompt_log.debug("--End of prompt\n")
+
+
+def parse_llm_outputs(df_essay, df_du, llm_output_dict, parser_func,
+                      fuzzysearch_factor, output_dir="", fuzzy_budget=None,
+                      parse_workers=1):
+    """
+    Parse LLM outputs that were generated before (e.g., read from the journal
+    of an experiment) without invoking the LLM.
+
+    Parameters
+    ----------
+    df_essay : DataFrame
+        One row per essay that is evaluated.
+    df_du : DataFrame
+        Ground truth discourse units.
+    llm_output_dict : dict
+        LLM output by essay_id. Essays without output count as unparsable
+        and are reported in the statistics.
+    parser_func : function
+        Parser function according to the prompt template format.
+    fuzzysearch_factor : int
+        See match_not_verbatim_du.
+    output_dir : str, optional
+        Directory to write statistics_df.csv and result_df.csv to.
+    fuzzy_budget : dict, optional
+        See match_not_verbatim_du_within_budget. The default is None (no
+        budget).
+    parse_workers : int, optional
+        Number of worker processes parsing the outputs (see
+        new_parse_pool). The default is 1 (parsing in this process).
+
+    Returns
+    -------
+    tuple of DataFrame
+        result_df and statistics_df like invoke_llm.
+    """
+    essay_ids = [essay_id for essay_id in df_essay.essay_id
+                 if essay_id in llm_output_dict]
+    if parse_workers > 1:
+        with new_parse_pool(
+                dict(zip(df_essay.essay_id, df_essay.full_text_clean)),
+                parser_func, fuzzysearch_factor, fuzzy_budget,
+                parse_workers) as parse_pool:
+            essay_results = dict(zip(essay_ids, tqdm(parse_pool.map(
+                parse_essay_in_worker, essay_ids,
+                [llm_output_dict[essay_id] for essay_id in essay_ids],
+                chunksize=max(1, len(essay_ids) // (4 * parse_workers))),
+                total=len(essay_ids))))
+    else:
+        essay_texts = dict(zip(df_essay.essay_id, df_essay.full_text_clean))
+        essay_results = {}
+        for essay_id in tqdm(essay_ids):
+            log.debug("")
+            log.debug(f"## Parsing output of essay {essay_id} ##")
+            essay_results[essay_id] = parse_llm_result(
+                stats_dict=new_stats_dict(),
+                essay_text=essay_texts[essay_id],
+                essay_id=essay_id,
+                parser_func=parser_func,
+                llm_output=llm_output_dict[essay_id],
+                result_rows=[],
+                fuzzysearch_factor=fuzzysearch_factor,
+                fuzzy_budget=fuzzy_budget)
+
+    # Merge the results in the order of df_essay
+    stats_dict = new_stats_dict()
+    result_rows = []
+    for essay_id in df_essay.essay_id:
+        if essay_id not in essay_results:
+            log.debug(f"No LLM output available for essay {essay_id}.")
+            stats_dict["missing_llm_outputs"] += 1
+            stats_dict["syntax_err_list"].append("")
+            continue
+        essay_stats_dict, essay_result_rows = essay_results[essay_id]
+        merge_stats_dict(stats_dict, essay_stats_dict)
+        result_rows.extend(essay_result_rows)
+    result_df = build_result_df(result_rows)
+    essay_result_df = build_essay_result_df(
+        df_essay.essay_id, df_essay.full_text_clean,
+        [llm_output_dict.get(essay_id) for essay_id in df_essay.essay_id])
+
+    statistics_df = build_statistics_df(stats_dict, df_essay, df_du)
+    write_parsing_results(result_df, statistics_df, output_dir,
+                          essay_result_df)
+    return result_df, statistics_df
+
+
+# Essay texts and parser configuration of a parse worker process
+parse_worker_state = {}
+
+
+def new_parse_pool(essay_texts, parser_func, fuzzysearch_factor,
+                   fuzzy_budget=None, parse_workers=None):
+    """
+    Create a process pool for parsing LLM outputs with
+    parse_essay_in_worker. The essay texts and the parser configuration are
+    sent to every worker once, so the tasks only contain the essay_id and
+    the LLM output.
+
+    Parameters
+    ----------
+    essay_texts : dict
+        Essay text by essay_id.
+    parser_func : function
+        Parser function according to the prompt template format. It must
+        be defined at module level to be sent to the workers.
+    fuzzysearch_factor : int
+        See match_not_verbatim_du.
+    fuzzy_budget : dict, optional
+        See match_not_verbatim_du_within_budget.
+    parse_workers : int, optional
+        Number of worker processes. The default is the number of CPUs.
+
+    Returns
+    -------
+    ParsePool
+    """
+    return ParsePool(parse_workers, (essay_texts, parser_func,
+                                     fuzzysearch_factor, fuzzy_budget))
+
+
+class ParsePool(concurrent.futures.ProcessPoolExecutor):
+    """
+    Process pool of new_parse_pool. The workers are started with the spawn
+    method, so they do not inherit the event loop, the rate limiter state
+    or the logging handlers of this process. Their log records are sent
+    through a queue to the handlers of the main logger of this process,
+    which are fixed when the pool is created.
+
+    On Windows and with the spawn method in general, the pool must be
+    created from within an 'if __name__ == "__main__":' block.
+    """
+
+    def __init__(self, max_workers, initargs):
+        context = multiprocessing.get_context("spawn")
+        self.log_queue = context.Queue()
+        self.log_listener = logging.handlers.QueueListener(
+            self.log_queue, *log.handlers, respect_handler_level=True)
+        self.log_listener.start()
+        super().__init__(max_workers=max_workers, mp_context=context,
+                         initializer=init_parse_worker,
+                         initargs=(self.log_queue, *initargs))
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        super().shutdown(wait=wait, cancel_futures=cancel_futures)
+        # The records of the workers are forwarded until they exited
+        if self.log_listener is not None:
+            self.log_listener.stop()
+            self.log_listener = None
+
+
+def init_parse_worker(log_queue, essay_texts, parser_func,
+                      fuzzysearch_factor, fuzzy_budget):
+    """
+    Send the log records of a parse worker to the log_queue and store the
+    essay texts and the parser configuration in the worker.
+    """
+    log.handlers.clear()
+    log.addHandler(logging.handlers.QueueHandler(log_queue))
+    log.setLevel(logging.DEBUG)
+    log.propagate = False
+    parse_worker_state["essay_texts"] = essay_texts
+    parse_worker_state["parser_func"] = parser_func
+    parse_worker_state["fuzzysearch_factor"] = fuzzysearch_factor
+    parse_worker_state["fuzzy_budget"] = fuzzy_budget
+
+
+def parse_essay_in_worker(essay_id, llm_output):
+    """
+    Parse the LLM output of an essay in a parse worker.
+
+    Returns
+    -------
+    tuple
+        stats_dict and result rows of the essay (see parse_llm_result).
+    """
+    return parse_llm_result(
+        stats_dict=new_stats_dict(),
+        essay_text=parse_worker_state["essay_texts"][essay_id],
+        essay_id=essay_id,
+        parser_func=parse_worker_state["parser_func"],
+        llm_output=llm_output,
+        result_rows=[],
+        fuzzysearch_factor=parse_worker_state["fuzzysearch_factor"],
+        fuzzy_budget=parse_worker_state["fuzzy_budget"])
+
+
+def build_statistics_df(stats_dict, df_essay, df_du, llm_cache=None):
+    """
+    Build the data frame with the parsing statistics of an experiment.
+    """
+    return pd.DataFrame({
         "Total DUs in ground truth":
             len(df_du[df_du["essay_id"].isin(df_essay.essay_id)]),
         "Total classified DUs": stats_dict["total_classified_du"],
@@ -112,72 +794,229 @@ def invoke_llm(df_essay, df_du, prompt_var_func_dict, parser_func,
             - stats_dict["total_verbatim_du"],
         "Non-verbatim DUs matched with fuzzysearch":
             stats_dict["total_matched_not_verbatim_du"],
+        "Fuzzy matching budget hits": stats_dict["fuzzy_budget_hits"],
         "Total Number of essays": len(df_essay),
         "Number of unparsable essays": len(stats_dict["syntax_err_list"]),
+        "Number of essays without LLM output":
+            stats_dict["missing_llm_outputs"],
+        "Discourse type table hits": stats_dict["discourse_type_table_hits"],
+        "Unknown discourse types": stats_dict["unknown_discourse_types"],
+        "LLM cache hits": llm_cache.hits if llm_cache is not None else 0,
+        "LLM cache misses":
+            llm_cache.misses if llm_cache is not None else 0,
         }, index=[0])
 
+
+def write_parsing_results(result_df, statistics_df, output_dir,
+                          essay_result_df=None):
+    """
+    Write result_df, statistics_df and essay_result_df to the output_dir
+    and log the statistics.
+    """
     if output_dir:
         statistics_df.to_csv(os.path.join(output_dir, "statistics_df.csv"))
         result_df.to_csv(os.path.join(output_dir, "result_df.csv"))
+        if essay_result_df is not None:
+            essay_result_df.to_csv(os.path.join(output_dir,
+                                                "essay_result_df.csv"))
 
     log.info(f"\nParsing info:\n"
              f"{statistics_df.transpose().to_string(header=False)}\n")
 
-    return result_df, statistics_df
+
+def read_llm_outputs(experiment_dir):
+    """
+    Read the raw LLM outputs of a previous experiment from its journal. For
+    experiments without journal the outputs are taken from
+    essay_result_df.csv or, for older experiments, from result_df.csv,
+    which only contains essays with at least one parsed discourse unit.
+
+    Returns
+    -------
+    dict
+        LLM output by essay_id.
+    """
+    journal = read_journal(os.path.join(experiment_dir, JOURNAL_FILE_NAME))
+    if journal:
+        return {essay_id: record["llm_output"]
+                for essay_id, record in journal.items()}
+    essay_result_file = os.path.join(experiment_dir, "essay_result_df.csv")
+    if os.path.isfile(essay_result_file):
+        essay_result_df = pd.read_csv(essay_result_file, index_col=0,
+                                      keep_default_na=False)
+        return dict(zip(essay_result_df.essay_id, essay_result_df.llm_output))
+    result_file = os.path.join(experiment_dir, "result_df.csv")
+    if not os.path.isfile(result_file):
+        raise FileNotFoundError(f"Neither {JOURNAL_FILE_NAME} nor "
+                                f"result_df.csv found in {experiment_dir}.")
+    log.warning(f"No {JOURNAL_FILE_NAME} found in {experiment_dir}. Outputs "
+                f"are read from result_df.csv, where essays without any "
+                f"parsed discourse unit are missing. They are scored as "
+                f"essays without LLM output.")
+    result_df = pd.read_csv(result_file, index_col=0).drop_duplicates(
+        "essay_id")
+    return dict(zip(result_df.essay_id, result_df.llm_output))
+
+
+def new_stats_dict():
+    """
+    Return an empty dict for the parsing statistics.
+    """
+    stats_dict = {}
+    stats_dict["total_classified_du"] = 0
+    stats_dict["total_verbatim_du"] = 0
+    stats_dict["total_matched_not_verbatim_du"] = 0
+    stats_dict["fuzzy_budget_hits"] = 0
+    stats_dict["missing_llm_outputs"] = 0
+    stats_dict["discourse_type_table_hits"] = 0
+    stats_dict["unknown_discourse_types"] = 0
+    stats_dict["syntax_err_list"] = []
+    return stats_dict
+
+
+def merge_stats_dict(stats_dict, other_stats_dict):
+    """
+    Add the parsing statistics of other_stats_dict to stats_dict.
+    """
+    for key, value in other_stats_dict.items():
+        stats_dict[key] += value
+    return stats_dict
+
+
+def new_result_df():
+    """
+    Return an empty result data frame.
+    """
+    return build_result_df([])
+
+
+def build_result_df(result_rows):
+    """
+    Build the result data frame once from the parsed discourse units
+    (tuples with the RESULT_COLUMNS) of all essays.
+    """
+    return pd.DataFrame(result_rows, columns=RESULT_COLUMNS)
+
+
+def build_essay_result_df(essay_ids, essay_texts, llm_outputs):
+    """
+    Build the essay result table with the essay text and the LLM output of
+    every essay (ESSAY_RESULT_COLUMNS). Essays without output are left out.
+    """
+    return pd.DataFrame(
+        [(essay_id, essay_text, llm_output) for essay_id, essay_text,
+         llm_output in zip(essay_ids, essay_texts, llm_outputs)
+         if llm_output is not None],
+        columns=ESSAY_RESULT_COLUMNS)
+
+
+def write_journal_record(journal_handle, essay_id, llm_output, stats_dict,
+                         result_rows):
+    """
+    Append the LLM output, the parsing statistics and the parsed discourse
+    units of an essay to the journal and flush it to disk.
+    """
+    record = {
+        "essay_id": essay_id,
+        "llm_output": llm_output,
+        "stats": {key: value for key, value in stats_dict.items()
+                  if key != "syntax_err_list"},
+        "syntax_error": len(stats_dict["syntax_err_list"]) > 0,
+        "rows": [list(row[1:]) for row in result_rows],
+        }
+    journal_handle.write(json.dumps(record, default=int) + "\n")
+    journal_handle.flush()
+
+
+def read_journal(journal_file):
+    """
+    Read the journal of an experiment.
+
+    Returns
+    -------
+    dict
+        Journal records by essay_id. Lines that were not completely written
+        (e.g., because the process was killed) are ignored.
+    """
+    journal = {}
+    if not os.path.isfile(journal_file):
+        return journal
+    with open(journal_file, "r", encoding="utf-8") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            journal[record["essay_id"]] = record
+    return journal
+
+
+def restore_journal_record(record):
+    """
+    Return the stats_dict and result rows of an essay from its journal
+    record.
+    """
+    stats_dict = new_stats_dict()
+    stats_dict.update(record["stats"])
+    if record["syntax_error"]:
+        stats_dict["syntax_err_list"].append(record["llm_output"])
+    result_rows = [(record["essay_id"], *row) for row in record["rows"]]
+    return stats_dict, result_rows
 
 
 def parse_llm_result(stats_dict, essay_text, essay_id, parser_func, llm_output,
-                     result_df, fuzzysearch_factor):
+                     result_rows, fuzzysearch_factor, fuzzy_budget=None):
     """
-    Parse the output of the LLM with the parser_func and create a result
-    dataframe.
+    Parse the output of the LLM with the parser_func and append the
+    discourse units as tuples (see RESULT_COLUMNS) to result_rows.
+    Non-verbatim discourse units are matched within the fuzzy_budget (see
+    match_not_verbatim_du_within_budget) if one is given. The discourse
+    types of the parser are normalised here (once per discourse unit), and
+    the table hits and unknown labels of the discourse_type_normaliser are
+    added to the stats_dict (also when parsing in a worker process, whose
+    normaliser counts separately).
     """
+    counters_before = discourse_type_normaliser.counters()
+    essay_deadline = None
+    if fuzzy_budget and fuzzy_budget.get("max_essay_seconds") is not None:
+        essay_deadline = time.perf_counter() \
+            + fuzzy_budget["max_essay_seconds"]
     try:
         # Use parser to get output dict like {<du_text>: <du_type>}
         output_dict = parser_func(llm_output)
 
         verbatim_counter = 0
         matched_not_verbatim_counter = 0
-        for span, du_type in output_dict.items():
+        verbatim_starts = locate_verbatim_spans(list(output_dict),
+                                                essay_text)
+        for (span, du_type), discourse_start in zip(output_dict.items(),
+                                                    verbatim_starts):
             # Write discourse units, that were generated verbatim by LLM
             # and write them to new result df
-            if span in essay_text:
+            if discourse_start is not None:
                 verbatim_counter += 1
-                result_df = pd.concat(
-                    [result_df, pd.DataFrame(
-                        {"essay_id": essay_id,
-                         "discourse_start": essay_text.find(span),
-                         "discourse_end":
-                             essay_text.find(span) + len(span),
-                         "discourse_text": span,
-                         "discourse_type": parse_discourse_type(du_type),
-                         "llm_output": llm_output,
-                         "original_essay_text": essay_text,
-                         }, index=[0])],
-                    ignore_index=True)
+                result_rows.append((essay_id, discourse_start,
+                                    discourse_start + len(span), span,
+                                    parse_discourse_type(du_type)))
             # Use fuzzysearch to match non-verbatim discourse units and
             # also write them to result df
             else:
                 log.debug(f"\nmatch_not_verbatim_du() of span:\n"
                           f"{remove_special_characters(span)}")
-                matches = match_not_verbatim_du(
-                    span, essay_text, fuzzysearch_factor)
+                if fuzzy_budget:
+                    matches, budget_hit = match_not_verbatim_du_within_budget(
+                        span, essay_text, fuzzysearch_factor, fuzzy_budget,
+                        essay_deadline)
+                    stats_dict["fuzzy_budget_hits"] += budget_hit
+                else:
+                    matches = match_not_verbatim_du(
+                        span, essay_text, fuzzysearch_factor)
                 if len(matches) == 1:
                     matched_not_verbatim_counter += 1
                     log.debug("+ match of non-verbatim span successful")
-                    result_df = pd.concat(
-                        [result_df, pd.DataFrame(
-                            {"essay_id": essay_id,
-                             "discourse_start": matches[0].start,
-                             "discourse_end": matches[0].end,
-                             "discourse_text": matches[0].matched,
-                             "discourse_type":
-                                 parse_discourse_type(du_type),
-                             "llm_output": llm_output,
-                             "original_essay_text": essay_text,
-                             "llm_prompt": essay_text,
-                             }, index=[0])],
-                        ignore_index=True)
+                    result_rows.append((essay_id, matches[0].start,
+                                        matches[0].end, matches[0].matched,
+                                        parse_discourse_type(du_type)))
                 else:
                     log.debug("- non-verbatim span could not be matched")
         log.debug(f"\nVerbatim discourse units in essay: "
@@ -204,7 +1043,12 @@ def parse_llm_result(stats_dict, essay_text, essay_id, parser_func, llm_output,
                   f"was:\n\n{remove_special_characters(llm_output)}\n\n")
         stats_dict["syntax_err_list"].append(llm_output)
 
-    return stats_dict, result_df
+    counters = discourse_type_normaliser.counters()
+    stats_dict["discourse_type_table_hits"] += \
+        counters["table_hits"] - counters_before["table_hits"]
+    stats_dict["unknown_discourse_types"] += \
+        counters["unknown_labels"] - counters_before["unknown_labels"]
+    return stats_dict, result_rows
 
 
 def remove_special_characters(span):
@@ -219,119 +1063,265 @@ def remove_special_characters(span):
 def write_batch_file(df_essay, df_du, prompt_var_func_dict, parser_func,
                      prompt_module, model, prompt_format,
                      example_df_file, example_format_function, exp_string="",
-                     output_dir="", numOfEssaysPerBatchFile=None):
+                     output_dir="", numOfEssaysPerBatchFile=None,
+                     maxBatchFileMB=BATCH_API_MAX_FILE_MB,
+                     maxTokensPerBatchFile=None, compress=False,
+                     context_size=None, fit_examples_to_context=False):
     """
     Write batch file for OpenAI Batch-API
-    """
-    tasks = []
 
-    for i, df_essay_row in tqdm(df_essay.iterrows(),
-                                total=df_essay.shape[0]):
-        prompt_var_dict = fill_prompt_var_dict(df_essay_row,
-                                               prompt_var_func_dict)
-        # prompt = chain.first.format(**prompt_var_dict)
+    Every task is written as soon as its prompt is rendered. A new batch
+    file is started before a file would exceed numOfEssaysPerBatchFile
+    requests (at most the 50,000 requests accepted by the Batch API),
+    maxBatchFileMB or maxTokensPerBatchFile prompt tokens (e.g., the
+    enqueued token limit of the account). If more than one file is
+    written, the files are numbered. context_size and
+    fit_examples_to_context are used as in invoke_llm.
 
-        prompt_dict = prompt_module.prompt_dict
-        if prompt_format == "simple":
-            prompt = prompt_generation.assembleSimplePrompt(
-                example_df_file=example_df_file,
-                example_format_function=example_format_function,
-                essay_text=df_essay_row.full_text_clean,
-                **prompt_dict)
-        elif prompt_format == "chat":
-            prompt = prompt_generation.assembleChatPrompt(
-                example_df_file=example_df_file,
-                example_format_function=example_format_function,
-                essay_text=df_essay_row.full_text_clean,
-                **prompt_dict)
-        elif prompt_format == "CoT":
-            prompt = prompt_generation.assembleCoTPrompt(
-                example_df_file=example_df_file,
-                example_format_function=example_format_function,
-                essay_text=df_essay_row.full_text_clean,
-                **prompt_dict)
-
-        chain = prompt | model
-
-        # Create message list in correct format for json dump
-        messages = []
-        if chain.first.__class__.__name__ == 'ChatPromptTemplate':
-            for message in chain.first.format_messages(**prompt_var_dict):
-                # Translate keys used by langchain to the roles used by OpenAI
-                if message.type == "system":
-                    role = "system"
-                elif message.type == "ai":
-                    role = "assistant"
-                elif message.type == "human":
-                    role = "user"
-                else:
-                    raise Exception("Unknown or not inplemented message type.")
-                messages.append({
-                    "role": role,
-                    "content": message.content})
-        elif chain.first.__class__.__name__ == 'PromptTemplate':
-            messages.append({
-                "role": "user",
-                "content": chain.first.format(**prompt_var_dict)})
-
-        task = {
-            "custom_id": df_essay_row.essay_id,
-            "method": "POST",
-            "url": "/v1/chat/completions",
-            "body": {
-                "model": chain.last.model_name,
-                "temperature": chain.last.temperature,
-                "max_tokens": chain.last.max_tokens,
-                "messages": messages,
-                }
-            }
-        tasks.append(task)
-
-    # Creating the file
-    if numOfEssaysPerBatchFile is None:
-        file_name = os.path.join(output_dir, f"batch_{exp_string}.jsonl")
-        with open(file_name, 'w') as file:
-            for obj in tasks:
-                file.write(json.dumps(obj) + '\n')
-    elif numOfEssaysPerBatchFile > 0:
-        fileNr = 0
-        for i, obj in enumerate(tasks):
-            file_name = os.path.join(output_dir,
-                                     f"batch_{exp_string}_{fileNr}.jsonl")
-            if (i + 1) % numOfEssaysPerBatchFile == 0:
-                fileNr += 1
-            with open(file_name, 'a') as file:
-                file.write(json.dumps(obj) + '\n')
-    else:
+    Returns
+    -------
+    list of str
+        Paths of the written batch files.
+    """
+    if numOfEssaysPerBatchFile is not None and numOfEssaysPerBatchFile <= 0:
         raise Exception("numOfEssaysPerBatchFile must be None or positve "
                         "integer!")
+    if prompt_format == "packed":
+        raise Exception("The packed prompt format can not be used for batch "
+                        "files!")
+    max_requests = BATCH_API_MAX_REQUESTS
+    if numOfEssaysPerBatchFile is not None:
+        max_requests = min(numOfEssaysPerBatchFile, max_requests)
+    writer = BatchFileWriter(
+        os.path.join(output_dir, f"batch_{exp_string}"),
+        max_requests=max_requests,
+        max_bytes=maxBatchFileMB * 1024 * 1024 if maxBatchFileMB else None,
+        max_tokens=maxTokensPerBatchFile,
+        compress=compress,
+        numbered=numOfEssaysPerBatchFile is not None)
+    chain_builder = compile_chain_builder(
+        prompt_module=prompt_module,
+        model=model,
+        prompt_format=prompt_format,
+        example_df_file=example_df_file,
+        example_format_function=example_format_function,
+        context_size=context_size,
+        fit_examples_to_context=fit_examples_to_context)
+
+    try:
+        for i, df_essay_row in tqdm(df_essay.iterrows(),
+                                    total=df_essay.shape[0]):
+            prompt_var_dict = fill_prompt_var_dict(df_essay_row,
+                                                   prompt_var_func_dict)
+
+            chain = chain_builder(df_essay_row)
+
+            messages = batch_messages(chain, prompt_var_dict)
+            task = {
+                "custom_id": df_essay_row.essay_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": chain.last.model_name,
+                    "temperature": chain.last.temperature,
+                    "max_tokens": chain.last.max_tokens,
+                    "messages": messages,
+                    }
+                }
+            num_tokens = 0
+            if maxTokensPerBatchFile:
+                num_tokens = tokens.count_message_tokens(
+                    messages, chain.last.model_name)
+            writer.write(task, num_tokens)
+    finally:
+        file_names = writer.close()
+    log.info(f"{len(df_essay)} tasks written to {len(file_names)} batch "
+             f"file(s).")
+    return file_names
+
+
+def batch_messages(chain, prompt_var_dict):
+    """
+    Create message list in correct format for json dump
+    """
+    messages = []
+    if chain.first.__class__.__name__ == 'ChatPromptTemplate':
+        for message in chain.first.format_messages(**prompt_var_dict):
+            # Translate keys used by langchain to the roles used by OpenAI
+            if message.type == "system":
+                role = "system"
+            elif message.type == "ai":
+                role = "assistant"
+            elif message.type == "human":
+                role = "user"
+            else:
+                raise Exception("Unknown or not inplemented message type.")
+            messages.append({
+                "role": role,
+                "content": message.content})
+    elif chain.first.__class__.__name__ == 'PromptTemplate':
+        messages.append({
+            "role": "user",
+            "content": chain.first.format(**prompt_var_dict)})
+    return messages
+
+
+class BatchFileWriter:
+    """
+    Stream batch tasks to one or more JSONL files (shards).
+
+    A new shard is started before the current one would exceed max_requests
+    tasks, max_bytes or max_tokens. The first shard is written to
+    <file_prefix>.jsonl and renamed to <file_prefix>_0.jsonl as soon as a
+    second shard is needed, unless numbered is True.
 
+    Parameters
+    ----------
+    file_prefix : str
+        Path of the batch files without extension.
+    max_requests : int, optional
+        Max number of tasks per file.
+    max_bytes : int, optional
+        Max size of the (uncompressed) file.
+    max_tokens : int, optional
+        Max sum of the token counts given to write().
+    compress : bool, optional
+        Write gzip compressed files (.jsonl.gz).
+    numbered : bool, optional
+        Always number the files, even if only one file is written.
+    """
 
-def llm_output_from_batch_file(batch_result_file, essay_id):
+    def __init__(self, file_prefix, max_requests=None, max_bytes=None,
+                 max_tokens=None, compress=False, numbered=False):
+        self.file_prefix = file_prefix
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.max_tokens = max_tokens
+        self.compress = compress
+        self.numbered = numbered
+        self.file_names = []
+        self._file = None
+
+    def _file_name(self, file_nr):
+        extension = ".jsonl.gz" if self.compress else ".jsonl"
+        if file_nr is None:
+            return f"{self.file_prefix}{extension}"
+        return f"{self.file_prefix}_{file_nr}{extension}"
+
+    def _open_next_file(self):
+        if self._file is not None:
+            self._file.close()
+        if len(self.file_names) == 1 and not self.numbered:
+            # Number the first file as well now that there are several
+            os.replace(self.file_names[0], self._file_name(0))
+            self.file_names[0] = self._file_name(0)
+        if self.numbered or self.file_names:
+            file_name = self._file_name(len(self.file_names))
+        else:
+            file_name = self._file_name(None)
+        if self.compress:
+            self._file = gzip.open(file_name, 'wb')
+        else:
+            self._file = open(file_name, 'wb')
+        self.file_names.append(file_name)
+        self._requests = 0
+        self._bytes = 0
+        self._tokens = 0
+
+    def write(self, task, num_tokens=0):
+        line = (json.dumps(task) + '\n').encode("utf-8")
+        if self._file is None or (
+                self._requests > 0 and (
+                    (self.max_requests
+                     and self._requests + 1 > self.max_requests)
+                    or (self.max_bytes
+                        and self._bytes + len(line) > self.max_bytes)
+                    or (self.max_tokens
+                        and self._tokens + num_tokens > self.max_tokens))):
+            self._open_next_file()
+        self._file.write(line)
+        self._requests += 1
+        self._bytes += len(line)
+        self._tokens += num_tokens
+
+    def close(self):
+        """
+        Close the current file and return the paths of all written files.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        return self.file_names
+
+
+def read_batch_result_files(batch_result_files):
     """
-    Retrieve output generated by the OpenAI model for a specified essay
-    from a batch file.
+    Read the outputs of one or more OpenAI batch result files (e.g., the
+    shards of an experiment) in a single pass.
 
     Parameters
     ----------
-    batch_result_file : str
-        Path to batch file.
-    essay_id : str
-        essay_id of the essay which was classified.
+    batch_result_files : str or list of str
+        Path(s) to batch result files. A path may contain wildcards to
+        match several shards.
 
     Returns
     -------
-    str
-        llm_output for the essay, which was to be classified.
+    tuple of dict
+        LLM output by custom_id (essay_id) and error message by custom_id
+        for requests that failed. A successful result overrides an error of
+        the same custom_id from another file (e.g., a resubmission).
     """
-    with open(batch_result_file, 'r') as file:
-        for line in file:
-            # Parsing the JSON string into a dict and appending to the list of
-            # results
-            json_object = json.loads(line.strip())
-            if json_object['custom_id'] == essay_id:
-                return json_object[
-                    'response']['body']['choices'][0]['message']['content']
+    if isinstance(batch_result_files, str):
+        batch_result_files = [batch_result_files]
+    file_list = []
+    for file_pattern in batch_result_files:
+        matched_files = sorted(glob.glob(file_pattern))
+        file_list.extend(matched_files if matched_files else [file_pattern])
+
+    output_dict = {}
+    error_dict = {}
+    for file_name in file_list:
+        open_func = gzip.open if file_name.endswith(".gz") else open
+        with open_func(file_name, 'rt') as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                json_object = json.loads(line)
+                custom_id = json_object['custom_id']
+                response = json_object.get('response') or {}
+                if json_object.get('error') \
+                        or response.get('status_code', 200) != 200:
+                    if custom_id not in output_dict:
+                        error_dict[custom_id] = str(
+                            json_object.get('error')
+                            or response.get('body', {}).get('error'))
+                    continue
+                output_dict[custom_id] = \
+                    response['body']['choices'][0]['message']['content']
+                error_dict.pop(custom_id, None)
+    return output_dict, error_dict
+
+
+def report_missing_batch_outputs(essay_ids, output_dict, error_dict):
+    """
+    Log the essays without output in the batch results.
+
+    Returns
+    -------
+    list
+        essay_ids without output.
+    """
+    missing_ids = [essay_id for essay_id in essay_ids
+                   if essay_id not in output_dict]
+    if missing_ids:
+        log.warning(f"{len(missing_ids)} of {len(essay_ids)} essays have no "
+                    f"output in the batch results. They are evaluated with "
+                    f"an empty output.")
+        for essay_id in missing_ids:
+            error = error_dict.get(essay_id, "missing in batch results")
+            log.debug(f"{essay_id}: {error}")
+    return missing_ids
 
 
 def write_metrics_statistics_to_excel_overview(
@@ -363,6 +1353,8 @@ def write_metrics_statistics_to_excel_overview(
                            float_format="%.2f")
 
     # Basic formatting of excel sheet with openpyxl
+    import openpyxl
+    from openpyxl.styles import PatternFill, Alignment
     wb = openpyxl.load_workbook(file_path)
     ws = wb.worksheets[0]
     for row in (9, 17):
@@ -378,12 +1370,91 @@ def write_metrics_statistics_to_excel_overview(
 
 
 def parser_python_dict(llm_output):
+    """
+    Parse LLM output in the format of a Python dictionary like
+    {"span": "type", ...} without evaluating it. The "key": "value" pairs
+    are read one after the other from the first opening brace to the
+    closing brace of the dictionary. After a malformed pair the parser
+    continues at the next pair boundary (a quote followed by a comma and a
+    quote or a line starting with a quote), so the other pairs and the
+    pairs before the end of a truncated output are recovered. Doubled
+    braces ({{ }}) and both quote styles are accepted.
+
+    Raises
+    ------
+    SyntaxError
+        If the output contains neither a pair nor an empty dictionary.
+
+    Returns
+    -------
+    dict
+        Discourse type by text of every discourse unit.
+    """
+    output_dict = {}
+    position = llm_output.find("{") + 1
+    while position < len(llm_output):
+        match = PYTHON_DICT_PAIR_PATTERN.match(llm_output, position)
+        if match is None:
+            match = PYTHON_DICT_RESYNC_PATTERN.search(llm_output, position)
+            if match is None or match.group("end") is not None:
+                break
+        else:
+            quote = match.group("quote")
+            output_dict[_read_string_literal(
+                quote + match.group("key") + quote)] = \
+                _read_string_literal(match.group("value_quote")
+                                     + match.group("value")
+                                     + match.group("value_quote"))
+            if match.group("end") is not None:
+                break
+        position = match.end()
+    if not output_dict and not re.fullmatch(
+            r"\s*(```python)?\s*\{+\s*\}+\s*(```)?\s*", llm_output):
+        raise SyntaxError("No dictionary found in the LLM output")
+    return output_dict
+
+
+def parser_python_dict_reference(llm_output):
+    """
+    Previous implementation of parser_python_dict, which evaluates the
+    output. Only use it for benchmarks on trusted outputs.
+    """
     llm_output = llm_output.replace(
         r"```python", "").replace("```", "").strip()
     return eval(llm_output)
 
 
+def _read_string_literal(token):
+    """
+    Return the value of a quoted string token of parser_python_dict.
+    """
+    if "\\" not in token:
+        return token[1:-1]
+    try:
+        return ast.literal_eval(token)
+    except (SyntaxError, ValueError):
+        return token[1:-1]
+
+
 def parser_XML(llm_output):
+    """
+    Parse the XML-like output of the LLM (see parse_xml_spans).
+
+    Returns
+    -------
+    dict
+        Tag name by text of every discourse unit. The tag names are
+        normalised to discourse types by parse_llm_result.
+    """
+    return {llm_output[start:end]: tag
+            for start, end, tag in parse_xml_spans(llm_output)}
+
+
+def parser_XML_reference(llm_output):
+    """
+    Regular expression implementation of parser_XML. Reference for tests
+    and benchmarks.
+    """
     output_dict = {}
     matches = re.finditer(r"<\/?([^>]+)>", llm_output)
     last_tag = ""
@@ -399,8 +1470,7 @@ def parser_XML(llm_output):
         else:
             is_start_tag = False
             if not is_start_tag and tag == last_tag:
-                output_dict[llm_output[last_end_pos: start_pos]] = \
-                    parse_discourse_type(tag)
+                output_dict[llm_output[last_end_pos: start_pos]] = tag
 
         # Set state for next iteration
         last_tag = tag
@@ -408,6 +1478,57 @@ def parser_XML(llm_output):
     return output_dict
 
 
+def parse_xml_spans(llm_output):
+    """
+    Find the text enclosed by a pair of tags like <Claim>...</Claim> in the
+    LLM output. Only the innermost pair of nested tags encloses a discourse
+    unit; text with tags inside and unclosed tags are ignored.
+
+    Returns
+    -------
+    list of tuple
+        Start and end offset of the enclosed text in llm_output and the tag
+        name, in the order of the output.
+    """
+    spans = []
+    last_tag = None
+    last_end = 0
+    for start, end, tag, is_closing_tag in tokenize_xml_tags(llm_output):
+        if is_closing_tag and tag == last_tag:
+            spans.append((last_end, start, tag))
+        last_tag = tag
+        last_end = end
+    return spans
+
+
+def tokenize_xml_tags(llm_output):
+    """
+    Yield every tag of the LLM output in a single pass. A tag is any
+    non-empty text between "<" and the next ">". It is a closing tag if it
+    starts with "/" followed by the tag name.
+
+    Yields
+    ------
+    tuple
+        Start and end offset of the tag in llm_output, the tag name and
+        whether it is a closing tag.
+    """
+    find = llm_output.find
+    start = find("<")
+    while start != -1:
+        end = find(">", start + 1)
+        if end == -1:
+            return
+        # "<>" is no tag
+        if end == start + 1:
+            start = find("<", end)
+            continue
+        is_closing_tag = llm_output[start + 1] == "/" and end > start + 2
+        yield (start, end + 1, llm_output[start + 1 + is_closing_tag:end],
+               is_closing_tag)
+        start = find("<", end + 1)
+
+
 def parser_TANL(llm_output):
     output_dict = {}
     matches = re.finditer(r"([^\[\]\|]+)\|([^\]]+)\]", llm_output)
@@ -416,15 +1537,352 @@ def parser_TANL(llm_output):
     return output_dict
 
 
+def locate_verbatim_spans(spans, essay_text):
+    """
+    Locate the spans that occur verbatim in the essay. Spans that occur
+    several times are placed in the order of the LLM output: the first
+    occurrence after the previously placed span that does not overlap a
+    placed span is taken. If there is none (e.g., the spans are not in
+    essay order), the first non-overlapping occurrence and finally the
+    first occurrence is taken.
+
+    Parameters
+    ----------
+    spans : list of str
+        Spans in the order of the LLM output.
+    essay_text : str
+        Text of the essay.
+
+    Returns
+    -------
+    list
+        Start index of every span or None if it does not occur verbatim.
+    """
+    starts = []
+    # Sorted (start, end) of the placed spans
+    placed = []
+    cursor = 0
+
+    def overlaps(start, end):
+        i = bisect.bisect_left(placed, (start, end))
+        return (i > 0 and placed[i - 1][1] > start) \
+            or (i < len(placed) and placed[i][0] < end)
+
+    def first_free_occurrence(span, start, stop):
+        start = essay_text.find(span, start)
+        while start != -1 and start < stop:
+            if not overlaps(start, start + len(span)):
+                return start
+            start = essay_text.find(span, start + 1)
+        return -1
+
+    for span in spans:
+        start = essay_text.find(span)
+        if start == -1 or not span:
+            starts.append(None if start == -1 else start)
+            continue
+        free_start = first_free_occurrence(span, max(start, cursor),
+                                           len(essay_text))
+        if free_start == -1:
+            free_start = first_free_occurrence(span, start, cursor)
+        if free_start != -1:
+            start = free_start
+            bisect.insort(placed, (start, start + len(span)))
+            if start >= cursor:
+                cursor = start + len(span)
+        starts.append(start)
+    return starts
+
+
 def match_not_verbatim_du(span, full_essay, fuzzysearch_factor=10):
     """
-    Invoke fuzzysearch matching
+    Invoke fuzzysearch matching (see align_not_verbatim_du)
+    """
+    return align_not_verbatim_du(span, full_essay, fuzzysearch_factor)
+
+
+def match_not_verbatim_du_full_scan(span, full_essay, fuzzysearch_factor=10):
+    """
+    Invoke fuzzysearch matching on the whole essay. Reference for
+    align_not_verbatim_du.
     """
     matches = fuzzysearch.find_near_matches(
         span, full_essay, max_l_dist=int(len(span) / fuzzysearch_factor))
     return matches
 
 
+def align_not_verbatim_du(span, full_essay, fuzzysearch_factor=10,
+                          deadline=None):
+    """
+    Anchor-and-extend alternative to scanning the whole essay with
+    fuzzysearch. The span is split into max_l_dist + 1 pieces. A match with
+    at most max_l_dist edits contains at least one of them verbatim, so the
+    exact occurrences of the pieces (anchors) give the candidate start
+    positions of the span (diagonals). Nearby diagonals are grouped and the
+    span is aligned to the essay within a band of max_l_dist diagonals
+    around every group (see _banded_alignments). Spans without anchors have
+    no match. Spans whose pieces are shorter than ALIGN_MIN_ANCHOR_LENGTH
+    are aligned to the whole essay. The alignment runs in this process and
+    checks the deadline every 64 characters of the span, so it stops in
+    time without a child process.
+
+    If the windows around the groups cover more than
+    ALIGN_MAX_WINDOW_COVERAGE of the essay (pieces that are common words),
+    only the groups with at least half the anchors of the best group are
+    aligned. A true match with many edits keeps few of its pieces and may
+    be dropped this way, so an ambiguous span can end up with a single
+    match.
+
+    Parameters
+    ----------
+    deadline : float, optional
+        time.perf_counter() value at which the search is stopped.
+
+    Returns
+    -------
+    list of fuzzysearch.Match or None
+        Matches with positions in full_essay like
+        fuzzysearch.find_near_matches: the best match (fewest edits, then
+        longest) of every group of overlapping alignments. None if the
+        deadline passed before all groups were aligned.
+    """
+    max_l_dist = int(len(span) / fuzzysearch_factor)
+    if max_l_dist == 0:
+        return fuzzysearch.find_near_matches(span, full_essay, max_l_dist=0)
+    if len(span) // (max_l_dist + 1) < ALIGN_MIN_ANCHOR_LENGTH:
+        alignments = _banded_alignments(
+            span, full_essay, [[-max_l_dist, len(full_essay)]], max_l_dist,
+            deadline)
+        if alignments is None:
+            return None
+        return _consolidate_alignments(alignments, full_essay)
+
+    groups = _group_anchor_diagonals(span, full_essay, max_l_dist)
+    if not groups:
+        return []
+    window_length = sum(
+        min(len(full_essay), last + len(span) + max_l_dist)
+        - max(0, first - max_l_dist) for first, last, _, _ in groups)
+    if window_length > ALIGN_MAX_WINDOW_COVERAGE * len(full_essay):
+        max_count = max(count for _, _, count, _ in groups)
+        groups = [group for group in groups if 2 * group[2] >= max_count]
+
+    # Merge overlapping bands and align the span within them
+    bands = []
+    for first, last, _, _ in groups:
+        if bands and first - max_l_dist <= bands[-1][1]:
+            bands[-1][1] = last + max_l_dist
+        else:
+            bands.append([first - max_l_dist, last + max_l_dist])
+    alignments = _banded_alignments(span, full_essay, bands, max_l_dist,
+                                    deadline)
+    if alignments is None:
+        return None
+    return _consolidate_alignments(alignments, full_essay)
+
+
+def _banded_alignments(span, full_essay, bands, max_l_dist, deadline=None):
+    """
+    Semi-global Levenshtein alignment of the whole span to the essay,
+    restricted to bands of diagonals (start position of the span in the
+    essay minus its position in the span). Row i of the dynamic program
+    holds the edits of span[:i] for every diagonal of every band, the rows
+    are computed with numpy. The left neighbour of a cell is resolved with
+    a cumulative minimum, and every cell also carries the earliest start
+    of its best alignments, so the longest alignment wins a tie.
+
+    Parameters
+    ----------
+    bands : list of list
+        [first diagonal, last diagonal] of every band.
+
+    Returns
+    -------
+    list of tuple or None
+        (start, end, dist) of the best alignment ending at every position
+        with at most max_l_dist edits. None if the deadline passed.
+    """
+    essay_codes = _essay_codes(full_essay)
+    span_codes = np.frombuffer(span.encode("utf-32-le"), dtype=np.uint32)
+    # One row per band, padded with diagonals beyond the end of the essay
+    width = max(high - low for low, high in bands) + 1
+    outside = len(full_essay) + 1
+    diagonals = np.full((len(bands), width), outside, dtype=np.int64)
+    for k, (low, high) in enumerate(bands):
+        diagonals[k, :high - low + 1] = np.arange(low, high + 1)
+    # Cells hold dist * scale + start, compared as one integer
+    scale = len(full_essay) + 1
+    infinite = np.int64(1) << 60
+    shift = np.arange(width, dtype=np.int64) * scale
+
+    row = np.where((diagonals >= 0) & (diagonals <= len(full_essay)),
+                   diagonals, infinite)
+    for i in range(1, len(span) + 1):
+        if deadline is not None and i % 64 == 1 \
+                and time.perf_counter() > deadline:
+            return None
+        positions = diagonals + (i - 1)
+        inside = (positions >= 0) & (positions < len(full_essay))
+        mismatch = essay_codes[np.clip(positions, 0, len(full_essay) - 1)] \
+            != span_codes[i - 1]
+        substitution = np.where(inside, row + mismatch * scale, infinite)
+        deletion = np.full_like(row, infinite)
+        deletion[:, :-1] = row[:, 1:] + scale
+        row = np.minimum(substitution, deletion)
+        row = np.minimum.accumulate(row - shift, axis=1) + shift
+        row[(positions < -1) | (positions >= len(full_essay))] = infinite
+        if row.min() // scale > max_l_dist:
+            return []
+    dists = row // scale
+    found = dists <= max_l_dist
+    return list(zip((row[found] % scale).tolist(),
+                    (diagonals[found] + len(span)).tolist(),
+                    dists[found].tolist()))
+
+
+@functools.lru_cache(maxsize=16)
+def _essay_codes(full_essay):
+    return np.frombuffer(full_essay.encode("utf-32-le"), dtype=np.uint32)
+
+
+def _consolidate_alignments(alignments, full_essay):
+    """
+    Keep the best alignment (fewest edits, then longest) of every group of
+    overlapping alignments, like fuzzysearch consolidates its matches.
+
+    Returns
+    -------
+    list of fuzzysearch.Match
+        Sorted by position.
+    """
+    groups = []
+    for start, end, dist in sorted(set(alignments)):
+        if groups and start < groups[-1][0]:
+            groups[-1][0] = max(groups[-1][0], end)
+            groups[-1][1].append((start, end, dist))
+        else:
+            groups.append([end, [(start, end, dist)]])
+    matches = []
+    for _, group in groups:
+        start, end, dist = min(group, key=lambda alignment: (
+            alignment[2], alignment[0] - alignment[1], alignment[0]))
+        matches.append(fuzzysearch.Match(start=start, end=end, dist=dist,
+                                         matched=full_essay[start:end]))
+    return matches
+
+
+def anchor_match_not_verbatim_du(span, full_essay, fuzzysearch_factor=10):
+    """
+    Cheap fallback of align_not_verbatim_du without fuzzysearch: the span is
+    placed on the diagonal with the most anchors of the best group of
+    diagonals. The edit distance of the match is not computed, dist is
+    set to max_l_dist.
+
+    Returns
+    -------
+    list of fuzzysearch.Match
+        One match, or no match if there are no anchors or several groups
+        have the most anchors.
+    """
+    max_l_dist = int(len(span) / fuzzysearch_factor)
+    if max_l_dist == 0 \
+            or len(span) // (max_l_dist + 1) < ALIGN_MIN_ANCHOR_LENGTH:
+        return []
+    groups = _group_anchor_diagonals(span, full_essay, max_l_dist)
+    if not groups:
+        return []
+    max_count = max(count for _, _, count, _ in groups)
+    best_groups = [group for group in groups if group[2] == max_count]
+    if len(best_groups) > 1:
+        return []
+    start = min(max(0, best_groups[0][3]), len(full_essay))
+    end = min(len(full_essay), start + len(span))
+    return [fuzzysearch.Match(start=start, end=end, dist=max_l_dist,
+                              matched=full_essay[start:end])]
+
+
+def _group_anchor_diagonals(span, full_essay, max_l_dist):
+    """
+    Find the exact occurrences of the max_l_dist + 1 pieces of the span and
+    group their diagonals (start positions of the span) that are at most
+    max_l_dist apart.
+
+    Returns
+    -------
+    list of list
+        [first diagonal, last diagonal, number of anchors, diagonal with
+        the most anchors] of every group, sorted by the diagonals.
+    """
+    piece_length = len(span) // (max_l_dist + 1)
+    # Count the anchors of every diagonal
+    votes = {}
+    for k in range(max_l_dist + 1):
+        offset = k * piece_length
+        # The last piece takes the rest of the span
+        piece = span[offset:offset + piece_length] if k < max_l_dist \
+            else span[offset:]
+        position = full_essay.find(piece)
+        while position != -1:
+            votes[position - offset] = votes.get(position - offset, 0) + 1
+            position = full_essay.find(piece, position + 1)
+
+    groups = []
+    for diagonal in sorted(votes):
+        if groups and diagonal - groups[-1][1] <= max_l_dist:
+            group = groups[-1]
+            group[1] = diagonal
+            group[2] += votes[diagonal]
+            if votes[diagonal] > votes[group[3]]:
+                group[3] = diagonal
+        else:
+            groups.append([diagonal, diagonal, votes[diagonal], diagonal])
+    return groups
+
+
+def match_not_verbatim_du_within_budget(span, full_essay, fuzzysearch_factor,
+                                        fuzzy_budget, essay_deadline=None):
+    """
+    Invoke match_not_verbatim_du within the limits of the fuzzy_budget.
+    Spans whose max_l_dist exceeds the budget, and spans that are still
+    aligned when the span or essay time budget is used up, fall back to
+    anchor_match_not_verbatim_du or are skipped.
+
+    Parameters
+    ----------
+    fuzzy_budget : dict
+        Any of the keys "max_span_seconds", "max_essay_seconds" (time
+        budgets), "max_l_dist" (max edit distance of the alignment) and
+        "fallback" ("anchor" (default) or "skip").
+    essay_deadline : float, optional
+        time.perf_counter() value at which the essay budget is used up.
+
+    Returns
+    -------
+    tuple
+        List of fuzzysearch.Match and whether the budget was hit.
+    """
+    max_l_dist = int(len(span) / fuzzysearch_factor)
+    now = time.perf_counter()
+    deadline = essay_deadline
+    if fuzzy_budget.get("max_span_seconds") is not None:
+        span_deadline = now + fuzzy_budget["max_span_seconds"]
+        deadline = span_deadline if deadline is None \
+            else min(deadline, span_deadline)
+    over_budget = (max_l_dist > fuzzy_budget.get("max_l_dist", max_l_dist)
+                   or (deadline is not None and now > deadline))
+    if not over_budget:
+        matches = align_not_verbatim_du(span, full_essay, fuzzysearch_factor,
+                                        deadline)
+        if matches is not None:
+            return matches, False
+
+    log.debug("! fuzzy matching budget of span exceeded")
+    if fuzzy_budget.get("fallback", "anchor") == "skip":
+        return [], True
+    return anchor_match_not_verbatim_du(span, full_essay,
+                                        fuzzysearch_factor), True
+
+
 def fill_prompt_var_dict(df_row, prompt_var_func_dict):
     """
     Create a Python dictionary where the keys are the possible prompt variables
@@ -449,6 +1907,14 @@ def parse_discourse_type(classified_type):
     XML-like syntax. This allows slight variations in the spelling or
     variations in the capitalization of the discourse unit types.
     """
+    return discourse_type_normaliser.normalise(classified_type)
+
+
+def parse_discourse_type_reference(classified_type):
+    """
+    Implementation of parse_discourse_type with difflib for every label.
+    Reference for tests.
+    """
     valid_types = get_valid_types_list()
     if classified_type:
         matches = difflib.get_close_matches(classified_type.lower(),
@@ -458,6 +1924,75 @@ def parse_discourse_type(classified_type):
     return None
 
 
+class DiscourseTypeNormaliser:
+    """
+    Map the discourse unit types emitted by the LLM to the valid types like
+    difflib.get_close_matches in parse_discourse_type_reference. The lower
+    case, and the lower case without spaces, of every valid type are looked
+    up in a precomputed table. Other labels are matched with difflib once
+    and kept in an LRU cache.
+
+    Parameters
+    ----------
+    valid_types : list of str, optional
+        The default is get_valid_types_list().
+    max_fuzzy_cache_size : int, optional
+        Max number of labels in the LRU cache. The default is 4096.
+    """
+
+    def __init__(self, valid_types=None, max_fuzzy_cache_size=4096):
+        self.valid_types = valid_types or get_valid_types_list()
+        self.table_hits = 0
+        self.unknown_labels = 0
+        self.fuzzy_match = functools.lru_cache(
+            maxsize=max_fuzzy_cache_size)(self.close_match)
+        # The values are computed with difflib as well, so the table only
+        # saves the work and never changes the result
+        self.table = {}
+        for valid_type in self.valid_types:
+            for label in [valid_type.lower(),
+                          valid_type.lower().replace(" ", "")]:
+                self.table[label] = self.close_match(label)
+
+    def close_match(self, label):
+        """
+        Return the valid type closest to the lower case label or None.
+        """
+        matches = difflib.get_close_matches(label, self.valid_types, n=1,
+                                            cutoff=0.6)
+        return matches[0] if matches else None
+
+    def normalise(self, classified_type):
+        """
+        Return the valid type of the label classified_type or None.
+        """
+        if not classified_type:
+            self.unknown_labels += 1
+            return None
+        label = classified_type.lower()
+        if label in self.table:
+            self.table_hits += 1
+            return self.table[label]
+        discourse_type = self.fuzzy_match(label)
+        if discourse_type is None:
+            self.unknown_labels += 1
+        return discourse_type
+
+    def counters(self):
+        """
+        Return the number of table hits, fuzzy cache hits and misses and
+        unknown labels.
+        """
+        cache_info = self.fuzzy_match.cache_info()
+        return {"table_hits": self.table_hits,
+                "fuzzy_cache_hits": cache_info.hits,
+                "fuzzy_cache_misses": cache_info.misses,
+                "unknown_labels": self.unknown_labels}
+
+
+discourse_type_normaliser = DiscourseTypeNormaliser()
+
+
 def add_predictionstring_span(df, full_text_col, du_start_index_col,
                               du_end_index_col):
     """
@@ -473,9 +2008,68 @@ def add_predictionstring_span(df, full_text_col, du_start_index_col,
     return prediction_df
 
 
+def add_word_interval(df, full_text_col, du_start_index_col,
+                      du_end_index_col):
+    """
+    Add the word index interval of every discourse unit as the columns
+    word_start and word_end (exclusive), i.e., the range of word indices of
+    the prediction string of add_predictionstring_span. The word offsets of
+    every essay text are computed once.
+    """
+    # Start offsets of the words of every text
+    word_offsets = {}
+    word_starts = []
+    word_ends = []
+    for text, start_idx, end_idx in zip(df[full_text_col],
+                                        df[du_start_index_col],
+                                        df[du_end_index_col]):
+        if text not in word_offsets:
+            word_offsets[text] = [match.start() for match
+                                  in WORD_PATTERN.finditer(text)]
+        # Words beginning before an offset are the words of
+        # text[:offset].split()
+        word_starts.append(bisect.bisect_left(word_offsets[text], start_idx))
+        word_ends.append(bisect.bisect_left(word_offsets[text], end_idx))
+    return df.assign(word_start=word_starts, word_end=word_ends)
+
+
 def build_predictionstring_df_word(df, full_text_col, du_start_index_col,
                                    du_end_index_col, essay_id_col,
                                    discourse_type_col):
+    """
+    Build the word-based prediction strings: one row per word of every
+    discourse unit with the word index as predictionstring. All rows are
+    built at once from the word index intervals (see add_word_interval).
+    """
+    word_interval_df = add_word_interval(df, full_text_col,
+                                         du_start_index_col, du_end_index_col)
+    word_starts = word_interval_df["word_start"].to_numpy(dtype=np.int64)
+    word_counts = np.clip(
+        word_interval_df["word_end"].to_numpy(dtype=np.int64) - word_starts,
+        0, None)
+    # Word index of every row: the start of its discourse unit plus the
+    # position of the row within the words of the discourse unit
+    row_starts = np.cumsum(word_counts) - word_counts
+    word_idx = np.arange(word_counts.sum()) \
+        + np.repeat(word_starts - row_starts, word_counts)
+    return pd.DataFrame({
+        "essay_id": np.repeat(df[essay_id_col].to_numpy(dtype=object),
+                              word_counts),
+        "discourse_type": np.repeat(
+            df[discourse_type_col].to_numpy(dtype=object), word_counts),
+        "predictionstring": np.array(list(map(str, word_idx.tolist())),
+                                     dtype=object),
+        })
+
+
+def build_predictionstring_df_word_reference(df, full_text_col,
+                                             du_start_index_col,
+                                             du_end_index_col, essay_id_col,
+                                             discourse_type_col):
+    """
+    Reference implementation of build_predictionstring_df_word with one
+    concat per word.
+    """
     word_predictionstring_df = pd.DataFrame(
         columns=["essay_id", "discourse_type", "predictionstring"])
     for i, row in df.iterrows():
@@ -541,9 +2135,10 @@ def check_overlap(s1, e1, s2, e2):
         return None
 
 
-def createLogger(full_output_dir, logger_name="main_logger"):
+def createLogger(full_output_dir, logger_name="main_logger", file_mode="w"):
     """
-    Setup logging (to console and to file)
+    Setup logging (to console and to file). Use file_mode "a" to append to
+    the log file of an existing experiment.
     """
     log = logging.getLogger(logger_name)
     log.setLevel(logging.DEBUG)
@@ -557,7 +2152,7 @@ def createLogger(full_output_dir, logger_name="main_logger"):
     if not os.path.exists(full_output_dir):
         os.makedirs(full_output_dir)
     log_file = os.path.join(full_output_dir, f"{logger_name}.log")
-    file_handler = logging.FileHandler(log_file, mode="w")
+    file_handler = logging.FileHandler(log_file, mode=file_mode)
     # clear old loggers
     if log.hasHandlers():
         log.handlers.clear()